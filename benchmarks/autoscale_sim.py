@@ -0,0 +1,523 @@
+#!/usr/bin/env python
+"""
+Replays a job arrival trace against :doc:`feederd`'s real autoscaling logic
+(:py:meth:`EC2InstanceManager.spawn_if_needed`,
+:py:meth:`EC2InstanceManager.scale_in_if_needed` and the configured scaling
+policy) and a model of the :doc:`ec2nommerd` pull loop, on a simulated
+clock. Nothing touches AWS, and hours of traffic run in seconds, so
+settings like ``JOB_OVERFLOW_THRESH``, ``MAX_NUM_EC2_INSTANCES``,
+``NOMMERD_MAX_INACTIVITY``, ``MIN_NUM_EC2_INSTANCES``,
+``FEEDERD_MANAGE_SCALE_IN`` and the poll intervals can be compared cheaply.
+
+Reports queue wait percentiles (submission to a nommer picking the job up),
+instance-hours, slot utilization, and how often the new job queue was
+polled.
+
+Traces are CSV files with one job per line::
+
+    <arrival offset in seconds>,<encode time in seconds>[,<nommer FQPN>]
+
+Without a trace, Poisson arrivals are generated. Settings are overridden
+with ``--set``, or a whole ``nomconf.py``-style module with ``--settings``.
+
+Examples::
+
+    python benchmarks/autoscale_sim.py --rate 0.05 --hours 8 \\
+        --set MAX_NUM_EC2_INSTANCES=10 --set JOB_OVERFLOW_THRESH=4
+
+    python benchmarks/autoscale_sim.py --trace jobs.csv --boot-time 240 \\
+        --set FEEDERD_SCALING_POLICY="'media_nommer.feederd.scaling_policy.PredictiveScalingPolicy'"
+"""
+import os
+import sys
+import ast
+import math
+import heapq
+import random
+import optparse
+from collections import deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from media_nommer.conf import settings, update_settings_from_module
+from media_nommer.core import instance_types
+from media_nommer.core.job_state_backend import EncodingJob
+from media_nommer.feederd.job_cache import JobCache
+from media_nommer.feederd.scaling_policy import JobStatistics
+from media_nommer.feederd.ec2_instance_manager import EC2InstanceManager
+
+DEFAULT_NOMMER = 'media_nommer.ec2nommerd.nommers.ffmpeg.FFmpegNommer'
+
+def percentile(values, pct):
+    """
+    :param list values: A sorted list of numbers.
+    :param float pct: The percentile to find, between 0 and 100.
+    :returns: The value at the given percentile.
+    """
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[index]
+
+class SimJob(object):
+    """
+    A job in the trace, along with the real EncodingJob that feederd's
+    code sees.
+    """
+    def __init__(self, num, arrival, encode_time, nommer):
+        self.arrival = arrival
+        self.encode_time = encode_time
+        self.started = None
+        self.finished = None
+        self.job = EncodingJob('file:///sim/in.mp4', 'file:///sim/out.mp4',
+                               nommer, [], unique_id='sim-%d' % num)
+
+class SimInstance(object):
+    """
+    A simulated ec2nommerd instance. Has the boto Instance attributes
+    feederd looks at.
+    """
+    def __init__(self, num, launch_time, boot_time, instance_type):
+        self.id = 'i-sim%05d' % num
+        self.state = 'pending'
+        self.instance_type = instance_type
+        self.slots = instance_types.get_slots(instance_type)
+        self.throughput = instance_types.get_instance_type_info(
+                                                instance_type)['throughput']
+        self.launch_time = launch_time
+        self.ready_time = launch_time + boot_time
+        self.terminate_time = None
+        self.running_jobs = set()
+        self.last_activity = self.ready_time
+        # The attributes in the instance's heartbeat domain entry. Empty
+        # until the first heartbeat.
+        self.node_state = {}
+        # When feederd last renewed the instance's lease.
+        self.lease_time = self.ready_time
+        # JobPuller's state. Bumping pull_seq cancels a pending long poll
+        # timeout or backoff.
+        self.is_long_polling = False
+        self.num_empty_pulls = 0
+        self.pull_seq = 0
+
+class SimReservation(object):
+    """
+    Stands in for a boto Reservation.
+    """
+    def __init__(self, instances):
+        self.instances = instances
+
+class Simulation(object):
+    """
+    A discrete-event simulation of feederd, its instances, and the job
+    queue between them.
+    """
+    def __init__(self, jobs, boot_time, max_time):
+        self.now = 0.0
+        self.jobs = jobs
+        self.boot_time = boot_time
+        self.max_time = max_time
+        self.events = []
+        self.event_seq = 0
+        # The new job queue, in submission order.
+        self.queue = deque()
+        self.instances = []
+        # State changes that feederd hasn't picked up from the queue yet.
+        self.pending_state_changes = []
+        self.num_finished = 0
+        # Calls to receive from the new job queue.
+        self.num_receives = 0
+
+    def schedule(self, at, func, *args):
+        """
+        Runs ``func(*args)`` at simulated time ``at``.
+        """
+        self.event_seq += 1
+        heapq.heappush(self.events, (at, self.event_seq, func, args))
+
+    def schedule_every(self, interval, start, func, *args):
+        """
+        Runs ``func(*args)`` every ``interval`` seconds from ``start`` on,
+        like a LoopingCall. Stops once ``func`` returns ``False``.
+        """
+        def tick():
+            if func(*args) is not False:
+                self.schedule(self.now + interval, tick)
+        self.schedule(start, tick)
+
+    def get_active_instances(self):
+        return [instance for instance in self.instances
+                if instance.terminate_time is None]
+
+    def launch_instances(self, num_instances, instance_type):
+        new_instances = []
+        for i in range(num_instances):
+            instance = SimInstance(len(self.instances), self.now,
+                                   self.boot_time, instance_type)
+            self.instances.append(instance)
+            new_instances.append(instance)
+            self.schedule(instance.ready_time, self.instance_ready, instance)
+        return SimReservation(new_instances)
+
+    def instance_ready(self, instance):
+        instance.state = 'running'
+        # Instances don't boot in lockstep with anything else.
+        self.schedule_every(settings.NOMMERD_NEW_JOB_CHECK_INTERVAL,
+                            self.now, self.check_for_new_jobs, instance)
+        self.schedule_every(settings.NOMMERD_HEARTBEAT_INTERVAL,
+                            self.now + settings.NOMMERD_HEARTBEAT_INTERVAL,
+                            self.heartbeat, instance)
+
+    def check_for_new_jobs(self, instance):
+        """
+        Models ec2nommerd's task_check_for_new_jobs() safety net.
+        """
+        if instance.terminate_time is not None:
+            return False
+        self.request_pull(instance)
+
+    def request_pull(self, instance, reset_backoff=False):
+        """
+        Models JobPuller.request_pull(). Pulls are instant, except for long
+        polls on an empty queue, which end early if a job is submitted.
+        """
+        if reset_backoff and not instance.is_long_polling:
+            instance.num_empty_pulls = 0
+            instance.pull_seq += 1
+        if instance.terminate_time is not None or \
+           instance.is_long_polling or \
+           instance.node_state.get('drain') == '1':
+            return
+        num_to_pop = min(10, instance.slots - len(instance.running_jobs))
+        if num_to_pop <= 0:
+            return
+        self.num_receives += 1
+        if not self.queue:
+            instance.is_long_polling = True
+            instance.pull_seq += 1
+            self.schedule(self.now + settings.NOMMERD_NEW_JOB_WAIT_TIME,
+                          self.long_poll_timeout, instance, instance.pull_seq)
+            return
+
+        while num_to_pop > 0 and self.queue:
+            sim_job = self.queue.popleft()
+            num_to_pop -= 1
+            sim_job.started = self.now
+            instance.running_jobs.add(sim_job)
+            instance.last_activity = self.now
+            self.pending_state_changes.append((sim_job, 'ENCODING'))
+            self.schedule(self.now + sim_job.encode_time / instance.throughput,
+                          self.finish_job, instance, sim_job)
+        instance.num_empty_pulls = 0
+        instance.pull_seq += 1
+        # There may be more where those came from.
+        self.request_pull(instance)
+
+    def long_poll_timeout(self, instance, pull_seq):
+        if pull_seq != instance.pull_seq:
+            return
+        instance.is_long_polling = False
+        instance.num_empty_pulls += 1
+        instance.pull_seq += 1
+        backoff = min(settings.NOMMERD_NEW_JOB_BACKOFF_MIN *
+                      2 ** (instance.num_empty_pulls - 1),
+                      settings.NOMMERD_NEW_JOB_BACKOFF_MAX)
+        self.schedule(self.now + backoff, self.backoff_done, instance,
+                      instance.pull_seq)
+
+    def backoff_done(self, instance, pull_seq):
+        if pull_seq == instance.pull_seq:
+            self.request_pull(instance)
+
+    def finish_job(self, instance, sim_job):
+        sim_job.finished = self.now
+        instance.running_jobs.discard(sim_job)
+        instance.last_activity = self.now
+        self.pending_state_changes.append((sim_job, 'FINISHED'))
+        self.num_finished += 1
+        self.request_pull(instance, reset_backoff=True)
+
+    def terminate_instance(self, instance):
+        instance.terminate_time = self.now
+        instance.state = 'terminated'
+
+    def heartbeat(self, instance):
+        """
+        Models ec2nommerd's threaded_heartbeat(): idle self-termination
+        (only once feederd's lease is stale, if it manages scale-in), and
+        draining if feederd manages scale-in.
+        """
+        if instance.terminate_time is not None:
+            return False
+        idle_seconds = self.now - instance.last_activity
+        if settings.FEEDERD_MANAGE_SCALE_IN:
+            max_inactivity = settings.NOMMERD_FALLBACK_MAX_INACTIVITY
+            is_lease_stale = self.now - instance.lease_time > max_inactivity
+        else:
+            max_inactivity = settings.NOMMERD_MAX_INACTIVITY
+            is_lease_stale = True
+        if settings.NOMMERD_TERMINATE_WHEN_IDLE and is_lease_stale and \
+           not instance.running_jobs and idle_seconds > max_inactivity:
+            self.terminate_instance(instance)
+            return False
+
+        state = 'ACTIVE'
+        if settings.FEEDERD_MANAGE_SCALE_IN and \
+           instance.node_state.get('drain') == '1':
+            was_draining = instance.node_state.get('state') in \
+                           ('DRAINING', 'DRAINED')
+            if was_draining and not instance.running_jobs:
+                state = 'DRAINED'
+            else:
+                state = 'DRAINING'
+        instance.node_state.update({
+            'active_jobs': str(len(instance.running_jobs)),
+            'idle_seconds': str(int(idle_seconds)),
+            'instance_type': instance.instance_type,
+            'slots': str(instance.slots),
+            'state': state,
+        })
+
+    def submit_job(self, sim_job):
+        """
+        Models a job coming in through /job/submit.
+        """
+        self.queue.append(sim_job)
+        # Hand it to a long poll, if anyone's waiting.
+        for instance in self.get_active_instances():
+            if instance.is_long_polling:
+                instance.is_long_polling = False
+                instance.pull_seq += 1
+                self.request_pull(instance)
+                break
+        JobCache.update_job(sim_job.job)
+        JobStatistics.record_arrivals([sim_job.job])
+
+    def check_for_job_state_changes(self):
+        """
+        Models feederd's threaded_check_for_job_state_changes().
+        """
+        changed_jobs = []
+        for sim_job, job_state in self.pending_state_changes:
+            sim_job.job.job_state = job_state
+            JobCache.update_job(sim_job.job)
+            changed_jobs.append(sim_job.job)
+        self.pending_state_changes = []
+        JobStatistics.record_state_changes(changed_jobs)
+        JobCache.uncache_finished_jobs()
+
+    def manage_instances(self):
+        """
+        Models feederd's threaded_manage_ec2_instances().
+        """
+        SimulatedInstanceManager.spawn_if_needed()
+        if settings.FEEDERD_MANAGE_SCALE_IN:
+            SimulatedInstanceManager.scale_in_if_needed()
+
+    def is_done(self):
+        if self.num_finished < len(self.jobs):
+            return False
+        # Keep going until the last instances (short of the warm pool)
+        # wind down.
+        if settings.FEEDERD_MANAGE_SCALE_IN:
+            num_to_keep = settings.MIN_NUM_EC2_INSTANCES
+        elif settings.NOMMERD_TERMINATE_WHEN_IDLE:
+            num_to_keep = 0
+        else:
+            return True
+        return len(self.get_active_instances()) <= num_to_keep
+
+    def run(self):
+        for sim_job in self.jobs:
+            self.schedule(sim_job.arrival, self.submit_job, sim_job)
+        self.schedule_every(settings.FEEDERD_JOB_STATE_CHANGE_CHECK_INTERVAL,
+                            settings.FEEDERD_JOB_STATE_CHANGE_CHECK_INTERVAL,
+                            self.check_for_job_state_changes)
+        self.schedule_every(settings.FEEDERD_AUTO_SCALE_INTERVAL,
+                            settings.FEEDERD_AUTO_SCALE_INTERVAL,
+                            self.manage_instances)
+
+        while self.events and not self.is_done():
+            at, seq, func, args = heapq.heappop(self.events)
+            if at > self.max_time:
+                break
+            self.now = at
+            func(*args)
+
+class SimulatedInstanceManager(EC2InstanceManager):
+    """
+    feederd's real instance manager, with the EC2 calls pointed at the
+    simulation.
+    """
+    simulation = None
+
+    @classmethod
+    def get_instances(cls, max_age=None):
+        return cls.simulation.get_active_instances()
+
+    @classmethod
+    def spawn_instances(cls, num_instances, instance_type=None):
+        return [cls.simulation.launch_instances(
+                    num_instances, instance_type or settings.EC2_INSTANCE_TYPE)]
+
+    @classmethod
+    def get_node_states(cls):
+        return dict([(instance.id, dict(instance.node_state))
+                     for instance in cls.simulation.get_active_instances()
+                     if instance.node_state])
+
+    @classmethod
+    def renew_node_leases(cls, node_states):
+        for instance in cls.simulation.get_active_instances():
+            if instance.id in node_states:
+                instance.lease_time = cls.simulation.now
+
+    @classmethod
+    def set_node_draining(cls, instance_id, is_draining):
+        for instance in cls.simulation.get_active_instances():
+            if instance.id != instance_id:
+                continue
+            if is_draining:
+                instance.node_state['drain'] = '1'
+            else:
+                instance.node_state.pop('drain', None)
+
+    @classmethod
+    def terminate_instances(cls, instances):
+        for instance in instances:
+            cls.simulation.terminate_instance(instance)
+
+    @classmethod
+    def get_instance_uptime(cls, instance):
+        return cls.simulation.now - instance.launch_time
+
+def load_trace(path):
+    """
+    :param str path: The path to a trace CSV file.
+    :rtype: list
+    :returns: A list of SimJobs, in arrival order.
+    """
+    rows = []
+    for line in open(path):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = [field.strip() for field in line.split(',')]
+        nommer = fields[2] if len(fields) > 2 else DEFAULT_NOMMER
+        rows.append((float(fields[0]), float(fields[1]), nommer))
+    rows.sort()
+    return [SimJob(num, arrival, encode_time, nommer)
+            for num, (arrival, encode_time, nommer) in enumerate(rows)]
+
+def generate_trace(rate, hours, mean_encode_time):
+    """
+    Generates Poisson arrivals, with gamma-distributed encode times.
+
+    :param float rate: Jobs per second.
+    :param float hours: How long jobs keep arriving.
+    :param float mean_encode_time: The mean encode time, in seconds.
+    :rtype: list
+    :returns: A list of SimJobs, in arrival order.
+    """
+    jobs = []
+    arrival = random.expovariate(rate)
+    while arrival < hours * 3600:
+        encode_time = random.gammavariate(4, mean_encode_time / 4.0)
+        jobs.append(SimJob(len(jobs), arrival, encode_time, DEFAULT_NOMMER))
+        arrival += random.expovariate(rate)
+    return jobs
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--trace',
+                      help='A CSV trace of jobs to replay.')
+    parser.add_option('--rate', type='float', default=0.02,
+                      help='Jobs per second, if no trace is given.')
+    parser.add_option('--hours', type='float', default=4,
+                      help='Hours of arrivals, if no trace is given.')
+    parser.add_option('--mean-encode-time', type='float', default=600,
+                      help='Mean encode time in seconds, if no trace is '
+                           'given.')
+    parser.add_option('--boot-time', type='float', default=180,
+                      help='Seconds from spawning an instance until it '
+                           'starts pulling jobs.')
+    parser.add_option('--seed', type='int', default=0,
+                      help='Random seed for generated traces.')
+    parser.add_option('--max-hours', type='float', default=72,
+                      help='Give up after this many simulated hours.')
+    parser.add_option('--settings',
+                      help='A nomconf.py-style module to load settings from.')
+    parser.add_option('--set', action='append', default=[],
+                      metavar='NAME=VALUE',
+                      help='Override a setting with a Python literal. May '
+                           'be given more than once.')
+    options, args = parser.parse_args()
+
+    if options.settings:
+        module_dir, module_file = os.path.split(
+            os.path.abspath(options.settings))
+        sys.path.insert(0, module_dir)
+        update_settings_from_module(
+            __import__(os.path.splitext(module_file)[0]))
+    for override in options.set:
+        name, value = override.split('=', 1)
+        setattr(settings, name.strip(), ast.literal_eval(value.strip()))
+
+    random.seed(options.seed)
+    if options.trace:
+        jobs = load_trace(options.trace)
+    else:
+        jobs = generate_trace(options.rate, options.hours,
+                              options.mean_encode_time)
+    if not jobs:
+        parser.error("No jobs to simulate.")
+
+    simulation = Simulation(jobs, options.boot_time,
+                            options.max_hours * 3600)
+    SimulatedInstanceManager.simulation = simulation
+    JobStatistics.clock = staticmethod(lambda: simulation.now)
+    simulation.run()
+
+    waits = sorted([sim_job.started - sim_job.arrival for sim_job in jobs
+                    if sim_job.started is not None])
+    busy_seconds = sum([(sim_job.finished or simulation.now) - sim_job.started
+                        for sim_job in jobs if sim_job.started is not None])
+    instance_seconds = []
+    slot_seconds = 0.0
+    billed_cost = 0.0
+    type_counts = {}
+    for instance in simulation.instances:
+        end = instance.terminate_time or simulation.now
+        instance_seconds.append(end - instance.launch_time)
+        slot_seconds += instance_seconds[-1] * instance.slots
+        # EC2 bills each started hour.
+        billed_cost += int(math.ceil(instance_seconds[-1] / 3600.0)) * \
+            instance_types.get_instance_type_info(instance.instance_type)['cost']
+        type_counts[instance.instance_type] = \
+            type_counts.get(instance.instance_type, 0) + 1
+    billed_hours = sum([int(math.ceil(seconds / 3600.0))
+                        for seconds in instance_seconds])
+
+    print "Scaling policy:   %s" % settings.FEEDERD_SCALING_POLICY
+    print "Jobs:             %d (%d finished)" % (len(jobs),
+                                                  simulation.num_finished)
+    print "Simulated time:   %.1f hours" % (simulation.now / 3600.0)
+    for pct in [50, 90, 99]:
+        print "p%d queue wait:   %.0f s" % (pct, percentile(waits, pct))
+    print "Max queue wait:   %.0f s" % (waits[-1] if waits else 0)
+    print "Instances:        %d launched (%s)" % (
+        len(simulation.instances),
+        ', '.join(['%d %s' % (type_counts[name], name)
+                   for name in sorted(type_counts)]))
+    print "Instance-hours:   %.1f (%d billed)" % (
+        sum(instance_seconds) / 3600.0, billed_hours)
+    print "Billed cost:      %.2f" % billed_cost
+    if instance_seconds:
+        print "Queue receives:   %d (%.0f per instance-hour)" % (
+            simulation.num_receives,
+            simulation.num_receives / (sum(instance_seconds) / 3600.0))
+    if slot_seconds:
+        print "Utilization:      %.1f%%" % (100.0 * busy_seconds / slot_seconds)
+
+if __name__ == '__main__':
+    main()
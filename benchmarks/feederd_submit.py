@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""
+Measures job submission throughput against a running :doc:`feederd`.
+Several submitter threads POST jobs to the JSON API as fast as they can
+for a while, then the requests/sec and latency percentiles are reported.
+
+Point feederd at the SQLite job state backend (see the "Running without
+AWS" section of the hacking docs) to benchmark without touching AWS, or
+at the default backend to see how it holds up against SimpleDB and SQS.
+
+Example::
+
+    python benchmarks/feederd_submit.py --url http://localhost:8001 \\
+        --submitters 20 --duration 30
+"""
+import json
+import time
+import urllib2
+import optparse
+import threading
+
+JOB = {
+    'source_path': 'file:///tmp/benchmark_in.mp4',
+    'dest_path': 'file:///tmp/benchmark_out.mp4',
+    'job_options': {
+        'nommer': 'media_nommer.ec2nommerd.nommers.ffmpeg.FFmpegNommer',
+        'options': [{'outfile_options': [['threads', 0]]}],
+    },
+}
+
+def percentile(values, pct):
+    """
+    :param list values: A sorted list of numbers.
+    :param float pct: The percentile to find, between 0 and 100.
+    :returns: The value at the given percentile.
+    """
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[index]
+
+def submitter(url, body, stop_time, latencies, errors, lock):
+    """
+    Submits jobs until ``stop_time``, recording the latency of each request.
+    """
+    while time.time() < stop_time:
+        start = time.time()
+        try:
+            response = urllib2.urlopen(url, body)
+            result = json.loads(response.read())
+            success = result.get('success')
+        except Exception:
+            success = False
+        elapsed = time.time() - start
+        lock.acquire()
+        try:
+            if success:
+                latencies.append(elapsed)
+            else:
+                errors.append(elapsed)
+        finally:
+            lock.release()
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--url', default='http://localhost:8001',
+                      help='The base URL of feederd.')
+    parser.add_option('--submitters', type='int', default=10,
+                      help='The number of concurrent submitters.')
+    parser.add_option('--duration', type='float', default=10,
+                      help='How long to submit jobs for (in seconds).')
+    parser.add_option('--batch-size', type='int', default=0,
+                      help='If set, submit this many jobs per request '
+                           'through /job/submit_batch.')
+    options, args = parser.parse_args()
+
+    if options.batch_size:
+        url = options.url.rstrip('/') + '/job/submit_batch'
+        body = json.dumps({'jobs': [JOB] * options.batch_size})
+    else:
+        url = options.url.rstrip('/') + '/job/submit'
+        body = json.dumps(JOB)
+
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    stop_time = time.time() + options.duration
+    threads = [threading.Thread(target=submitter,
+                                args=(url, body, stop_time, latencies,
+                                      errors, lock))
+               for i in range(options.submitters)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    latencies.sort()
+    jobs_per_request = options.batch_size or 1
+    print "Submitters:     %d" % options.submitters
+    print "Requests:       %d (%d errors)" % (len(latencies) + len(errors),
+                                              len(errors))
+    print "Requests/sec:   %.1f" % (len(latencies) / elapsed)
+    print "Jobs/sec:       %.1f" % (len(latencies) * jobs_per_request / elapsed)
+    for pct in [50, 90, 99]:
+        print "p%d latency:    %.1f ms" % (pct,
+                                           percentile(latencies, pct) * 1000)
+
+if __name__ == '__main__':
+    main()
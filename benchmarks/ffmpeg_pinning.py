@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+"""
+Compares the aggregate encoding speed of several concurrent ffmpeg runs,
+with and without the CPU pinning and thread budgeting that
+:doc:`ec2nommerd` does (see
+:py:class:`CPUAllocator <media_nommer.ec2nommerd.cpu_allocator.CPUAllocator>`).
+
+* Unpinned: every ffmpeg gets ``-threads 0``, and starts a thread for each
+  core on the machine.
+* Pinned: each ffmpeg is pinned to its share of the cores with taskset,
+  and gets a thread per core in its share.
+
+Reports the total frames encoded per second for each, along with the
+slowest and fastest job. Without ``--infile``, a test pattern is generated
+by ffmpeg, so nothing needs downloading.
+
+Example::
+
+    python benchmarks/ffmpeg_pinning.py --jobs 4 --preset fast \\
+        --infile some_video.mp4
+"""
+import os
+import re
+import sys
+import time
+import optparse
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from media_nommer.ec2nommerd.cpu_allocator import CPUAllocator
+from media_nommer.ec2nommerd.resource_monitor import ResourceMonitor
+
+# ffmpeg reports progress like "frame= 1234 fps=...".
+FRAME_RE = re.compile(r'frame=\s*(\d+)')
+
+class BenchmarkJob(object):
+    """
+    Stands in for an EncodingJob, as far as CPUAllocator cares.
+    """
+    def __init__(self, unique_id):
+        self.unique_id = unique_id
+
+def get_input_args(options):
+    """
+    :returns: The ffmpeg arguments for the input, either the given file or
+        a generated test pattern.
+    """
+    if options.infile:
+        return ['-i', options.infile]
+    return ['-f', 'lavfi', '-i',
+            'testsrc=duration=%d:size=%s:rate=30' % (options.duration,
+                                                     options.size)]
+
+def run_round(options, is_pinned):
+    """
+    Runs ``options.jobs`` ffmpeg processes at once, and waits for all of
+    them to finish.
+
+    :param bool is_pinned: If ``True``, pin each process to its share of
+        the cores, and give it a thread per core.
+    :rtype: tuple
+    :returns: A ``(total frames, elapsed seconds, per-job fps list)`` tuple.
+    """
+    processes = []
+    start = time.time()
+    for index in range(options.jobs):
+        job = BenchmarkJob('benchmark-%d' % index)
+        if is_pinned:
+            cores = CPUAllocator.acquire(job, options.jobs)
+            prefix = CPUAllocator.get_pinning_prefix(cores)
+            threads = len(cores)
+        else:
+            prefix = []
+            threads = 0
+        cmd = prefix + ['ffmpeg', '-y'] + get_input_args(options) + [
+            '-threads', str(threads), '-vcodec', options.vcodec,
+            '-preset', options.preset, '-an', '-f', 'null', os.devnull]
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        processes.append((job, process, time.time()))
+
+    total_frames = 0
+    job_fps = []
+    for job, process, job_start in processes:
+        stderr = process.communicate()[1]
+        job_elapsed = time.time() - job_start
+        CPUAllocator.release(job)
+        if process.returncode != 0:
+            print stderr
+            raise RuntimeError('ffmpeg failed on %s' % job.unique_id)
+        frames = FRAME_RE.findall(stderr)
+        num_frames = frames and int(frames[-1]) or 0
+        total_frames += num_frames
+        job_fps.append(num_frames / job_elapsed)
+    return total_frames, time.time() - start, job_fps
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--jobs', type='int',
+                      default=max(2, ResourceMonitor.get_num_cpus() // 2),
+                      help='How many ffmpeg processes to run at once.')
+    parser.add_option('--infile',
+                      help='The file to encode. If left out, a test pattern '
+                           'is generated.')
+    parser.add_option('--duration', type='int', default=20,
+                      help='How long (in seconds) the test pattern is.')
+    parser.add_option('--size', default='1280x720',
+                      help='The test pattern\'s frame size.')
+    parser.add_option('--vcodec', default='libx264',
+                      help='The video codec to encode with.')
+    parser.add_option('--preset', default='medium',
+                      help='The encoder preset.')
+    parser.add_option('--rounds', type='int', default=1,
+                      help='How many times to run each mode.')
+    options, args = parser.parse_args()
+
+    print "Cores:          %d" % ResourceMonitor.get_num_cpus()
+    print "Concurrent:     %d" % options.jobs
+    for label, is_pinned in [('Unpinned', False), ('Pinned', True)]:
+        total_frames = 0
+        total_elapsed = 0.0
+        job_fps = []
+        for round_num in range(options.rounds):
+            frames, elapsed, fps = run_round(options, is_pinned)
+            total_frames += frames
+            total_elapsed += elapsed
+            job_fps += fps
+        print "%-15s %.1f fps total, %.1f-%.1f fps per job" % (
+            label + ':', total_frames / total_elapsed, min(job_fps),
+            max(job_fps))
+
+if __name__ == '__main__':
+    main()
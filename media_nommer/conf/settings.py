@@ -77,6 +77,72 @@ EC2_INSTANCE_TYPE = 'm1.large'
 
 The type of instance to run on. Must be at least ``m1.large``. ``t1.micro``
 and ``t1.small`` instances are *NOT* supported by the default AMI."""
+EC2_INSTANCE_TYPES = {}
+"""Default: ``{}``
+
+The instance types :doc:`../feederd` may spawn, with how many jobs each
+runs at once (``slots``), how fast each slot encodes compared to others
+(``throughput``, ``1.0`` by default), and what an hour of each costs
+(``cost``). For example::
+
+    EC2_INSTANCE_TYPES = {
+        'm1.large': {'slots': 2, 'throughput': 1.0, 'cost': 0.32},
+        'c1.xlarge': {'slots': 4, 'throughput': 1.6, 'cost': 0.66},
+    }
+
+When spawning, :doc:`../feederd` picks the mix of types that clears the
+waiting jobs for the least money: fast types for long jobs, and cheap ones
+for short jobs. If empty, only :py:data:`EC2_INSTANCE_TYPE` is spawned, with
+:py:data:`MAX_ENCODING_JOBS_PER_EC2_INSTANCE` slots."""
+EC2_FALLBACK_INSTANCE_TYPES = []
+"""Default: ``[]``
+
+Instance types to spawn instead, if EC2_ is short on
+:py:data:`EC2_INSTANCE_TYPE` capacity. Whatever the preferred type can't
+take is spread over these (and :py:data:`EC2_AVAILABILITY_ZONES`) in
+parallel."""
+EC2_AVAILABILITY_ZONES = []
+"""Default: ``[]``
+
+Availability zones to spawn EC2_ instances in, the preferred one first.
+The others are only used when the first is short on capacity. If empty,
+EC2_ picks."""
+EC2_USE_RELEASE_BUNDLE = True
+"""Default: ``True``
+
+When ``True``, :doc:`../feederd` uploads a bundle of the media-nommer code
+it's running (see :py:mod:`media_nommer.feederd.release_bundle`) to
+:py:data:`CONFIG_S3_BUCKET` at startup, and new EC2_ instances install
+from it. This is much faster than installing from GitHub on every launch,
+and keeps the instances running the same code as :doc:`../feederd`. When
+``False`` (or if the upload fails), instances install the latest code
+from GitHub."""
+EC2_RELEASE_BUNDLE_INCLUDE_DEPENDENCIES = False
+"""Default: ``False``
+
+When ``True``, wheels of media-nommer's dependencies are built with
+:command:`pip` and included in the release bundle, so instances don't need
+to download any of them. When ``False``, instances install the pinned
+versions from PyPI instead, which is quick if the AMI already has them."""
+EC2_RELEASE_BUNDLE_CACHE_DIR = '/home/nom/.media_nommer_bundles'
+"""Default: ``'/home/nom/.media_nommer_bundles'``
+
+Where instances keep downloaded release bundles. A bundle already here
+(baked into an AMI, for example) isn't downloaded again."""
+EC2_INSTANCE_TAGS = {'media-nommer': 'ec2nommerd'}
+"""Default: ``{'media-nommer': 'ec2nommerd'}``
+
+Tags applied to the EC2_ instances :doc:`../feederd` spawns. See
+:py:data:`EC2_FILTER_BY_TAGS`."""
+EC2_FILTER_BY_TAGS = False
+"""Default: ``False``
+
+If ``True``, only instances with the :py:data:`EC2_INSTANCE_TAGS` tags (and
+the :py:data:`EC2_AMI_ID` AMI) are counted as media-nommer instances. This
+is handy if other things run the same AMI. If ``False``, every instance of
+the AMI is counted. Leave this off until every running instance has been
+tagged, since untagged instances from older versions of media-nommer
+wouldn't be counted."""
 
 ###############################
 # Intelligent scaling settings
@@ -86,11 +152,21 @@ MAX_ENCODING_JOBS_PER_EC2_INSTANCE = 2
 """Default: ``2``
 
 The maximum number of jobs that should ever run on a single EC2_ instance at
-the same time."""
+the same time, for instance types without ``slots`` in
+:py:data:`EC2_INSTANCE_TYPES`. Scaling policies also count capacity in
+instances with this many slots."""
 MAX_NUM_EC2_INSTANCES = 3
 """Default: ``3``
 
 The maximum number of EC2 instances to run at a time."""
+MIN_NUM_EC2_INSTANCES = 0
+"""Default: ``0``
+
+The number of EC2_ instances to keep running (and warm) at all times, even
+with no jobs to encode. Saves new jobs from waiting on instances to boot,
+at the cost of paying for the idle ones. Only enforced on the way down if
+:py:data:`FEEDERD_MANAGE_SCALE_IN` is ``True``, since instances otherwise
+terminate themselves."""
 JOB_OVERFLOW_THRESH = 2
 """Default: ``2``
 
@@ -99,6 +175,43 @@ If the number of unfinished jobs exceeds our capacity
 ``<Number of Active EC2 instances>``) by this number of jobs, look at starting
 new instances if we have not already exceeded
 :py:data:`MAX_NUM_EC2_INSTANCES`."""
+FEEDERD_SCALING_POLICY = 'media_nommer.feederd.scaling_policy.ThresholdScalingPolicy'
+"""Default: ``'media_nommer.feederd.scaling_policy.ThresholdScalingPolicy'``
+
+The FQPN of the scaling policy class that decides how many EC2_ instances
+to run. The default goes by :py:data:`JOB_OVERFLOW_THRESH`. Set this to
+``'media_nommer.feederd.scaling_policy.PredictiveScalingPolicy'`` to scale
+by job arrival rates and durations instead, as per the
+``FEEDERD_SCALING_*`` settings below."""
+FEEDERD_SCALING_TARGET_QUEUE_WAIT = 60 * 5
+"""Default: ``60 * 5``
+
+The predictive scaling policy spawns enough instances that new jobs
+shouldn't have to wait longer than this (in seconds) to start."""
+FEEDERD_SCALING_INSTANCE_BOOT_TIME = 60 * 3
+"""Default: ``60 * 3``
+
+Roughly how long (in seconds) it takes a newly spawned instance to start
+working on jobs."""
+FEEDERD_SCALING_ARRIVAL_WINDOW = 60 * 10
+"""Default: ``60 * 10``
+
+How far back (in seconds) the predictive scaling policy looks when
+figuring the job arrival rate."""
+FEEDERD_SCALING_BURST_WINDOW = 60
+"""Default: ``60``
+
+A shorter window (in seconds) used to spot bursts of job arrivals. The
+higher of the two rates is scaled for."""
+FEEDERD_SCALING_DURATION_HISTORY_SIZE = 50
+"""Default: ``50``
+
+How many recent job durations to average, per nommer."""
+FEEDERD_SCALING_DEFAULT_JOB_DURATION = 60 * 10
+"""Default: ``60 * 10``
+
+The assumed job duration (in seconds) for nommers that haven't had any
+jobs finish yet."""
 
 ###################
 # feederd settings
@@ -108,6 +221,122 @@ FEEDERD_JOB_STATE_CHANGE_CHECK_INTERVAL = 60
 """Default: ``60``
 
 How often :doc:`../feederd` will check for job state changes."""
+FEEDERD_JOB_STATE_CHANGE_DRAIN = True
+"""Default: ``True``
+
+When ``True``, :doc:`../feederd` keeps popping batches of job state changes
+from the queue on every check until SQS_ reports the queue empty (or
+:py:data:`FEEDERD_JOB_STATE_CHANGE_MAX_PER_TICK` is reached). When ``False``,
+only a single batch of up to 10 state changes is popped per check."""
+FEEDERD_JOB_STATE_CHANGE_RECEIVERS = 4
+"""Default: ``4``
+
+When draining the job state change queue, this many receivers pop batches
+from SQS_ concurrently."""
+FEEDERD_JOB_STATE_CHANGE_MAX_PER_TICK = 1000
+"""Default: ``1000``
+
+The maximum number of job state change messages to pop during a single
+check when :py:data:`FEEDERD_JOB_STATE_CHANGE_DRAIN` is ``True``. Anything
+left over is picked up on the next check."""
+FEEDERD_UNFINISHED_JOB_SCAN_SEGMENTS = 4
+"""Default: ``4``
+
+When :doc:`../feederd` scans the job state backend for un-finished jobs (at
+startup, for example), the scan is split up into this many creation time
+ranges that are paged through concurrently."""
+FEEDERD_SUBMISSION_THREADS = 10
+"""Default: ``10``
+
+The number of threads :doc:`../feederd` uses to save newly submitted jobs
+to the job state backend. These are separate from the threads that run
+the interval tasks, so a slow backend doesn't hold up the JSON API or the
+other way around."""
+FEEDERD_MAX_JOBS_PER_BATCH_SUBMIT = 100
+"""Default: ``100``
+
+The most jobs that may be submitted in a single ``/job/submit_batch/`` API
+call."""
+FEEDERD_STATUS_LOOKUP_THREADS = 5
+"""Default: ``5``
+
+The number of threads :doc:`../feederd` uses to load jobs from the job state
+backend when a ``/job/status`` API call asks for a job that isn't cached."""
+FEEDERD_FINISHED_JOB_CACHE_SIZE = 1000
+"""Default: ``1000``
+
+How many recently finished jobs :doc:`../feederd` keeps in memory to answer
+``/job/status`` API calls with. Older finished jobs are loaded from the job
+state backend."""
+FEEDERD_JOB_STATE_STREAM_BACKLOG = 10000
+"""Default: ``10000``
+
+How many of the most recent job state changes :doc:`../feederd` keeps in
+memory for ``/job/events`` watchers to resume from."""
+FEEDERD_JOB_STATE_LONG_POLL_TIMEOUT = 30
+"""Default: ``30``
+
+How long (in seconds) a ``/job/events`` long-poll is held open waiting for
+job state changes before returning empty-handed."""
+FEEDERD_JOB_STATE_STREAM_KEEPALIVE_INTERVAL = 15
+"""Default: ``15``
+
+How often (in seconds) to send a keepalive to ``/job/events`` event stream
+watchers, so idle connections aren't closed by proxies."""
+FEEDERD_NOTIFY_MAX_CONNECTIONS_PER_HOST = 4
+"""Default: ``4``
+
+The most job state change notifications :doc:`../feederd` will have
+in-flight to any one ``notify_url`` host at a time. This many connections
+per host are also kept open between notifications for re-use."""
+FEEDERD_NOTIFICATION_OUTBOX_DB_PATH = '~/.media_nommer_outbox.sqlite3'
+"""Default: ``'~/.media_nommer_outbox.sqlite3'``
+
+The SQLite database that :doc:`../feederd` keeps undelivered job state change
+notifications in, so they survive restarts."""
+FEEDERD_NOTIFY_MAX_IN_FLIGHT = 200
+"""Default: ``200``
+
+The most job state change notifications :doc:`../feederd` will have
+in-flight at once, across all hosts."""
+FEEDERD_NOTIFY_MAX_ATTEMPTS = 20
+"""Default: ``20``
+
+How many times delivery of a job state change notification is attempted
+before giving up on it."""
+FEEDERD_NOTIFY_RETRY_BASE_DELAY = 5
+"""Default: ``5``
+
+How long (in seconds) to wait before retrying a failed job state change
+notification the first time. The wait doubles with each failed attempt, up
+to :py:data:`FEEDERD_NOTIFY_RETRY_MAX_DELAY`."""
+FEEDERD_NOTIFY_RETRY_MAX_DELAY = 600
+"""Default: ``600``
+
+The longest (in seconds) to wait between attempts at delivering a job state
+change notification."""
+FEEDERD_NOTIFY_RETRY_CHECK_INTERVAL = 1
+"""Default: ``1``
+
+How often (in seconds) :doc:`../feederd` checks its notification outbox for
+retries that have come due."""
+FEEDERD_NOTIFY_BATCH_URLS = []
+"""Default: ``[]``
+
+Job state change notifications to any ``notify_url`` starting with one of
+these prefixes are coalesced into batches. Rather than a form-encoded POST
+per change, the receiver gets a JSON array of changes in one POST, with
+only the latest change for each job. The receiver must be able to handle
+this, so this is opt-in."""
+FEEDERD_NOTIFY_BATCH_WINDOW = 1.0
+"""Default: ``1.0``
+
+How long (in seconds) to hold notifications for URLs in
+:py:data:`FEEDERD_NOTIFY_BATCH_URLS` so others can join the batch."""
+FEEDERD_NOTIFY_BATCH_MAX_SIZE = 100
+"""Default: ``100``
+
+The most notifications to collapse into a single batch."""
 FEEDERD_PRUNE_JOBS_INTERVAL = 60 * 5
 """Default: ``60 * 5``
 
@@ -126,6 +355,32 @@ FEEDERD_AUTO_SCALE_INTERVAL = 60
 
 How often :doc:`../feederd` should see if it needs to spawn additional
 EC2_ instances."""
+FEEDERD_RECONCILE_JOB_COUNTS_INTERVAL = 60 * 10
+"""Default: ``60 * 10``
+
+How often (in seconds) :doc:`../feederd` checks its running count of
+unfinished jobs (which drives EC2_ instance scaling) against the job state
+backend's."""
+FEEDERD_EC2_INSTANCE_CACHE_TTL = 30
+"""Default: ``30``
+
+How long (in seconds) :doc:`../feederd` caches its list of active EC2_
+instances before looking them up again."""
+FEEDERD_MANAGE_SCALE_IN = True
+"""Default: ``True``
+
+When ``True``, :doc:`../feederd` decides which idle EC2_ instances to
+terminate (based on the heartbeats in
+:py:data:`SIMPLEDB_EC2_NOMMER_STATE_DOMAIN`), draining them of work first.
+Instances only terminate themselves as a fallback, after
+:py:data:`NOMMERD_FALLBACK_MAX_INACTIVITY`. When ``False``, each instance
+terminates itself after :py:data:`NOMMERD_MAX_INACTIVITY`."""
+FEEDERD_SCALE_IN_BILLING_WINDOW = 60 * 10
+"""Default: ``60 * 10``
+
+Since instances are billed by the hour, idle instances are only terminated
+when they are within this many seconds of starting another billing hour.
+Until then, they may as well stick around in case more jobs come in."""
 
 ###################
 # nommerd settings
@@ -143,7 +398,18 @@ NOMMERD_MAX_INACTIVITY = 60 * 10
 """Default: ``60 * 50``
 
 How many seconds of inactivity (not working on any jobs) before an
-instance will terminate itself."""
+instance will terminate itself. If :py:data:`FEEDERD_MANAGE_SCALE_IN` is
+``True``, this is how long an instance has to be idle before
+:doc:`../feederd` considers terminating it."""
+NOMMERD_FALLBACK_MAX_INACTIVITY = 3600 * 2
+"""Default: ``3600 * 2``
+
+If :py:data:`FEEDERD_MANAGE_SCALE_IN` is ``True``, instances still
+terminate themselves after this many seconds of inactivity, in case
+:doc:`../feederd` isn't around to do it. They only do so if feederd hasn't
+renewed their lease (which it does on every scale-in pass) for this long
+either, so idle instances kept for :py:data:`MIN_NUM_EC2_INSTANCES` stay up
+while feederd is running."""
 NOMMERD_HEARTBEAT_INTERVAL = 60
 """Default: ``60``
 
@@ -156,8 +422,91 @@ is ``True``.
 NOMMERD_NEW_JOB_CHECK_INTERVAL = 60
 """Default: ``60``
 
-An interval (in seconds) to wait between calls to AWS_ to check for new
-jobs."""
+Nodes pull new jobs as soon as they have free slots, and long poll while
+the queue is empty. This is how often (in seconds) they make sure that's
+still happening."""
+NOMMERD_NEW_JOB_WAIT_TIME = 20
+"""Default: ``20``
+
+How long (in seconds) a node waits for a job to arrive when the new job
+queue is empty, before giving up on that pull (SQS_ long polling). SQS_
+allows up to 20."""
+NOMMERD_NEW_JOB_BACKOFF_MIN = 2
+"""Default: ``2``
+
+How long (in seconds) a node waits before pulling again after a pull
+comes up empty. This doubles with each empty pull in a row, up to
+:py:data:`NOMMERD_NEW_JOB_BACKOFF_MAX`."""
+NOMMERD_NEW_JOB_BACKOFF_MAX = 40
+"""Default: ``40``
+
+The longest (in seconds) a node waits between empty pulls. Along with
+:py:data:`NOMMERD_NEW_JOB_WAIT_TIME`, this makes for about one call to
+SQS_ a minute on an idle node."""
+NOMMERD_CONTROL_THREADS = 3
+"""Default: ``3``
+
+The number of threads each node uses for heartbeats and popping jobs from
+the queue. These are kept apart from the threads that run encoding jobs
+(one per slot), so heartbeats go out on time however busy the node is. A
+pull may hold a thread for up to :py:data:`NOMMERD_NEW_JOB_WAIT_TIME`
+seconds, so keep this at 2 or more."""
+NOMMERD_ADMISSION_CONTROL = True
+"""Default: ``True``
+
+If ``True``, nodes only fill their free slots as far as their CPU load,
+memory and temp disk space allow, going by an estimate of each job's needs.
+Jobs that won't fit are put back on the queue for another node. If
+``False``, every free slot is filled."""
+NOMMERD_MAX_LOAD_PER_CORE = 1.5
+"""Default: ``1.5``
+
+Nodes don't pull new jobs while their one minute load average per CPU core
+is higher than this."""
+NOMMERD_JOB_MEMORY_ESTIMATE = 512 * 1024 * 1024
+"""Default: ``512 * 1024 * 1024``
+
+How much memory (in bytes) a job with 720p output is expected to need.
+Nommers may scale this by the job's options."""
+NOMMERD_JOB_DISK_FACTOR = 2.5
+"""Default: ``2.5``
+
+A job is expected to need this many times its source file's size in temp
+disk space, for the downloaded source, the output and anything else the
+encoder writes along the way."""
+NOMMERD_JOB_DISK_ESTIMATE = 1024 * 1024 * 1024
+"""Default: ``1024 * 1024 * 1024``
+
+How much temp disk space (in bytes) a job is expected to need when its
+source file's size can't be determined, or it hasn't been looked at yet."""
+NOMMERD_MIN_FREE_DISK = 512 * 1024 * 1024
+"""Default: ``512 * 1024 * 1024``
+
+Nodes don't take on jobs that would leave less than this much (in bytes)
+free in the temp directory."""
+NOMMERD_REQUEUE_DELAY = 60
+"""Default: ``60``
+
+Jobs that a node doesn't have the resources for are put back on the queue,
+hidden for this many seconds, to give other nodes a shot at them."""
+NOMMERD_CORES_PER_JOB = None
+"""Default: ``None``
+
+If set, nodes run at least one job per this many CPU cores, even if their
+type has fewer slots. Lets large nodes fill up, with
+:py:data:`NOMMERD_ADMISSION_CONTROL` keeping them from overdoing it."""
+NOMMERD_PIN_CPUS = True
+"""Default: ``True``
+
+If ``True``, each encoding job's ffmpeg is pinned to its share of the
+node's CPU cores (the number of cores over the number of slots) with
+:py:data:`NOMMERD_TASKSET_BIN_PATH`. Either way, jobs that leave ffmpeg's
+``threads`` option at ``0`` get a thread per core in their share."""
+NOMMERD_TASKSET_BIN_PATH = 'taskset'
+"""Default: ``'taskset'``
+
+The taskset command used to pin encoders to CPU cores. Pinning is skipped
+if it can't be found."""
 NOMMERD_QTFASTSTART_BIN_PATH = '/home/nom/.virtualenvs/media_nommer/bin/qtfaststart'
 """
 The path to the qtfaststart bin used by ec2nommerd.
@@ -167,6 +516,22 @@ The path to the qtfaststart bin used by ec2nommerd.
 #General settings
 ##################
 
+JOB_STATE_BACKEND = 'media_nommer.core.job_state_backends.aws.AWSJobStateBackend'
+"""Default: ``'media_nommer.core.job_state_backends.aws.AWSJobStateBackend'``
+
+The job state backend class used to store jobs and pass messages between
+:doc:`../feederd` and :doc:`../ec2nommerd`. The default uses SimpleDB_ and
+SQS_. Set this to
+``'media_nommer.core.job_state_backends.sqlite.SQLiteJobStateBackend'`` to
+run everything on one machine without AWS_ (see
+:py:data:`SQLITE_JOB_STATE_DB_PATH`)."""
+SQLITE_JOB_STATE_DB_PATH = '~/.media_nommer.sqlite3'
+"""Default: ``'~/.media_nommer.sqlite3'``
+
+The path to the SQLite database used by the SQLite job state backend. Only
+used if :py:data:`JOB_STATE_BACKEND` is set to the SQLite backend.
+:doc:`../feederd` and :doc:`../ec2nommerd` must point to the same file."""
+
 STORAGE_BACKENDS = {
     's3': 'media_nommer.core.storage_backends.s3.S3Backend',
     'http': 'media_nommer.core.storage_backends.http.HTTPBackend',
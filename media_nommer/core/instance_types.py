@@ -0,0 +1,135 @@
+"""
+Describes the EC2_ instance types media-nommer may run on, as configured in
+the :py:data:`EC2_INSTANCE_TYPES <media_nommer.conf.settings.EC2_INSTANCE_TYPES>`
+setting. :doc:`../ec2nommerd` goes by this to decide how many jobs to run at
+once, and :doc:`../feederd` to account for capacity and pick which types to
+spawn.
+
+Capacity is measured in *baseline slots*: a slot with a ``throughput`` of
+``1.0``. A type with 4 slots and a throughput of ``1.5`` has a capacity of 6
+baseline slots.
+"""
+import math
+from media_nommer.conf import settings
+
+# Used for types that aren't in EC2_INSTANCE_TYPES (instances left over from
+# an old configuration, for example).
+DEFAULT_THROUGHPUT = 1.0
+DEFAULT_COST = 1.0
+# Instances are billed for each hour they're up, or part thereof.
+BILLING_PERIOD = 3600
+
+def get_instance_types():
+    """
+    :rtype: dict
+    :returns: A dict with instance type names as keys, and dicts with
+        ``slots``, ``throughput`` and ``cost`` keys as values. If
+        :py:data:`EC2_INSTANCE_TYPES <media_nommer.conf.settings.EC2_INSTANCE_TYPES>`
+        is empty, this only has
+        :py:data:`EC2_INSTANCE_TYPE <media_nommer.conf.settings.EC2_INSTANCE_TYPE>`.
+    """
+    configured = settings.EC2_INSTANCE_TYPES or {
+        settings.EC2_INSTANCE_TYPE: {},
+    }
+    instance_types = {}
+    for name, info in configured.items():
+        instance_types[name] = {
+            'slots': int(info.get('slots',
+                            settings.MAX_ENCODING_JOBS_PER_EC2_INSTANCE)),
+            'throughput': float(info.get('throughput', DEFAULT_THROUGHPUT)),
+            'cost': float(info.get('cost', DEFAULT_COST)),
+        }
+    return instance_types
+
+def get_instance_type_info(instance_type):
+    """
+    :param str instance_type: An EC2_ instance type name.
+    :rtype: dict
+    :returns: The type's ``slots``, ``throughput`` and ``cost``, as per
+        :py:func:`get_instance_types`. Types that aren't configured get
+        :py:data:`MAX_ENCODING_JOBS_PER_EC2_INSTANCE <media_nommer.conf.settings.MAX_ENCODING_JOBS_PER_EC2_INSTANCE>`
+        slots, and the default throughput and cost.
+    """
+    info = get_instance_types().get(instance_type)
+    if info is None:
+        info = {
+            'slots': settings.MAX_ENCODING_JOBS_PER_EC2_INSTANCE,
+            'throughput': DEFAULT_THROUGHPUT,
+            'cost': DEFAULT_COST,
+        }
+    return info
+
+def get_slots(instance_type):
+    """
+    :param str instance_type: An EC2_ instance type name.
+    :rtype: int
+    :returns: How many jobs an instance of this type runs at once.
+    """
+    return get_instance_type_info(instance_type)['slots']
+
+def get_capacity(instance_type):
+    """
+    :param str instance_type: An EC2_ instance type name.
+    :rtype: float
+    :returns: An instance's capacity, in baseline slots.
+    """
+    info = get_instance_type_info(instance_type)
+    return info['slots'] * info['throughput']
+
+def _get_cost_per_job(info, batch):
+    """
+    :param dict info: An instance type's info.
+    :param list batch: The baseline durations (in seconds) of the jobs an
+        instance of this type would run, one per slot.
+    :rtype: float
+    :returns: What each job costs, if an instance of this type were spawned
+        just to run them. Partial hours are billed as whole ones, which is
+        what makes small, cheap instances a better deal for short jobs.
+    """
+    run_time = max(batch) / info['throughput']
+    billed_hours = max(1, int(math.ceil(run_time / BILLING_PERIOD)))
+    return info['cost'] * billed_hours / float(len(batch))
+
+def choose_instance_types(capacity, max_num_instances, job_durations,
+                          default_duration):
+    """
+    Picks the cheapest mix of instance types for clearing a backlog.
+
+    Instances are picked one at a time. Each takes a job per slot from the
+    backlog, longest jobs first, and goes to whichever type would run its
+    jobs for the least money per job. Long jobs end up on fast instances,
+    and short ones on cheap instances with plenty of slots. Once the backlog
+    runs out, the rest of the capacity is planned for jobs of
+    ``default_duration``.
+
+    :param float capacity: How much capacity (in baseline slots) is needed.
+    :param int max_num_instances: Pick no more instances than this.
+    :param list job_durations: The baseline durations (in seconds) of the
+        jobs waiting to run.
+    :param float default_duration: The baseline duration (in seconds) to
+        assume for jobs that haven't arrived yet.
+    :rtype: list
+    :returns: A list of instance type names, one per instance to spawn.
+    """
+    instance_types = get_instance_types()
+    # Sorted by name, so ties always go the same way.
+    type_names = sorted(instance_types.keys())
+    backlog = sorted(job_durations, reverse=True)
+    chosen = []
+    while capacity > 0 and len(chosen) < max_num_instances:
+        best_name = None
+        best_key = None
+        for name in type_names:
+            info = instance_types[name]
+            batch = backlog[:info['slots']]
+            batch += [default_duration] * (info['slots'] - len(batch))
+            # Cheapest per job first, then most capacity.
+            key = (_get_cost_per_job(info, batch),
+                   -info['slots'] * info['throughput'])
+            if best_key is None or key < best_key:
+                best_name, best_key = name, key
+        chosen.append(best_name)
+        best_info = instance_types[best_name]
+        del backlog[:best_info['slots']]
+        capacity -= best_info['slots'] * best_info['throughput']
+    return chosen
@@ -10,23 +10,41 @@ There are two pieces to the job state backend:
   individual jobs and their state.
 * The :py:class:`JobStateBackend` class is used to operate as the topmost
   manager. It can track all of the currently running jobs, get new jobs
-  from the SQS queue, and process state change notifications from SQS.
+  from the new job queue, and process state change notifications.
+
+:py:class:`JobStateBackend` itself doesn't know where jobs and queues are
+stored. That is left up to its sub-classes in
+:py:mod:`media_nommer.core.job_state_backends`, one of which is selected via
+the :py:data:`JOB_STATE_BACKEND <media_nommer.conf.settings.JOB_STATE_BACKEND>`
+setting. Use :py:func:`get_job_state_backend` to get a reference to it.
 """
 import random
 import hashlib
 import datetime
 import json
-import boto
-from boto.sqs.message import Message
+import Queue
+import threading
 from media_nommer.conf import settings
 from media_nommer.utils import logger
 from media_nommer.utils.mod_importing import import_class_from_module_string
+from media_nommer.core.job_state_backends.exceptions import JobVersionConflict
+
+def get_job_state_backend():
+    """
+    Returns the job state backend class selected by the
+    :py:data:`JOB_STATE_BACKEND <media_nommer.conf.settings.JOB_STATE_BACKEND>`
+    setting.
+
+    :rtype: :py:class:`JobStateBackend`
+    :returns: A reference to the configured job state backend class.
+    """
+    return import_class_from_module_string(settings.JOB_STATE_BACKEND)
 
 class EncodingJob(object):
     """
     Represents a single encoding job. This class handles the serialization
     and de-serialization involved when saving and loading encoding jobs
-    to and from SimpleDB_.
+    to and from the job state backend.
     
     .. tip:: You generally won't be instantiating these objects yourself.
         To retrieve an existing job, you may
@@ -35,7 +53,7 @@ class EncodingJob(object):
     def __init__(self, source_path, dest_path, nommer, job_options,
                  unique_id=None, job_state='PENDING', job_state_details=None,
                  notify_url=None, creation_dtime=None,
-                 last_modified_dtime=None):
+                 last_modified_dtime=None, version=None):
         """
         :param str source_path: The URI to the source media to encode.
         :param str dest_path: The URI to upload the encoded media to.
@@ -54,6 +72,10 @@ class EncodingJob(object):
             was created.
         :keyword datetime.datetime last_modified_dtime: The time when this job
             was last modified.
+        :keyword int version: The version of the job that was last saved. This
+            is incremented on each save, and is used to detect conflicting
+            updates. ``None`` for new jobs (and jobs saved before versions
+            were tracked).
         """
         self.source_path = source_path
         self.dest_path = dest_path
@@ -85,13 +107,38 @@ class EncodingJob(object):
         self.creation_dtime = self._get_dtime_from_string(self.creation_dtime)
         self.last_modified_dtime = self._get_dtime_from_string(self.last_modified_dtime)
 
+        # SimpleDB stores this as a string, too.
+        self.version = int(version) if version else 0
+
+        # The attributes as they were last loaded or saved. Used to figure
+        # out which attributes need to be written during save().
+        if self.unique_id:
+            self._saved_attributes = self._get_item_attributes()
+        else:
+            self._saved_attributes = {}
+
     def __repr__(self):
         """
         String representation of the object. Just show the unique ID.
         """
         return u'EncodingJob: %s' % self.unique_id
 
-    def _get_dtime_from_string(self, dtime):
+    def get_freshness_key(self):
+        """
+        Used to tell which of two copies of the same job (from the store, or
+        queue message snapshots) is the most recent.
+
+        :rtype: tuple
+        :returns: A key that sorts newer copies of the job higher. The
+            :py:attr:`version` is bumped by every save, so it's compared
+            first. ``last_modified_dtime`` comes from whichever host did the
+            save, and its clock, so it only breaks ties between copies from
+            before versions were tracked.
+        """
+        return (self.version, self.last_modified_dtime)
+
+    @classmethod
+    def _get_dtime_from_string(cls, dtime):
         """
         If ``dtime`` is a string, try to parse and instantiate a date from it.
         If it's something else, just return the value without messing with it.
@@ -101,10 +148,54 @@ class EncodingJob(object):
             :py:class:`datetime.datetime` object.
         """
         if isinstance(dtime, basestring):
+            if '.' not in dtime:
+                # repr() leaves off the microseconds when they're zero.
+                return datetime.datetime.strptime(dtime, '%Y-%m-%d %H:%M:%S')
             return datetime.datetime.strptime(dtime, '%Y-%m-%d %H:%M:%S.%f')
         # Not a string, just return it.
         return dtime
 
+    @classmethod
+    def _get_string_from_dtime(cls, dtime):
+        """
+        The inverse of :py:meth:`_get_dtime_from_string`. Serializes a
+        :py:class:`datetime.datetime` object to a string that
+        :py:meth:`_get_dtime_from_string` can parse.
+
+        :param datetime.datetime dtime: The datetime to serialize.
+        :rtype: str
+        :returns: The datetime in ``repr(datetime.datetime)`` format.
+        """
+        return dtime.strftime('%Y-%m-%d %H:%M:%S.%f')
+
+    def _get_message_body(self):
+        """
+        Serializes a snapshot of the job to a compact JSON string for use as
+        an SQS_ message body. This lets whoever pops the message rebuild the
+        job without a trip to SimpleDB_. The keys are kept short to keep
+        messages small, and the format is versioned via
+        :py:attr:`JobStateBackend.MESSAGE_FORMAT_VERSION`.
+
+        :rtype: str
+        :returns: A JSON-serialized snapshot of the job.
+        """
+        snapshot = {
+            'v': JobStateBackend.MESSAGE_FORMAT_VERSION,
+            'id': self.unique_id,
+            'st': self.job_state,
+            'sd': self.job_state_details,
+            'lm': self._get_string_from_dtime(self.last_modified_dtime),
+            'cr': self._get_string_from_dtime(self.creation_dtime),
+            'jo': self.job_options,
+            'sp': self.source_path,
+            'dp': self.dest_path,
+            'nm': '%s.%s' % (self.nommer.__class__.__module__,
+                             self.nommer.__class__.__name__),
+            'nu': self.notify_url,
+            'vr': self.version,
+        }
+        return json.dumps(snapshot, separators=(',', ':'))
+
     def _generate_unique_job_id(self):
         """
         Since SimpleDB has no notion of primary keys or auto-incrementing
@@ -121,36 +212,99 @@ class EncodingJob(object):
                                   random_salt)
         return hashlib.sha512(combo_str).hexdigest()[:50]
 
+    def _get_item_attributes(self):
+        """
+        Serializes the job to a dict of attributes, suitable for storing
+        in the job state backend.
+
+        :rtype: dict
+        :returns: The job's attributes, keyed by name.
+        """
+        return {
+            'unique_id': self.unique_id,
+            'source_path': self.source_path,
+            'dest_path': self.dest_path,
+            'nommer': '%s.%s' % (self.nommer.__class__.__module__,
+                                 self.nommer.__class__.__name__),
+            'job_options': json.dumps(self.job_options),
+            'job_state': self.job_state,
+            'job_state_details': self.job_state_details,
+            'notify_url': self.notify_url,
+            'last_modified_dtime': self._get_string_from_dtime(
+                                                    self.last_modified_dtime),
+            'creation_dtime': self._get_string_from_dtime(self.creation_dtime),
+            'version': self.version,
+        }
+
     def save(self):
         """
-        Serializes and saves the job to SimpleDB_. In the case of a newly
-        instantiated job, also handles queueing the job up into the new job
-        queue.
+        Serializes and saves the job to the job state backend. In the case of
+        a newly instantiated job, also handles queueing the job up into the
+        new job queue.
+
+        Only the attributes that have changed since the job was loaded (or
+        last saved) are written. The write is conditional on the stored
+        version matching :py:attr:`version`, so that concurrent updates
+        (for example, :doc:`../feederd` abandoning a job that a nommer is
+        still working on) aren't silently lost.
         
+        :raises: :py:exc:`JobVersionConflict <media_nommer.core.job_state_backends.exceptions.JobVersionConflict>`
+            if the job was saved by someone else since it was loaded.
         :rtype: str
         :returns: The unique ID of the job.
         """
+        backend = get_job_state_backend()
         # Is this a new job that needs creation?
         is_new_job = not self.unique_id
         # Generate this once so our microseconds stay the same from
         # creation time to updated time.
         now_dtime = datetime.datetime.now()
 
+        expected_version = self.version
+        old_last_modified_dtime = self.last_modified_dtime
+        item, changed = self._prepare_for_save(now_dtime)
+
+        logger.debug("EncodingJob.save(): Item pre-save values: %s" % changed)
+
+        try:
+            backend._put_job_item(self.unique_id, changed,
+                                  expected_version=expected_version)
+        except:
+            # Whatever went wrong, nothing was saved. Put things back the way
+            # they were, so the job can be saved again. New jobs get a new
+            # ID next time, so they're still enqueued once saved.
+            self.version = expected_version
+            self.last_modified_dtime = old_last_modified_dtime
+            if is_new_job:
+                self.unique_id = None
+            raise
+        self._saved_attributes = item
+
         if is_new_job:
+            logger.debug("EncodingJob.save(): Enqueueing new job: %s" % self.unique_id)
+            backend._send_message(settings.SQS_NEW_JOB_QUEUE_NAME,
+                                  self._get_message_body())
+
+        return self.unique_id
+
+    def _prepare_for_save(self, now_dtime):
+        """
+        Brings the job's attributes up to date for saving: new jobs are
+        given an ID, creation time, and ``PENDING`` state, the modification
+        time is set, and the version is bumped. Nothing is written to the
+        backend.
+
+        :param datetime.datetime now_dtime: The time of the save.
+        :rtype: tuple
+        :returns: A tuple of all of the job's attributes, and the attributes
+            that have changed since the last save (both dicts).
+        """
+        if not self.unique_id:
             # This serves as the "FK" equivalent.
             self.unique_id = self._generate_unique_job_id()
-            # Create the item in the domain.
-            job = JobStateBackend._get_sdb_job_state_domain().new_item(self.unique_id)
             # Start populating values.
             self.creation_dtime = now_dtime
             self.job_state = 'PENDING'
-        else:
-            # Retrieve the existing item for the job.
-            job = JobStateBackend._get_sdb_job_state_domain().get_item(self.unique_id)
-            if job is None:
-                msg = 'EncodingJob.save(): ' \
-                      'No match found in DB for ID: %s' % self.unique_id
-                raise Exception(msg)
 
         if self.job_state_details and isinstance(self.job_state_details,
                                                  basestring):
@@ -159,45 +313,33 @@ class EncodingJob(object):
             # a great assumption, but it'll have to do.
             self.job_state_details = self.job_state_details[-1023:]
 
-        job['unique_id'] = self.unique_id
-        job['source_path'] = self.source_path
-        job['dest_path'] = self.dest_path
-        job['nommer'] = '%s.%s' % (self.nommer.__class__.__module__,
-                                   self.nommer.__class__.__name__)
-        job['job_options'] = json.dumps(self.job_options)
-        job['job_state'] = self.job_state
-        job['job_state_details'] = self.job_state_details
-        job['notify_url'] = self.notify_url
-        job['last_modified_dtime'] = now_dtime
-        job['creation_dtime'] = self.creation_dtime
-
-        logger.debug("EncodingJob.save(): Item pre-save values: %s" % job)
-
-        job.save()
-
-        if is_new_job:
-            logger.debug("EncodingJob.save(): Enqueueing new job: %s" % self.unique_id)
-            sqs_message = Message(body=job['unique_id'])
-            JobStateBackend._get_sqs_new_job_queue().write(sqs_message)
-
-        return job['unique_id']
+        # Keep the local copy in sync with what is being written, since it
+        # ends up in the queue message snapshots.
+        self.last_modified_dtime = now_dtime
+        self.version += 1
+        item = self._get_item_attributes()
+        # Only write what has changed. last_modified_dtime and version
+        # always make the cut.
+        changed = dict((key, val) for key, val in item.items()
+                       if self._saved_attributes.get(key) != val)
+        return item, changed
 
     def _send_state_change_notification(self):
         """
-        Send a message to a state change SQS that lets feederd know to
-        re-load the job from memory.
+        Send a message to a state change SQS that lets feederd know that
+        the job has changed. The message carries a snapshot of the job, so
+        feederd doesn't need to re-load it from SimpleDB_.
         """
         logger.debug("EncodingJob._send_state_change_notification(): " \
                      "Sending job state change for %s" % self.unique_id)
-        sqs_message = Message()
-        sqs_message.set_body(self.unique_id)
-        JobStateBackend._get_sqs_state_change_queue().write(sqs_message)
+        get_job_state_backend()._send_message(
+            settings.SQS_JOB_STATE_CHANGE_QUEUE_NAME,
+            self._get_message_body())
 
     def set_job_state(self, job_state, details=None):
         """
         Sets the job's state and saves it to the backend. Sends a notification
-        to :doc:`../feederd` to re-load the job's data from SimpleDB_ via
-        SQS_.
+        to :doc:`../feederd` via the state change queue.
         
         :param str job_state: The state to set the job to.
         :keyword str job_state_details: Any details to go along with whatever
@@ -231,91 +373,244 @@ class EncodingJob(object):
 
 class JobStateBackend(object):
     """
-    Abstracts storing and retrieving job state information to and from
-    SimpleDB_. Jobs are represented through the :py:class:`EncodingJob` class,
-    which are instantiated and returned as needed.
+    Abstracts storing and retrieving job state information. Jobs are
+    represented through the :py:class:`EncodingJob` class, which are
+    instantiated and returned as needed.
+
+    This class serves as a protocol for job state backends. It contains
+    all of the logic that is common to every backend, and leaves the actual
+    storage of jobs and queue messages to the ``_``-prefixed methods below
+    that raise ``NotImplementedError``. Sub-classes override those.
+
+    Queue methods refer to queues by name, as per the
+    :py:data:`SQS_NEW_JOB_QUEUE_NAME <media_nommer.conf.settings.SQS_NEW_JOB_QUEUE_NAME>`
+    and
+    :py:data:`SQS_JOB_STATE_CHANGE_QUEUE_NAME <media_nommer.conf.settings.SQS_JOB_STATE_CHANGE_QUEUE_NAME>`
+    settings. Messages returned by :py:meth:`_receive_messages` must have
+    ``get_body()`` and ``delete()`` methods, like boto's SQS messages.
     """
     JOB_STATES = ['PENDING', 'DOWNLOADING', 'ENCODING', 'UPLOADING',
                   'FINISHED', 'ERROR', 'ABANDONED']
     """All possible job states as a list of strings."""
 
+    MESSAGE_FORMAT_VERSION = 1
+    """The version of the job snapshot format used in queue message bodies.
+    Messages with any other version (or no snapshot at all) cause the job
+    to be loaded from the backend's job storage instead."""
+
     FINISHED_STATES = ['FINISHED', 'ERROR', 'ABANDONED']
     """Any jobs in the following states are considered "finished" in that we
     won't do anything else with them. This is a list of strings."""
 
-    # The following AWS fields are for lazy-loading.
-    __aws_sdb_connection = None
-    __aws_sdb_job_state_domain = None
-    __aws_sqs_connection = None
-    __aws_sqs_new_job_queue = None
-    __aws_sqs_state_change_queue = None
+    UNFINISHED_JOBS_PAGE_SIZE = 250
+    """The number of jobs fetched per page by :py:meth:`iter_unfinished_jobs`."""
+
+    JOB_ITEM_BATCH_SIZE = 25
+    """The most jobs written per :py:meth:`_put_new_job_items` call. This
+    is SimpleDB_'s BatchPutAttributes limit."""
+
+    MESSAGE_BATCH_SIZE = 10
+    """The most messages sent per :py:meth:`_send_messages` call. This is
+    SQS_'s SendMessageBatch limit."""
 
     @classmethod
-    def _get_sdb_connection(cls):
+    def _get_job_item(cls, unique_id):
         """
-        Lazy - loading of the SimpleDB boto connection. Refer to this instead of
-        referencing cls.__aws_sdb_connection directly.
+        Retrieves a job's stored attributes.
 
-        :returns: A boto connection to Amazon's SimpleDB interface.
+        :param str unique_id: An :py:class:`EncodingJob`'s unique ID.
+        :rtype: dict or ``None``
+        :returns: The job's attributes (as per
+            :py:meth:`EncodingJob._get_item_attributes`), or ``None`` if
+            no such job exists.
         """
-        if not cls.__aws_sdb_connection:
-            cls.__aws_sdb_connection = boto.connect_sdb(
-                settings.AWS_ACCESS_KEY_ID,
-                settings.AWS_SECRET_ACCESS_KEY)
-        return cls.__aws_sdb_connection
+        msg = "Backend doesn't implement _get_job_item()"
+        raise NotImplementedError(msg)
 
     @classmethod
-    def _get_sdb_job_state_domain(cls):
+    def _put_job_item(cls, unique_id, attributes, expected_version):
         """
-        Lazy-loading of the SimpleDB boto domain. Refer to this instead of
-        referencing cls.__aws_sdb_job_state_domain directly.
+        Stores some or all of a job's attributes, creating the job if needed.
+        Attributes that aren't given are left as they are. The write only
+        goes through if the stored job's version is ``expected_version``.
 
-        :returns: A boto SimpleDB domain for this workflow.
+        :param str unique_id: An :py:class:`EncodingJob`'s unique ID.
+        :param dict attributes: The attributes to write, as per
+            :py:meth:`EncodingJob._get_item_attributes`.
+        :param int expected_version: The version the stored job must have.
+            ``0`` means that the job must either not exist yet, or have been
+            saved before versions were tracked.
+        :raises: :py:exc:`JobVersionConflict <media_nommer.core.job_state_backends.exceptions.JobVersionConflict>`
+            if the stored version doesn't match.
         """
-        if not cls.__aws_sdb_job_state_domain:
-            cls.__aws_sdb_job_state_domain = cls._get_sdb_connection().create_domain(
-                                        settings.SIMPLEDB_JOB_STATE_DOMAIN)
-        return cls.__aws_sdb_job_state_domain
+        msg = "Backend doesn't implement _put_job_item()"
+        raise NotImplementedError(msg)
 
     @classmethod
-    def _get_sqs_connection(cls):
+    def _put_new_job_items(cls, items):
         """
-        Lazy-loading of the SQS boto connection. Refer to this instead of
-        referencing cls.__aws_sqs_connection directly.
-        
-        :returns: A boto connection to Amazon's SimpleDB interface.
+        Stores a batch of new jobs. Backends that support batched writes
+        should override this, the default just calls :py:meth:`_put_job_item`
+        for each job.
+
+        :param list items: A list of ``(unique_id, attributes)`` tuples, no
+            longer than :py:attr:`JOB_ITEM_BATCH_SIZE`.
+        :rtype: dict
+        :returns: A dict of error messages, keyed by the unique IDs of the
+            jobs that couldn't be stored. Empty if all went well.
+        """
+        errors = {}
+        for unique_id, attributes in items:
+            try:
+                cls._put_job_item(unique_id, attributes, expected_version=0)
+            except Exception, exc:
+                errors[unique_id] = str(exc)
+        return errors
+
+    @classmethod
+    def _iter_unfinished_job_item_pages(cls, min_creation_dtime=None,
+                                        max_creation_dtime=None):
+        """
+        Retrieves the stored attributes of all jobs not in one of the
+        :py:attr:`FINISHED_STATES`, a page at a time. Pages hold up to
+        :py:attr:`UNFINISHED_JOBS_PAGE_SIZE` items, and should only be
+        fetched from the backend as the generator is advanced.
+
+        This may be called from more than one thread at once.
+
+        :keyword str min_creation_dtime: If specified, only jobs created at
+            or after this time (in ``repr(datetime.datetime)`` format).
+        :keyword str max_creation_dtime: If specified, only jobs created
+            before this time (in ``repr(datetime.datetime)`` format).
+        :rtype: generator
+        :returns: A generator of lists of job attribute dicts.
+        """
+        msg = "Backend doesn't implement _iter_unfinished_job_item_pages()"
+        raise NotImplementedError(msg)
+
+    @classmethod
+    def _get_oldest_unfinished_creation_dtime(cls):
+        """
+        Finds the creation time of the oldest job not in one of the
+        :py:attr:`FINISHED_STATES`.
+
+        :rtype: str or ``None``
+        :returns: The creation time in ``repr(datetime.datetime)`` format, or
+            ``None`` if there are no unfinished jobs.
+        """
+        msg = "Backend doesn't implement _get_oldest_unfinished_creation_dtime()"
+        raise NotImplementedError(msg)
+
+    @classmethod
+    def _count_unfinished_job_items(cls):
+        """
+        Counts the jobs not in one of the :py:attr:`FINISHED_STATES`, without
+        fetching them.
+
+        :rtype: int
+        :returns: The number of unfinished jobs.
+        """
+        msg = "Backend doesn't implement _count_unfinished_job_items()"
+        raise NotImplementedError(msg)
+
+    @classmethod
+    def _delete_job_items(cls, unique_ids):
+        """
+        Deletes some stored jobs. Jobs that aren't stored are skipped.
+
+        :param list unique_ids: The unique IDs of the jobs to delete, no
+            more than :py:attr:`JOB_ITEM_BATCH_SIZE` of them.
+        """
+        msg = "Backend doesn't implement _delete_job_items()"
+        raise NotImplementedError(msg)
+
+    @classmethod
+    def _delete_all_job_items(cls):
+        """
+        Deletes every stored job.
+        """
+        msg = "Backend doesn't implement _delete_all_job_items()"
+        raise NotImplementedError(msg)
+
+    @classmethod
+    def _send_message(cls, queue_name, body, delay_seconds=0):
+        """
+        Writes a message to a queue.
+
+        :param str queue_name: The name of the queue to write to.
+        :param str body: The message body.
+        :keyword int delay_seconds: Keep the message hidden from receivers
+            for this many seconds. SQS allows up to 900.
+        """
+        msg = "Backend doesn't implement _send_message()"
+        raise NotImplementedError(msg)
+
+    @classmethod
+    def _send_messages(cls, queue_name, bodies):
+        """
+        Writes a batch of messages to a queue. Backends that support batched
+        sends should override this, the default just calls
+        :py:meth:`_send_message` for each body.
+
+        :param str queue_name: The name of the queue to write to.
+        :param list bodies: The message bodies, no more than
+            :py:attr:`MESSAGE_BATCH_SIZE` of them.
+        :rtype: dict
+        :returns: A dict of error messages, keyed by the index in ``bodies``
+            of the messages that couldn't be sent. Empty if all went well.
         """
-        if not cls.__aws_sqs_connection:
-            cls.__aws_sqs_connection = boto.connect_sqs(
-                settings.AWS_ACCESS_KEY_ID,
-                settings.AWS_SECRET_ACCESS_KEY)
-        return cls.__aws_sqs_connection
+        errors = {}
+        for index, body in enumerate(bodies):
+            try:
+                cls._send_message(queue_name, body)
+            except Exception, exc:
+                errors[index] = str(exc)
+        return errors
 
     @classmethod
-    def _get_sqs_new_job_queue(cls):
+    def _receive_messages(cls, queue_name, num_to_receive, visibility_timeout,
+                          wait_time_seconds=0):
         """
-        Lazy - loading of the SQS boto queue. Refer to this instead of
-        referencing cls.__aws_sqs_new_job_queue directly.
+        Receives messages from a queue. Received messages are hidden from
+        other receivers until ``visibility_timeout`` passes, after which they
+        re-appear on the queue unless ``delete()`` was called on them.
 
-        :returns: A boto SQS queue.
+        :param str queue_name: The name of the queue to receive from.
+        :param int num_to_receive: The maximum number of messages to receive.
+        :param int visibility_timeout: The time (in seconds) that received
+            messages stay hidden.
+        :keyword int wait_time_seconds: If the queue is empty, wait up to
+            this many seconds for a message to arrive (long polling) before
+            returning an empty list.
+        :rtype: list
+        :returns: A list of messages with ``get_body()`` and ``delete()``
+            methods.
         """
-        if not cls.__aws_sqs_new_job_queue:
-            cls.__aws_sqs_new_job_queue = cls._get_sqs_connection().create_queue(
-                settings.SQS_NEW_JOB_QUEUE_NAME)
-        return cls.__aws_sqs_new_job_queue
+        msg = "Backend doesn't implement _receive_messages()"
+        raise NotImplementedError(msg)
 
     @classmethod
-    def _get_sqs_state_change_queue(cls):
+    def _get_queue_length(cls, queue_name):
         """
-        Lazy - loading of the SQS boto queue. Refer to this instead of
-        referencing cls.__aws_sqs_state_change_queue directly.
+        Returns the (possibly approximate) number of messages waiting in
+        a queue.
 
-        :returns: A boto SQS queue.
+        :param str queue_name: The name of the queue to check.
+        :rtype: int
+        :returns: The number of messages in the queue.
         """
-        if not cls.__aws_sqs_state_change_queue:
-            cls.__aws_sqs_state_change_queue = cls._get_sqs_connection().create_queue(
-                settings.SQS_JOB_STATE_CHANGE_QUEUE_NAME)
-        return cls.__aws_sqs_state_change_queue
+        msg = "Backend doesn't implement _get_queue_length()"
+        raise NotImplementedError(msg)
+
+    @classmethod
+    def _clear_queue(cls, queue_name):
+        """
+        Deletes every message in a queue.
+
+        :param str queue_name: The name of the queue to clear.
+        """
+        msg = "Backend doesn't implement _clear_queue()"
+        raise NotImplementedError(msg)
 
     @classmethod
     def _get_job_object_from_item(cls, item):
@@ -326,6 +621,62 @@ class JobStateBackend(object):
         job = EncodingJob(**item)
         return job
 
+    @classmethod
+    def _get_job_object_from_message_body(cls, body):
+        """
+        Given an SQS message body, rebuild the job from the snapshot it
+        carries (see :py:meth:`EncodingJob._get_message_body`).
+
+        :param str body: The SQS message body.
+        :rtype: :py:class:`EncodingJob` or ``None``
+        :returns: The rebuilt job, or ``None`` if the body doesn't contain a
+            snapshot we understand. Older versions of media-nommer only put
+            the job's unique ID in the body, for example.
+        """
+        try:
+            snapshot = json.loads(body)
+        except ValueError:
+            # Not JSON, this is probably just a unique ID.
+            return None
+
+        if not isinstance(snapshot, dict) or \
+           snapshot.get('v') != cls.MESSAGE_FORMAT_VERSION:
+            return None
+
+        try:
+            return EncodingJob(snapshot['sp'], snapshot['dp'],
+                               snapshot['nm'], snapshot['jo'],
+                               unique_id=snapshot['id'],
+                               job_state=snapshot['st'],
+                               job_state_details=snapshot['sd'],
+                               notify_url=snapshot['nu'],
+                               creation_dtime=snapshot['cr'],
+                               last_modified_dtime=snapshot['lm'],
+                               version=snapshot.get('vr'))
+        except (KeyError, ValueError):
+            logger.error("JobStateBackend._get_job_object_from_message_body(): " \
+                         "Malformed job snapshot: %s" % body)
+            return None
+
+    @classmethod
+    def _get_unique_id_from_message_body(cls, body):
+        """
+        Given an SQS message body, return the unique ID of the job it refers
+        to. The body is either a job snapshot, or a bare unique ID.
+
+        :param str body: The SQS message body.
+        :rtype: str
+        :returns: The job's unique ID.
+        """
+        try:
+            snapshot = json.loads(body)
+        except ValueError:
+            return body
+
+        if isinstance(snapshot, dict) and snapshot.has_key('id'):
+            return snapshot['id']
+        return body
+
     @classmethod
     def get_job_object_from_id(cls, unique_id):
         """
@@ -335,7 +686,7 @@ class JobStateBackend(object):
         
         :param str unique_id: An :py:class:`EncodingJob`'s unique ID.
         """
-        item = cls._get_sdb_job_state_domain().get_item(unique_id)
+        item = cls._get_job_item(unique_id)
         if item is None:
             msg = 'JobStateBackend.get_job_object_from_id(): ' \
                   'No unique ID match for: % s' % unique_id
@@ -346,85 +697,305 @@ class JobStateBackend(object):
     @classmethod
     def wipe_all_job_data(cls):
         """
-        Deletes the SimpleDB domain and empties the SQS queue. These are both
+        Deletes all stored jobs and empties the new job queue. These are both
         used to store and communicate job state data. 
-        
-        :rtype: bool
-        :returns: ``True`` if successful. ``False`` if not.
         """
-        try:
-            cls._get_sdb_connection().delete_domain(settings.SIMPLEDB_JOB_STATE_DOMAIN)
-            cls._get_sqs_new_job_queue().clear()
-        except boto.exception.SDBResponseError:
-            # Tried to delete a domain that doesn't exist. We probably haven't
-            # ran feederd before, or are doing testing.
-            pass
+        cls._delete_all_job_items()
+        cls._clear_queue(settings.SQS_NEW_JOB_QUEUE_NAME)
+
+    @classmethod
+    def save_new_jobs(cls, jobs):
+        """
+        Saves and enqueues a list of new jobs, the same as calling
+        :py:meth:`EncodingJob.save` on each of them, but with batched
+        writes to the backend.
 
-        # Reset our local cache of the boto SDB domain object.
-        cls.__aws_sdb_job_state_domain = None
-        # Reset our local cache of the boto SQS queue object.
-        cls.__aws_sqs_new_job_queue = None
+        :param list jobs: A list of new (un-saved) :py:class:`EncodingJob`
+            instances.
+        :rtype: list
+        :returns: A list with an error message (or ``None``, if the job was
+            saved and enqueued) for each job, in the same order as ``jobs``.
+            Every job is given a unique ID, even if it failed.
+
+        A failed job is never left stored without a message on the new job
+        queue, where nothing would ever pop it. Jobs that were stored but
+        couldn't be enqueued are deleted again, so re-submitting them doesn't
+        leave a duplicate behind. A batch that fails, for whatever reason,
+        only fails the jobs in it.
+        """
+        now_dtime = datetime.datetime.now()
+        errors = {}
+        items = []
+        for job in jobs:
+            old_values = (job.version, job.last_modified_dtime,
+                          job.creation_dtime)
+            item, changed = job._prepare_for_save(now_dtime)
+            items.append((job, item, old_values))
+
+        stored_jobs = []
+        for start in range(0, len(items), cls.JOB_ITEM_BATCH_SIZE):
+            batch = items[start:start + cls.JOB_ITEM_BATCH_SIZE]
+            batch_items = [(job.unique_id, item) for job, item, old in batch]
+            try:
+                batch_errors = cls._put_new_job_items(batch_items)
+            except Exception, exc:
+                logger.error("JobStateBackend.save_new_jobs(): " \
+                             "Unable to store a batch of jobs: %s" % exc)
+                logger.error()
+                batch_errors = dict([(unique_id, str(exc))
+                                     for unique_id, item in batch_items])
+                # Some of the batch may have been written before it failed.
+                cls._discard_new_jobs([job for job, item, old in batch])
+            for job, item, old_values in batch:
+                if batch_errors.has_key(job.unique_id):
+                    # Put things back the way they were, as EncodingJob.save()
+                    # does.
+                    (job.version, job.last_modified_dtime,
+                     job.creation_dtime) = old_values
+                    errors[job.unique_id] = batch_errors[job.unique_id]
+                else:
+                    job._saved_attributes = item
+                    stored_jobs.append(job)
+
+        unqueued_jobs = []
+        for start in range(0, len(stored_jobs), cls.MESSAGE_BATCH_SIZE):
+            batch_jobs = stored_jobs[start:start + cls.MESSAGE_BATCH_SIZE]
+            try:
+                batch_errors = cls._send_messages(
+                    settings.SQS_NEW_JOB_QUEUE_NAME,
+                    [job._get_message_body() for job in batch_jobs])
+            except Exception, exc:
+                logger.error("JobStateBackend.save_new_jobs(): " \
+                             "Unable to enqueue a batch of jobs: %s" % exc)
+                batch_errors = dict([(index, str(exc))
+                                     for index in range(len(batch_jobs))])
+            for index in sorted(batch_errors.keys()):
+                job = batch_jobs[index]
+                # Give it one more shot on its own before giving up.
+                try:
+                    cls._send_message(settings.SQS_NEW_JOB_QUEUE_NAME,
+                                      job._get_message_body())
+                except Exception, exc:
+                    logger.error("JobStateBackend.save_new_jobs(): " \
+                                 "Unable to enqueue job %s: %s" % (
+                                    job.unique_id, exc))
+                    errors[job.unique_id] = str(exc)
+                    unqueued_jobs.append(job)
+        cls._discard_new_jobs(unqueued_jobs)
+
+        return [errors.get(job.unique_id) for job in jobs]
+
+    @classmethod
+    def _discard_new_jobs(cls, jobs):
+        """
+        Deletes new jobs that couldn't be saved and enqueued, so they aren't
+        left stored with nothing to pop them. Failures are logged, since the
+        jobs are being reported as failed either way.
+
+        :param list jobs: The :py:class:`EncodingJob` instances to delete.
+        """
+        for start in range(0, len(jobs), cls.JOB_ITEM_BATCH_SIZE):
+            unique_ids = [job.unique_id for job in
+                          jobs[start:start + cls.JOB_ITEM_BATCH_SIZE]]
+            try:
+                cls._delete_job_items(unique_ids)
+            except Exception:
+                logger.error("JobStateBackend._discard_new_jobs(): " \
+                             "Unable to delete jobs: %s" % unique_ids)
+                logger.error()
+
+    @classmethod
+    def requeue_new_job(cls, job, delay_seconds=0):
+        """
+        Puts a job that was popped from the new job queue back on it, for
+        some other node to pick up.
+
+        :param EncodingJob job: A job that was popped with
+            :py:meth:`pop_new_jobs_from_queue`.
+        :keyword int delay_seconds: Keep the job hidden from receivers for
+            this many seconds, so whoever put it back doesn't just pop it
+            again.
+        """
+        cls._send_message(settings.SQS_NEW_JOB_QUEUE_NAME,
+                          job._get_message_body(),
+                          delay_seconds=delay_seconds)
 
     @classmethod
-    def get_unfinished_jobs(cls):
+    def get_unfinished_jobs(cls, num_segments=1):
         """
-        Queries SimpleDB for a list of pending jobs that have not yet been
+        Queries the backend for a list of pending jobs that have not yet been
         finished. 
+
+        .. tip:: This holds every unfinished job in memory at once. Use
+            :py:meth:`iter_unfinished_jobs` if you don't need them all at
+            the same time.
         
+        :keyword int num_segments: See :py:meth:`iter_unfinished_jobs`.
         :rtype: list 
         :returns: A list of unfinished :py:class:`EncodingJob` objects.
         """
-        query_str = "SELECT * FROM %s WHERE job_state != '%s' " \
-                    "and job_state != '%s' " \
-                    "and job_state != '%s'" % (
-              settings.SIMPLEDB_JOB_STATE_DOMAIN,
-              'FINISHED',
-              'ERROR',
-              'ABANDONED',
-        )
-        results = cls._get_sdb_job_state_domain().select(query_str)
-
-        jobs = []
-        for item in results:
+        return list(cls.iter_unfinished_jobs(num_segments=num_segments))
+
+    @classmethod
+    def count_unfinished_jobs(cls):
+        """
+        Counts the jobs that have not yet been finished. Much cheaper than
+        :py:meth:`get_unfinished_jobs`, since no jobs are fetched.
+
+        :rtype: int
+        :returns: The number of unfinished jobs.
+        """
+        return cls._count_unfinished_job_items()
+
+    @classmethod
+    def iter_unfinished_jobs(cls, num_segments=1):
+        """
+        Queries the backend for pending jobs that have not yet been finished,
+        yielding them a page at a time so that only a page or so of jobs is
+        held in memory at once.
+
+        If ``num_segments`` is more than one, the query is split up into
+        that many creation time ranges, each of which is paged through in
+        its own thread. Jobs from different segments are yielded as their
+        pages arrive, so there is no particular order.
+
+        :keyword int num_segments: The number of segments to split the query
+            into.
+        :rtype: generator
+        :returns: A generator of unfinished :py:class:`EncodingJob` objects.
+        """
+        if num_segments > 1:
+            pages = cls._iter_segmented_unfinished_job_item_pages(num_segments)
+        else:
+            pages = cls._iter_unfinished_job_item_pages()
+
+        for page in pages:
+            for item in page:
+                try:
+                    job = cls._get_job_object_from_item(item)
+                except TypeError:
+                    message = "JobStateBackend.iter_unfinished_jobs(): " \
+                              "Unable to instantiate job: %s" % item
+                    logger.error(message_or_obj=message)
+                    logger.error()
+                    continue
+                except ImportError:
+                    message = "JobStateBackend.iter_unfinished_jobs(): " \
+                              "Invalid nommer specified for job: %s" % item
+                    logger.error(message_or_obj=message)
+                    logger.error()
+                    continue
+                yield job
+
+    @classmethod
+    def _iter_segmented_unfinished_job_item_pages(cls, num_segments):
+        """
+        Splits the time between the oldest unfinished job's creation and now
+        into ``num_segments`` equal ranges, and pages through each range
+        concurrently via :py:meth:`_iter_unfinished_job_item_pages`. Pages
+        are handed back through a bounded queue, so the segment threads
+        can't get too far ahead of the consumer.
+
+        :param int num_segments: The number of segments to split the query
+            into.
+        :rtype: generator
+        :returns: A generator of lists of job attribute dicts.
+        """
+        oldest = cls._get_oldest_unfinished_creation_dtime()
+        if not oldest:
+            # No unfinished jobs at all.
+            return
+
+        start_dtime = EncodingJob._get_dtime_from_string(oldest)
+        segment_length = (datetime.datetime.now() - start_dtime) / num_segments
+
+        # Boundaries between segments. The first segment has no lower bound
+        # and the last has no upper bound, so jobs created while we're
+        # paging (or with odd creation times) aren't missed.
+        bounds = [None]
+        for i in range(1, num_segments):
+            boundary = start_dtime + segment_length * i
+            bounds.append(EncodingJob._get_string_from_dtime(boundary))
+        bounds.append(None)
+
+        pages = Queue.Queue(maxsize=num_segments * 2)
+        # Set when the consumer goes away, so the segment threads can stop.
+        stopped = threading.Event()
+        # Marks the end of a segment in the pages queue.
+        segment_done = object()
+
+        def put(obj):
+            while not stopped.is_set():
+                try:
+                    pages.put(obj, timeout=1)
+                    return True
+                except Queue.Full:
+                    continue
+            return False
+
+        def page_through_segment(min_dtime, max_dtime):
             try:
-                job = cls._get_job_object_from_item(item)
-            except TypeError:
-                message = "JobStateBackend.get_unfinished_jobs(): " \
-                          "Unable to instantiate job: %s" % item
-                logger.error(message_or_obj=message)
-                logger.error()
-                continue
-            except ImportError:
-                message = "JobStateBackend.get_unfinished_jobs(): " \
-                          "Invalid nommer specified for job: %s" % item
-                logger.error(message_or_obj=message)
+                for page in cls._iter_unfinished_job_item_pages(
+                                                min_creation_dtime=min_dtime,
+                                                max_creation_dtime=max_dtime):
+                    if not put(page):
+                        return
+            except Exception, exc:
+                logger.error("JobStateBackend." \
+                             "_iter_segmented_unfinished_job_item_pages(): " \
+                             "Segment %s - %s failed." % (min_dtime, max_dtime))
                 logger.error()
-                continue
-            jobs.append(job)
+                # Handed to the consumer, who re-raises it.
+                put(exc)
+            put(segment_done)
+
+        for i in range(num_segments):
+            thread = threading.Thread(target=page_through_segment,
+                                      args=(bounds[i], bounds[i + 1]))
+            # Don't hold up shutdown if the consumer bails out early.
+            thread.daemon = True
+            thread.start()
 
-        return jobs
+        try:
+            segments_remaining = num_segments
+            while segments_remaining:
+                page = pages.get()
+                if page is segment_done:
+                    segments_remaining -= 1
+                elif isinstance(page, Exception):
+                    raise page
+                else:
+                    yield page
+        finally:
+            stopped.set()
 
     @classmethod
-    def _pop_jobs_from_queue(cls, queue, num_to_pop, visibility_timeout=30,
-                             delete_msg_on_pop=True):
+    def _pop_jobs_from_queue(cls, queue_name, num_to_pop, visibility_timeout=30,
+                             delete_msg_on_pop=True, wait_time_seconds=0):
         """
-        Pops job objects from a queue whose entries have bodies that just
-        contain job ID strings. This is a generic helper method to pop from
-        arbitrary SQS queues. The new job queue and the job state change queues
-        are examples of uses for it.
+        Pops job objects from a queue whose entries have bodies that contain
+        job snapshots (or, for older messages, just job ID strings). This is
+        a generic helper method to pop from arbitrary queues. The new job
+        queue and the job state change queues are examples of uses for it.
+
+        Jobs are rebuilt from the snapshot in the message body when possible.
+        The backend's job storage is only queried for messages without a
+        usable snapshot.
         
         .. warning:: 
             Once jobs are popped from a queue and ``delete()`` is ran on the
             message, they are gone for good. Be careful to handle errors in
             the methods higher on the call stack that use this method. 
         
-        :param boto.sqs.queue.Queue queue: The queue to pop jobs from.
+        :param str queue_name: The name of the queue to pop jobs from.
         :param int num_to_pop: The maximum number of jobs to pop at a time.
             This can not be more than 10, as per SimpleDB_ limitations.
         :param int visibility_timeout: The time (in seconds) that a job
             will re-appear on the queue if ``delete()`` is not called on it.
         :param bool delete_msg_on_pop: If ``True``, delete the message as soon
             as the job is popped.
+        :keyword int wait_time_seconds: If the queue is empty, wait up to
+            this many seconds for a job to arrive. SQS allows up to 20.
         :rtype: list
         :returns: A list of :py:class:`EncodingJob` objects.
         """
@@ -432,22 +1003,31 @@ class JobStateBackend(object):
             msg = 'SQS only allows up to 10 messages to be popped at a time.'
             raise Exception(msg)
 
-        messages = queue.get_messages(num_to_pop,
-                                      visibility_timeout=visibility_timeout)
+        messages = cls._receive_messages(queue_name, num_to_pop,
+                                         visibility_timeout,
+                                         wait_time_seconds=wait_time_seconds)
         # Store these in a dict to avoid duplicates. Keys are unique id.
         jobs = {}
 
         for message in messages:
-            # These message bodies only contain a unique id string.
-            unique_id = message.get_body()
+            body = message.get_body()
+            job = cls._get_job_object_from_message_body(body)
 
-            if not jobs.has_key(unique_id):
-                # Avoid querying for a job we already have. This mostly comes
-                # up with the state change queue, where you can have more
-                # than one state change for the same object. In that case,
-                # there could be more than one queue entry with the same
-                # job id in their bodies.
-                jobs[unique_id] = cls.get_job_object_from_id(unique_id)
+            if job:
+                # There can be more than one state change for the same job
+                # in a batch. Keep whichever snapshot is the most recent.
+                existing = jobs.get(job.unique_id)
+                if not existing or \
+                   job.get_freshness_key() >= existing.get_freshness_key():
+                    jobs[job.unique_id] = job
+            else:
+                # No usable snapshot, fall back to the job storage.
+                unique_id = cls._get_unique_id_from_message_body(body)
+                if not jobs.has_key(unique_id):
+                    # Avoid querying for a job we already have. This mostly
+                    # comes up with the state change queue, where you can
+                    # have more than one state change for the same object.
+                    jobs[unique_id] = cls.get_job_object_from_id(unique_id)
 
             if delete_msg_on_pop:
                 # Deleting a message makes it gone for good from SQS, instead
@@ -458,7 +1038,7 @@ class JobStateBackend(object):
         return jobs.values()
 
     @classmethod
-    def pop_new_jobs_from_queue(cls, num_to_pop):
+    def pop_new_jobs_from_queue(cls, num_to_pop, wait_time_seconds=0):
         """
         Pops any new jobs from the job queue.
         
@@ -469,12 +1049,16 @@ class JobStateBackend(object):
         
         :param int num_to_pop: Pop up to this many jobs from the queue at once.
             This can be up to 10, as per SimpleDB_ limitations.
+        :keyword int wait_time_seconds: If the queue is empty, wait up to
+            this many seconds for a job to arrive (long polling). This can be
+            up to 20, as per SQS_ limitations.
         :rtype: list
         :returns: A list of :py:class:`EncodingJob` objects.
         """
-        return cls._pop_jobs_from_queue(cls._get_sqs_new_job_queue(),
+        return cls._pop_jobs_from_queue(settings.SQS_NEW_JOB_QUEUE_NAME,
                                          num_to_pop,
-                                         visibility_timeout=3600)
+                                         visibility_timeout=3600,
+                                         wait_time_seconds=wait_time_seconds)
 
     @classmethod
     def pop_state_changes_from_queue(cls, num_to_pop):
@@ -491,6 +1075,87 @@ class JobStateBackend(object):
         :rtype: list
         :returns: A list of :py:class:`EncodingJob` objects.
         """
-        return cls._pop_jobs_from_queue(cls._get_sqs_state_change_queue(),
+        return cls._pop_jobs_from_queue(settings.SQS_JOB_STATE_CHANGE_QUEUE_NAME,
                                          num_to_pop,
                                          visibility_timeout=3600)
+
+    @classmethod
+    def drain_state_changes_from_queue(cls, max_to_pop, num_receivers=1):
+        """
+        Keeps popping batches of state changes from the queue until SQS
+        hands back an empty batch, or until ``max_to_pop`` messages have
+        been requested. Up to ``num_receivers`` batches are popped
+        concurrently, each in its own thread. Backends must give each thread
+        its own connection (as the AWS and SQLite backends do).
+
+        .. warning:: 
+            The same caveats as :py:meth:`pop_state_changes_from_queue` apply.
+            Messages are deleted as soon as they are popped.
+
+        :param int max_to_pop: The maximum number of state change messages to
+            pop during this drain.
+        :keyword int num_receivers: The number of concurrent receivers.
+        :rtype: list
+        :returns: A list of :py:class:`EncodingJob` objects. Each job only
+            appears once, even if it had more than one state change queued.
+        """
+        # Keys are unique IDs, values are EncodingJob objects. Shared by
+        # all of the receiver threads, so guard it (and the remaining
+        # budget) with a lock.
+        jobs = {}
+        # This is a list so the receiver threads can modify it in place.
+        remaining = [max_to_pop]
+        lock = threading.Lock()
+
+        def receiver():
+            while True:
+                with lock:
+                    num_to_pop = min(10, remaining[0])
+                    if num_to_pop <= 0:
+                        # Budget exhausted for this drain.
+                        return
+                    remaining[0] -= num_to_pop
+
+                try:
+                    popped = cls.pop_state_changes_from_queue(num_to_pop)
+                except:
+                    logger.error("JobStateBackend." \
+                                 "drain_state_changes_from_queue(): " \
+                                 "Receiver failed.")
+                    logger.error()
+                    return
+
+                if not popped:
+                    # SQS reports the queue as empty.
+                    return
+
+                with lock:
+                    for job in popped:
+                        # Other receivers may have popped a snapshot of the
+                        # same job. Keep the most recent one.
+                        existing = jobs.get(job.unique_id)
+                        if not existing or \
+                           job.get_freshness_key() >= \
+                           existing.get_freshness_key():
+                            jobs[job.unique_id] = job
+
+        receivers = [threading.Thread(target=receiver)
+                     for i in range(max(1, num_receivers))]
+        for thread in receivers:
+            thread.start()
+        for thread in receivers:
+            thread.join()
+
+        return jobs.values()
+
+    @classmethod
+    def get_state_change_queue_backlog(cls):
+        """
+        Returns the backend's approximation of the number of messages waiting
+        in the state change queue. This is a good indicator of how far behind
+        :doc:`../feederd` is on processing job state changes.
+
+        :rtype: int
+        :returns: The approximate number of state changes in the queue.
+        """
+        return cls._get_queue_length(settings.SQS_JOB_STATE_CHANGE_QUEUE_NAME)
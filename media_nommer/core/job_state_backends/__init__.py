@@ -0,0 +1,11 @@
+"""
+Job state backends store encoding jobs and pass messages between
+:doc:`../feederd` and :doc:`../ec2nommerd` via the new job and job state
+change queues. Each backend is a sub-class of
+:py:class:`media_nommer.core.job_state_backend.JobStateBackend`.
+
+The backend in use is selected with the
+:py:data:`JOB_STATE_BACKEND <media_nommer.conf.settings.JOB_STATE_BACKEND>`
+setting. A reference to it may be obtained through
+:py:func:`media_nommer.core.job_state_backend.get_job_state_backend`.
+"""
@@ -0,0 +1,254 @@
+"""
+A job state backend that stores jobs in a SimpleDB_ domain and passes
+messages through SQS_ queues. This is the default, and the only backend
+that works with :doc:`../ec2nommerd` instances on EC2_.
+"""
+import threading
+import boto
+from boto.exception import SDBResponseError, SQSError
+from boto.sqs.message import Message
+from boto.sqs.queue import Queue
+from media_nommer.conf import settings
+from media_nommer.core.job_state_backend import JobStateBackend
+from media_nommer.core.job_state_backends.exceptions import JobVersionConflict
+
+class AWSJobStateBackend(JobStateBackend):
+    """
+    Stores jobs in the SimpleDB_ domain given by the
+    :py:data:`SIMPLEDB_JOB_STATE_DOMAIN <media_nommer.conf.settings.SIMPLEDB_JOB_STATE_DOMAIN>`
+    setting, and uses SQS_ queues for the new job and state change queues.
+    """
+    # boto connections aren't safe to share between threads, so each thread
+    # lazy-loads its own connections, domain and queues. Do not refer to
+    # directly.
+    __local = threading.local()
+    # Bumped when the job state domain is deleted, so every thread knows to
+    # re-load its domain object.
+    __sdb_domain_generation = 0
+    # The generation the domain was last created in. Threads that come
+    # along later needn't ask SimpleDB to create it again.
+    __sdb_domain_created_generation = None
+    # Keys are queue names, values are queue URLs. Once a queue's URL is
+    # known, other threads can get at it without asking SQS.
+    __sqs_queue_urls = {}
+
+    @classmethod
+    def _get_sdb_connection(cls):
+        """
+        Lazy-loading of this thread's SimpleDB boto connection. Refer to this
+        instead of referencing cls.__local directly.
+
+        :returns: A boto connection to Amazon's SimpleDB interface.
+        """
+        if getattr(cls.__local, 'sdb_connection', None) is None:
+            cls.__local.sdb_connection = boto.connect_sdb(
+                settings.AWS_ACCESS_KEY_ID,
+                settings.AWS_SECRET_ACCESS_KEY)
+        return cls.__local.sdb_connection
+
+    @classmethod
+    def _get_sdb_job_state_domain(cls):
+        """
+        Lazy-loading of this thread's SimpleDB boto domain. Refer to this
+        instead of referencing cls.__local directly.
+
+        :returns: A boto SimpleDB domain for this workflow.
+        """
+        generation = cls.__sdb_domain_generation
+        if getattr(cls.__local, 'sdb_domain_generation', None) != generation:
+            conn = cls._get_sdb_connection()
+            if cls.__sdb_domain_created_generation == generation:
+                cls.__local.sdb_job_state_domain = conn.get_domain(
+                                        settings.SIMPLEDB_JOB_STATE_DOMAIN,
+                                        validate=False)
+            else:
+                cls.__local.sdb_job_state_domain = conn.create_domain(
+                                        settings.SIMPLEDB_JOB_STATE_DOMAIN)
+                cls.__sdb_domain_created_generation = generation
+            cls.__local.sdb_domain_generation = generation
+        return cls.__local.sdb_job_state_domain
+
+    @classmethod
+    def _get_sqs_connection(cls):
+        """
+        Lazy-loading of this thread's SQS boto connection. Refer to this
+        instead of referencing cls.__local directly.
+        
+        :returns: A boto connection to Amazon's SQS interface.
+        """
+        if getattr(cls.__local, 'sqs_connection', None) is None:
+            cls.__local.sqs_connection = boto.connect_sqs(
+                settings.AWS_ACCESS_KEY_ID,
+                settings.AWS_SECRET_ACCESS_KEY)
+        return cls.__local.sqs_connection
+
+    @classmethod
+    def _get_sqs_queue(cls, queue_name):
+        """
+        Lazy-loading of this thread's SQS boto queues. Refer to this instead
+        of referencing cls.__local directly.
+
+        :param str queue_name: The name of the SQS queue.
+        :returns: A boto SQS queue.
+        """
+        if getattr(cls.__local, 'sqs_queues', None) is None:
+            # Keys are queue names, values are boto SQS queues.
+            cls.__local.sqs_queues = {}
+        if not cls.__local.sqs_queues.has_key(queue_name):
+            conn = cls._get_sqs_connection()
+            queue_url = cls.__sqs_queue_urls.get(queue_name)
+            if queue_url:
+                queue = Queue(conn, queue_url)
+            else:
+                queue = conn.create_queue(queue_name)
+                cls.__sqs_queue_urls[queue_name] = queue.url
+            cls.__local.sqs_queues[queue_name] = queue
+        return cls.__local.sqs_queues[queue_name]
+
+    @classmethod
+    def _get_job_item(cls, unique_id):
+        return cls._get_sdb_job_state_domain().get_item(unique_id)
+
+    @classmethod
+    def _put_job_item(cls, unique_id, attributes, expected_version):
+        if expected_version:
+            expected_value = ['version', str(expected_version)]
+        else:
+            # New jobs (and those saved before versions were tracked) must
+            # not have a version attribute yet.
+            expected_value = ['version', False]
+        try:
+            cls._get_sdb_job_state_domain().put_attributes(
+                unique_id, attributes, replace=True,
+                expected_value=expected_value)
+        except SDBResponseError, exc:
+            if exc.error_code in ['ConditionalCheckFailed',
+                                  'AttributeDoesNotExist']:
+                raise JobVersionConflict(
+                    'Job %s is no longer at version %d.' % (unique_id,
+                                                            expected_version))
+            raise
+
+    @classmethod
+    def _put_new_job_items(cls, items):
+        # BatchPutAttributes can't be made conditional, but new jobs have
+        # freshly generated IDs, so there's nothing to conflict with.
+        try:
+            cls._get_sdb_job_state_domain().batch_put_attributes(
+                dict(items), replace=True)
+        except SDBResponseError, exc:
+            # The batch is all or nothing.
+            return dict((unique_id, str(exc)) for unique_id, attributes in items)
+        return {}
+
+    @classmethod
+    def _get_unfinished_where_clause(cls):
+        """
+        :rtype: str
+        :returns: The SimpleDB select WHERE clause (without the WHERE) that
+            matches unfinished jobs.
+        """
+        return " and ".join(["job_state != '%s'" % state
+                             for state in cls.FINISHED_STATES])
+
+    @classmethod
+    def _iter_unfinished_job_item_pages(cls, min_creation_dtime=None,
+                                        max_creation_dtime=None):
+        query_str = "SELECT * FROM `%s` WHERE %s" % (
+            settings.SIMPLEDB_JOB_STATE_DOMAIN,
+            cls._get_unfinished_where_clause())
+        if min_creation_dtime:
+            query_str += " and creation_dtime >= '%s'" % min_creation_dtime
+        if max_creation_dtime:
+            query_str += " and creation_dtime < '%s'" % max_creation_dtime
+        query_str += " LIMIT %d" % cls.UNFINISHED_JOBS_PAGE_SIZE
+
+        # This may be running in several threads at once, each with its
+        # own connection.
+        conn = cls._get_sdb_connection()
+        domain = cls._get_sdb_job_state_domain()
+
+        next_token = None
+        while True:
+            results = conn.select(domain, query_str, next_token=next_token)
+            page = list(results)
+            if page:
+                yield page
+            next_token = results.next_token
+            if not next_token:
+                break
+
+    @classmethod
+    def _get_oldest_unfinished_creation_dtime(cls):
+        # SimpleDB needs a predicate on the attribute being sorted by.
+        query_str = "SELECT creation_dtime FROM `%s` WHERE %s " \
+                    "and creation_dtime is not null " \
+                    "ORDER BY creation_dtime ASC LIMIT 1" % (
+            settings.SIMPLEDB_JOB_STATE_DOMAIN,
+            cls._get_unfinished_where_clause())
+        for item in cls._get_sdb_job_state_domain().select(query_str,
+                                                           max_items=1):
+            return item['creation_dtime']
+        return None
+
+    @classmethod
+    def _count_unfinished_job_items(cls):
+        query_str = "SELECT count(*) FROM `%s` WHERE %s" % (
+            settings.SIMPLEDB_JOB_STATE_DOMAIN,
+            cls._get_unfinished_where_clause())
+        # SimpleDB may stop counting partway and hand back a partial count,
+        # with the rest coming in later results.
+        return sum([int(item['Count']) for item in
+                    cls._get_sdb_job_state_domain().select(query_str)])
+
+    @classmethod
+    def _delete_job_items(cls, unique_ids):
+        # A None value deletes the whole item.
+        cls._get_sdb_job_state_domain().batch_delete_attributes(
+            dict([(unique_id, None) for unique_id in unique_ids]))
+
+    @classmethod
+    def _delete_all_job_items(cls):
+        try:
+            cls._get_sdb_connection().delete_domain(settings.SIMPLEDB_JOB_STATE_DOMAIN)
+        except SDBResponseError:
+            # Tried to delete a domain that doesn't exist. We probably haven't
+            # ran feederd before, or are doing testing.
+            pass
+
+        # Have every thread re-load its boto SDB domain object.
+        cls.__sdb_domain_generation += 1
+
+    @classmethod
+    def _send_message(cls, queue_name, body, delay_seconds=0):
+        # SQS only takes whole seconds.
+        cls._get_sqs_queue(queue_name).write(
+            Message(body=body), delay_seconds=int(delay_seconds) or None)
+
+    @classmethod
+    def _send_messages(cls, queue_name, bodies):
+        # Unlike write(), write_batch() doesn't go through the queue's
+        # message class, so encode the bodies the same way Message does.
+        entries = [(str(index), Message(body=body).get_body_encoded(), 0)
+                   for index, body in enumerate(bodies)]
+        try:
+            results = cls._get_sqs_queue(queue_name).write_batch(entries)
+        except SQSError, exc:
+            return dict((index, str(exc)) for index in range(len(bodies)))
+        return dict((int(error['id']), error.get('error_message'))
+                    for error in results.errors)
+
+    @classmethod
+    def _receive_messages(cls, queue_name, num_to_receive, visibility_timeout,
+                          wait_time_seconds=0):
+        return cls._get_sqs_queue(queue_name).get_messages(
+            num_to_receive, visibility_timeout=visibility_timeout,
+            wait_time_seconds=wait_time_seconds or None)
+
+    @classmethod
+    def _get_queue_length(cls, queue_name):
+        return cls._get_sqs_queue(queue_name).count()
+
+    @classmethod
+    def _clear_queue(cls, queue_name):
+        cls._get_sqs_queue(queue_name).clear()
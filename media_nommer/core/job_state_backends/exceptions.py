@@ -0,0 +1,21 @@
+"""
+Job state backend exceptions
+"""
+class JobStateBackendException(Exception):
+    """
+    A generic job state backend-related exception. Try to be more specific in
+    your code, just use this as a parent class.
+    """
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return repr(self.message)
+
+class JobVersionConflict(JobStateBackendException):
+    """
+    Raised when saving a job whose stored version no longer matches the
+    version that the in-memory copy was loaded with. Someone else has saved
+    the job in the meantime, so our copy is stale.
+    """
+    pass
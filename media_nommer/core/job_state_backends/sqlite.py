@@ -0,0 +1,295 @@
+"""
+A job state backend that keeps jobs and queues in a local SQLite database.
+This doesn't need AWS_ at all, which makes it handy for development,
+testing, and benchmarking :doc:`../feederd` and :doc:`../ec2nommerd` on
+a single machine. Both daemons must point at the same database file via the
+:py:data:`SQLITE_JOB_STATE_DB_PATH <media_nommer.conf.settings.SQLITE_JOB_STATE_DB_PATH>`
+setting.
+
+.. warning:: Since the database is a local file, this backend can't be used
+    with :doc:`../ec2nommerd` instances running on EC2_.
+"""
+import os
+import time
+import uuid
+import sqlite3
+import threading
+from media_nommer.conf import settings
+from media_nommer.core.job_state_backend import JobStateBackend
+from media_nommer.core.job_state_backends.exceptions import JobVersionConflict
+
+class SQLiteMessage(object):
+    """
+    A message received from one of the SQLite-backed queues. Mimics the
+    parts of boto's SQS messages that
+    :py:class:`JobStateBackend <media_nommer.core.job_state_backend.JobStateBackend>`
+    relies on.
+    """
+    def __init__(self, backend, message_id, receipt_handle, body):
+        """
+        :param SQLiteJobStateBackend backend: The backend the message was
+            received through.
+        :param int message_id: The message's row ID.
+        :param str receipt_handle: Identifies this particular receipt of the
+            message. If the message's visibility timeout passes and another
+            receiver gets it, this receipt can no longer delete it.
+        :param str body: The message body.
+        """
+        self.backend = backend
+        self.message_id = message_id
+        self.receipt_handle = receipt_handle
+        self.body = body
+
+    def get_body(self):
+        """
+        :rtype: str
+        :returns: The message body.
+        """
+        return self.body
+
+    def delete(self):
+        """
+        Deletes the message from its queue, so it won't re-appear once its
+        visibility timeout passes.
+        """
+        self.backend._get_db_connection().execute(
+            "DELETE FROM messages WHERE message_id = ? AND receipt_handle = ?",
+            (self.message_id, self.receipt_handle))
+
+class SQLiteJobStateBackend(JobStateBackend):
+    """
+    Stores jobs and queue messages in the SQLite database found at
+    :py:data:`SQLITE_JOB_STATE_DB_PATH <media_nommer.conf.settings.SQLITE_JOB_STATE_DB_PATH>`.
+    Queue messages follow SQS_'s visibility timeout semantics.
+    """
+    JOB_COLUMNS = ['unique_id', 'source_path', 'dest_path', 'nommer',
+                   'job_options', 'job_state', 'job_state_details',
+                   'notify_url', 'last_modified_dtime', 'creation_dtime',
+                   'version']
+    """The columns in the jobs table, in order."""
+    LONG_POLL_INTERVAL = 0.25
+    """How often (in seconds) long polls check for new messages."""
+
+    # SQLite connections can't be shared between threads, so each thread
+    # lazy-loads its own. Do not refer to directly.
+    __local = threading.local()
+
+    @classmethod
+    def _get_db_connection(cls):
+        """
+        Lazy-loading of this thread's SQLite connection. Refer to this instead
+        of referencing cls.__local directly. The tables are created on the
+        first connection to a database.
+
+        :returns: An SQLite connection in autocommit mode.
+        """
+        db_path = os.path.expanduser(settings.SQLITE_JOB_STATE_DB_PATH)
+        if getattr(cls.__local, 'db_path', None) != db_path:
+            # Either the first connection in this thread, or the setting has
+            # been changed to point at another database.
+            conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            cls._create_tables(conn)
+            cls.__local.connection = conn
+            cls.__local.db_path = db_path
+        return cls.__local.connection
+
+    @classmethod
+    def _create_tables(cls, conn):
+        """
+        Creates the jobs and messages tables, if they don't already exist.
+
+        :param sqlite3.Connection conn: The connection to create tables with.
+        """
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (%s, PRIMARY KEY (unique_id))" % (
+                ', '.join(cls.JOB_COLUMNS)))
+        # Databases created before jobs were versioned lack this column.
+        existing_columns = [row[1] for row in
+                            conn.execute("PRAGMA table_info(jobs)")]
+        if 'version' not in existing_columns:
+            conn.execute("ALTER TABLE jobs ADD COLUMN version")
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_job_state ON jobs (job_state)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "message_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "queue_name TEXT NOT NULL, "
+            "body TEXT NOT NULL, "
+            "visible_at REAL NOT NULL, "
+            "receipt_handle TEXT)")
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS messages_queue_visible "
+            "ON messages (queue_name, visible_at)")
+
+    @classmethod
+    def _get_job_item(cls, unique_id):
+        row = cls._get_db_connection().execute(
+            "SELECT * FROM jobs WHERE unique_id = ?", (unique_id,)).fetchone()
+        if row is None:
+            return None
+        return dict((str(key), row[key]) for key in row.keys())
+
+    @classmethod
+    def _put_job_item(cls, unique_id, attributes, expected_version):
+        conn = cls._get_db_connection()
+        columns = [column for column in cls.JOB_COLUMNS
+                   if attributes.has_key(column) and column != 'unique_id']
+        values = [attributes[column] for column in columns]
+
+        if expected_version:
+            version_clause = "version = ?"
+            params = values + [unique_id, expected_version]
+        else:
+            # Jobs saved before versions were tracked have no version.
+            version_clause = "(version IS NULL OR version = 0)"
+            params = values + [unique_id]
+        cursor = conn.execute(
+            "UPDATE jobs SET %s WHERE unique_id = ? AND %s" % (
+                ', '.join(['%s = ?' % column for column in columns]),
+                version_clause),
+            params)
+        if cursor.rowcount:
+            return
+
+        if not expected_version:
+            # Nothing to update, so this should be a brand new job.
+            try:
+                conn.execute(
+                    "INSERT INTO jobs (unique_id, %s) VALUES (?, %s)" % (
+                        ', '.join(columns), ', '.join(['?'] * len(columns))),
+                    [unique_id] + values)
+                return
+            except sqlite3.IntegrityError:
+                # Someone else created it first.
+                pass
+
+        raise JobVersionConflict(
+            'Job %s is no longer at version %d.' % (unique_id,
+                                                    expected_version))
+
+    @classmethod
+    def _iter_unfinished_job_item_pages(cls, min_creation_dtime=None,
+                                        max_creation_dtime=None):
+        conn = cls._get_db_connection()
+        query_str = "SELECT * FROM jobs WHERE job_state NOT IN (%s)" % (
+            ', '.join(['?'] * len(cls.FINISHED_STATES)))
+        params = list(cls.FINISHED_STATES)
+        if min_creation_dtime:
+            query_str += " AND creation_dtime >= ?"
+            params.append(min_creation_dtime)
+        if max_creation_dtime:
+            query_str += " AND creation_dtime < ?"
+            params.append(max_creation_dtime)
+        # Page by unique ID, since it never changes for a job.
+        query_str += " AND unique_id > ? ORDER BY unique_id LIMIT ?"
+
+        last_unique_id = ''
+        while True:
+            rows = conn.execute(query_str, params + [
+                last_unique_id, cls.UNFINISHED_JOBS_PAGE_SIZE]).fetchall()
+            if not rows:
+                break
+            yield [dict((str(key), row[key]) for key in row.keys())
+                   for row in rows]
+            last_unique_id = rows[-1]['unique_id']
+
+    @classmethod
+    def _get_oldest_unfinished_creation_dtime(cls):
+        row = cls._get_db_connection().execute(
+            "SELECT MIN(creation_dtime) FROM jobs "
+            "WHERE job_state NOT IN (%s)" % (
+                ', '.join(['?'] * len(cls.FINISHED_STATES))),
+            cls.FINISHED_STATES).fetchone()
+        return row[0]
+
+    @classmethod
+    def _count_unfinished_job_items(cls):
+        row = cls._get_db_connection().execute(
+            "SELECT COUNT(*) FROM jobs WHERE job_state NOT IN (%s)" % (
+                ', '.join(['?'] * len(cls.FINISHED_STATES))),
+            cls.FINISHED_STATES).fetchone()
+        return row[0]
+
+    @classmethod
+    def _delete_job_items(cls, unique_ids):
+        cls._get_db_connection().executemany(
+            "DELETE FROM jobs WHERE unique_id = ?",
+            [(unique_id,) for unique_id in unique_ids])
+
+    @classmethod
+    def _delete_all_job_items(cls):
+        cls._get_db_connection().execute("DELETE FROM jobs")
+
+    @classmethod
+    def _send_message(cls, queue_name, body, delay_seconds=0):
+        cls._get_db_connection().execute(
+            "INSERT INTO messages (queue_name, body, visible_at) "
+            "VALUES (?, ?, ?)",
+            (queue_name, body, time.time() + delay_seconds))
+
+    @classmethod
+    def _receive_messages(cls, queue_name, num_to_receive, visibility_timeout,
+                          wait_time_seconds=0):
+        # There's nothing to notify waiting receivers with, so long polling
+        # is done by checking every so often.
+        give_up_at = time.time() + wait_time_seconds
+        while True:
+            messages = cls._receive_messages_now(queue_name, num_to_receive,
+                                                 visibility_timeout)
+            if messages or time.time() >= give_up_at:
+                return messages
+            time.sleep(min(cls.LONG_POLL_INTERVAL,
+                           max(0, give_up_at - time.time())))
+
+    @classmethod
+    def _receive_messages_now(cls, queue_name, num_to_receive,
+                              visibility_timeout):
+        """
+        Receives whatever messages are on a queue right now, without
+        waiting. See :py:meth:`_receive_messages`.
+        """
+        conn = cls._get_db_connection()
+        now = time.time()
+        messages = []
+
+        # Take the write lock up front so no other receiver (in this process
+        # or another) can grab the same messages between the SELECT and the
+        # UPDATE below.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT message_id, body FROM messages "
+                "WHERE queue_name = ? AND visible_at <= ? "
+                "ORDER BY message_id LIMIT ?",
+                (queue_name, now, num_to_receive)).fetchall()
+            for row in rows:
+                receipt_handle = uuid.uuid4().hex
+                # Hide the message until the visibility timeout passes.
+                conn.execute(
+                    "UPDATE messages SET visible_at = ?, receipt_handle = ? "
+                    "WHERE message_id = ?",
+                    (now + visibility_timeout, receipt_handle,
+                     row['message_id']))
+                messages.append(SQLiteMessage(cls, row['message_id'],
+                                              receipt_handle, row['body']))
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+
+        return messages
+
+    @classmethod
+    def _get_queue_length(cls, queue_name):
+        # Like SQS's ApproximateNumberOfMessages, only count visible messages.
+        row = cls._get_db_connection().execute(
+            "SELECT COUNT(*) FROM messages "
+            "WHERE queue_name = ? AND visible_at <= ?",
+            (queue_name, time.time())).fetchone()
+        return row[0]
+
+    @classmethod
+    def _clear_queue(cls, queue_name):
+        cls._get_db_connection().execute(
+            "DELETE FROM messages WHERE queue_name = ?", (queue_name,))
@@ -0,0 +1,401 @@
+"""
+Tests for the job state backends. Only the SQLite backend is tested here,
+since it doesn't require AWS.
+"""
+import os
+import time
+import datetime
+import socket
+import unittest
+import threading
+import tempfile
+from media_nommer.conf import settings
+from media_nommer.core.job_state_backend import EncodingJob, get_job_state_backend
+from media_nommer.core.job_state_backends.sqlite import SQLiteJobStateBackend
+from media_nommer.core.job_state_backends.exceptions import JobVersionConflict
+
+class SQLiteJobStateBackendTests(unittest.TestCase):
+    """
+    Tests for the SQLiteJobStateBackend class.
+    """
+    def setUp(self):
+        """
+        Point the job state backend settings at a fresh SQLite database.
+        """
+        self.old_backend = settings.JOB_STATE_BACKEND
+        self.old_db_path = settings.SQLITE_JOB_STATE_DB_PATH
+        fd, self.db_path = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(fd)
+        settings.JOB_STATE_BACKEND = 'media_nommer.core.job_state_backends.' \
+                                     'sqlite.SQLiteJobStateBackend'
+        settings.SQLITE_JOB_STATE_DB_PATH = self.db_path
+
+    def tearDown(self):
+        settings.JOB_STATE_BACKEND = self.old_backend
+        settings.SQLITE_JOB_STATE_DB_PATH = self.old_db_path
+        os.remove(self.db_path)
+
+    def _create_job(self):
+        """
+        Creates, saves, and returns a new job.
+        """
+        job = EncodingJob('file:///tmp/in.mp4', 'file:///tmp/out.mp4',
+                          'media_nommer.ec2nommerd.nommers.ffmpeg.FFmpegNommer',
+                          [{'outfile_options': [['threads', 0]]}],
+                          notify_url='http://example.com/')
+        job.save()
+        return job
+
+    def test_backend_from_settings(self):
+        """
+        The backend should be selected via the JOB_STATE_BACKEND setting.
+        """
+        self.assertEqual(get_job_state_backend(), SQLiteJobStateBackend)
+
+    def test_new_job_queue(self):
+        """
+        Saving a new job should store it and queue it up for the nommers.
+        """
+        backend = get_job_state_backend()
+        job = self._create_job()
+
+        stored_job = backend.get_job_object_from_id(job.unique_id)
+        self.assertEqual(stored_job.job_state, 'PENDING')
+        self.assertEqual(stored_job.job_options, job.job_options)
+        self.assertEqual(stored_job.creation_dtime, job.creation_dtime)
+
+        popped = backend.pop_new_jobs_from_queue(10)
+        self.assertEqual([j.unique_id for j in popped], [job.unique_id])
+        self.assertEqual(popped[0].notify_url, 'http://example.com/')
+        # Popping deletes the message.
+        self.assertEqual(backend.pop_new_jobs_from_queue(10), [])
+
+    def test_save_new_jobs(self):
+        """
+        Batch saving should store and enqueue every job, across several
+        batches.
+        """
+        backend = get_job_state_backend()
+        old_batch_sizes = (backend.JOB_ITEM_BATCH_SIZE,
+                           backend.MESSAGE_BATCH_SIZE)
+        backend.JOB_ITEM_BATCH_SIZE, backend.MESSAGE_BATCH_SIZE = 3, 2
+        try:
+            jobs = [EncodingJob('file:///tmp/in.mp4', 'file:///tmp/out%d.mp4' % i,
+                                'media_nommer.ec2nommerd.nommers.ffmpeg.FFmpegNommer',
+                                [{'outfile_options': [['threads', 0]]}])
+                    for i in range(7)]
+            self.assertEqual(backend.save_new_jobs(jobs), [None] * 7)
+        finally:
+            backend.JOB_ITEM_BATCH_SIZE, backend.MESSAGE_BATCH_SIZE = \
+                old_batch_sizes
+
+        job_ids = sorted([job.unique_id for job in jobs])
+        stored_job = backend.get_job_object_from_id(jobs[3].unique_id)
+        self.assertEqual(stored_job.dest_path, 'file:///tmp/out3.mp4')
+        self.assertEqual(stored_job.job_state, 'PENDING')
+        self.assertEqual(stored_job.version, 1)
+        popped = backend.pop_new_jobs_from_queue(10)
+        self.assertEqual(sorted([j.unique_id for j in popped]), job_ids)
+
+    def test_save_new_jobs_failures(self):
+        """
+        Jobs in a batch that blows up part way through, or that can't be
+        enqueued, should be reported as failed, rolled back, and not left
+        stored. The other batches should carry on.
+        """
+        backend = get_job_state_backend()
+        old_methods = dict([(name, backend.__dict__.get(name))
+                            for name in ['_put_new_job_items',
+                                         '_send_messages', '_send_message']])
+        put_new_job_items = backend._put_new_job_items
+        send_messages = backend._send_messages
+        send_message = backend._send_message
+        jobs = [EncodingJob('file:///tmp/in.mp4', 'file:///tmp/out%d.mp4' % i,
+                            'media_nommer.ec2nommerd.nommers.ffmpeg.FFmpegNommer',
+                            [])
+                for i in range(7)]
+        old_dtimes = [(job.last_modified_dtime, job.creation_dtime)
+                      for job in jobs]
+
+        def failing_put_new_job_items(cls, items):
+            put_new_job_items(items)
+            if jobs[3].unique_id in dict(items):
+                # Stored, but the response never made it back.
+                raise socket.error('Connection reset by peer')
+            return {}
+
+        def failing_send_messages(cls, queue_name, bodies):
+            if jobs[0].unique_id in bodies[0]:
+                raise socket.error('Connection reset by peer')
+            return send_messages(queue_name, bodies)
+
+        def failing_send_message(cls, queue_name, body, delay_seconds=0):
+            if jobs[0].unique_id in body:
+                raise socket.error('Connection reset by peer')
+            return send_message(queue_name, body, delay_seconds=delay_seconds)
+
+        backend._put_new_job_items = classmethod(failing_put_new_job_items)
+        backend._send_messages = classmethod(failing_send_messages)
+        backend._send_message = classmethod(failing_send_message)
+        old_batch_sizes = (backend.JOB_ITEM_BATCH_SIZE,
+                           backend.MESSAGE_BATCH_SIZE)
+        backend.JOB_ITEM_BATCH_SIZE, backend.MESSAGE_BATCH_SIZE = 3, 2
+        try:
+            errors = backend.save_new_jobs(jobs)
+        finally:
+            backend.JOB_ITEM_BATCH_SIZE, backend.MESSAGE_BATCH_SIZE = \
+                old_batch_sizes
+            for name, method in old_methods.items():
+                if method is None:
+                    delattr(backend, name)
+                else:
+                    setattr(backend, name, method)
+
+        failed = [0, 3, 4, 5]
+        self.assertEqual([index for index, error in enumerate(errors)
+                          if error], failed)
+        for index in [3, 4, 5]:
+            self.assertEqual(jobs[index].version, 0)
+            self.assertEqual((jobs[index].last_modified_dtime,
+                              jobs[index].creation_dtime), old_dtimes[index])
+        for index in failed:
+            self.assertRaises(Exception, backend.get_job_object_from_id,
+                              jobs[index].unique_id)
+
+        # Job 1 was in the batch that couldn't be sent, but made it on its
+        # own.
+        saved_ids = sorted([jobs[index].unique_id for index in [1, 2, 6]])
+        popped = backend.pop_new_jobs_from_queue(10)
+        self.assertEqual(sorted([j.unique_id for j in popped]), saved_ids)
+        self.assertEqual(sorted([j.unique_id for j in
+                                 backend.get_unfinished_jobs()]), saved_ids)
+
+    def test_state_changes(self):
+        """
+        State changes should be saved and announced via the state change queue.
+        Multiple changes for the same job collapse into the most recent one.
+        """
+        backend = get_job_state_backend()
+        job = self._create_job()
+        job.set_job_state('DOWNLOADING')
+        job.set_job_state('ENCODING')
+
+        self.assertEqual(backend.get_state_change_queue_backlog(), 2)
+        popped = backend.drain_state_changes_from_queue(100, num_receivers=2)
+        self.assertEqual(len(popped), 1)
+        self.assertEqual(popped[0].job_state, 'ENCODING')
+        self.assertEqual(backend.get_state_change_queue_backlog(), 0)
+
+        stored_job = backend.get_job_object_from_id(job.unique_id)
+        self.assertEqual(stored_job.job_state, 'ENCODING')
+
+    def test_state_changes_clock_skew(self):
+        """
+        Snapshots of the same job should be told apart by version, not by
+        the clocks of whichever hosts saved them. The modification time only
+        breaks ties.
+        """
+        backend = get_job_state_backend()
+        job = self._create_job()
+        job.set_job_state('DOWNLOADING')
+        job.set_job_state('ENCODING')
+        # Pretend the ENCODING save came from a node whose clock is an hour
+        # behind.
+        job.last_modified_dtime -= datetime.timedelta(hours=1)
+        newer_body = job._get_message_body()
+        backend._clear_queue(settings.SQS_JOB_STATE_CHANGE_QUEUE_NAME)
+
+        older = backend.get_job_object_from_id(job.unique_id)
+        older.job_state, older.version = 'DOWNLOADING', 2
+        older.last_modified_dtime = datetime.datetime.now()
+        for pop in [lambda: backend.pop_state_changes_from_queue(10),
+                    lambda: backend.drain_state_changes_from_queue(
+                                                    100, num_receivers=1)]:
+            backend._send_message(settings.SQS_JOB_STATE_CHANGE_QUEUE_NAME,
+                                  newer_body)
+            backend._send_message(settings.SQS_JOB_STATE_CHANGE_QUEUE_NAME,
+                                  older._get_message_body())
+            popped = pop()
+            self.assertEqual([(j.job_state, j.version) for j in popped],
+                             [('ENCODING', 3)])
+
+        # Snapshots from before versions were tracked go by time.
+        older.version = job.version = 0
+        self.assertTrue(older.get_freshness_key() > job.get_freshness_key())
+
+    def test_unfinished_jobs(self):
+        """
+        Only jobs that aren't in a finished state should be selected.
+        """
+        backend = get_job_state_backend()
+        unfinished_job = self._create_job()
+        finished_job = self._create_job()
+        finished_job.set_job_state('FINISHED')
+
+        unfinished_ids = [j.unique_id for j in backend.get_unfinished_jobs()]
+        self.assertEqual(unfinished_ids, [unfinished_job.unique_id])
+        self.assertEqual(backend.count_unfinished_jobs(), 1)
+
+    def test_iter_unfinished_jobs(self):
+        """
+        Paged and segmented iteration should yield every unfinished job
+        exactly once.
+        """
+        backend = get_job_state_backend()
+        old_page_size = backend.UNFINISHED_JOBS_PAGE_SIZE
+        backend.UNFINISHED_JOBS_PAGE_SIZE = 2
+        try:
+            job_ids = sorted([self._create_job().unique_id for i in range(7)])
+            for num_segments in [1, 3]:
+                iterated_ids = [job.unique_id for job in
+                    backend.iter_unfinished_jobs(num_segments=num_segments)]
+                self.assertEqual(sorted(iterated_ids), job_ids)
+        finally:
+            backend.UNFINISHED_JOBS_PAGE_SIZE = old_page_size
+
+    def test_visibility_timeout(self):
+        """
+        Received messages should be hidden until their visibility timeout
+        passes, then re-appear if they weren't deleted.
+        """
+        backend = get_job_state_backend()
+        backend._send_message('test_queue', 'some body')
+
+        messages = backend._receive_messages('test_queue', 10, 3600)
+        self.assertEqual([m.get_body() for m in messages], ['some body'])
+        # Hidden from other receivers.
+        self.assertEqual(backend._receive_messages('test_queue', 10, 0), [])
+
+        backend._send_message('test_queue', 'other body')
+        messages = backend._receive_messages('test_queue', 10, 0)
+        self.assertEqual([m.get_body() for m in messages], ['other body'])
+        # Not deleted and no visibility timeout, so it comes right back.
+        messages = backend._receive_messages('test_queue', 10, 0)
+        self.assertEqual([m.get_body() for m in messages], ['other body'])
+        messages[0].delete()
+        self.assertEqual(backend._receive_messages('test_queue', 10, 0), [])
+
+    def test_long_polling(self):
+        """
+        Receiving from an empty queue should wait for a message to arrive,
+        up to the wait time.
+        """
+        backend = get_job_state_backend()
+        start = time.time()
+        self.assertEqual(
+            backend._receive_messages('test_queue', 10, 0,
+                                      wait_time_seconds=0.5), [])
+        self.assertTrue(time.time() - start >= 0.5)
+
+        timer = threading.Timer(0.3, backend._send_message,
+                                ['test_queue', 'late body'])
+        timer.start()
+        start = time.time()
+        messages = backend._receive_messages('test_queue', 10, 0,
+                                             wait_time_seconds=5)
+        timer.join()
+        self.assertEqual([m.get_body() for m in messages], ['late body'])
+        self.assertTrue(time.time() - start < 5)
+
+    def test_legacy_message_body(self):
+        """
+        Messages that only carry a unique ID should fall back to loading
+        the job from storage.
+        """
+        backend = get_job_state_backend()
+        job = self._create_job()
+        backend._clear_queue(settings.SQS_NEW_JOB_QUEUE_NAME)
+        backend._send_message(settings.SQS_NEW_JOB_QUEUE_NAME, job.unique_id)
+
+        popped = backend.pop_new_jobs_from_queue(10)
+        self.assertEqual([j.unique_id for j in popped], [job.unique_id])
+
+    def test_requeue_new_job(self):
+        """
+        Requeued jobs should stay hidden for the delay, then be popped like
+        any other new job.
+        """
+        backend = get_job_state_backend()
+        job = self._create_job()
+        backend._clear_queue(settings.SQS_NEW_JOB_QUEUE_NAME)
+
+        backend.requeue_new_job(job, delay_seconds=0.3)
+        self.assertEqual(backend.pop_new_jobs_from_queue(10), [])
+        time.sleep(0.3)
+        popped = backend.pop_new_jobs_from_queue(10)
+        self.assertEqual([j.unique_id for j in popped], [job.unique_id])
+
+    def test_wipe_all_job_data(self):
+        """
+        Wiping should remove all jobs and empty the new job queue.
+        """
+        backend = get_job_state_backend()
+        self._create_job()
+        backend.wipe_all_job_data()
+
+        self.assertEqual(backend.get_unfinished_jobs(), [])
+        self.assertEqual(backend.pop_new_jobs_from_queue(10), [])
+
+    def test_partial_save(self):
+        """
+        Saves should only write changed attributes, and bump the version.
+        """
+        backend = get_job_state_backend()
+        job = self._create_job()
+        self.assertEqual(job.version, 1)
+        # Change something behind the job's back that it doesn't touch.
+        backend._get_db_connection().execute(
+            "UPDATE jobs SET notify_url = 'http://example.org/' "
+            "WHERE unique_id = ?", (job.unique_id,))
+        job.set_job_state('DOWNLOADING')
+        self.assertEqual(job.version, 2)
+
+        stored_job = backend.get_job_object_from_id(job.unique_id)
+        self.assertEqual(stored_job.job_state, 'DOWNLOADING')
+        self.assertEqual(stored_job.notify_url, 'http://example.org/')
+        self.assertEqual(stored_job.version, 2)
+
+    def test_failed_save(self):
+        """
+        A save that fails for some other reason than a conflict shouldn't
+        leave the job a version ahead, so the next save goes through.
+        """
+        backend = get_job_state_backend()
+        job = self._create_job()
+        old_put_job_item = backend.__dict__['_put_job_item']
+
+        def failing_put_job_item(cls, unique_id, attributes, expected_version):
+            # Only fail the once.
+            backend._put_job_item = old_put_job_item
+            raise IOError('Transient error.')
+
+        backend._put_job_item = classmethod(failing_put_job_item)
+        try:
+            self.assertRaises(IOError, job.set_job_state, 'ENCODING')
+        finally:
+            backend._put_job_item = old_put_job_item
+        self.assertEqual(job.version, 1)
+
+        job.set_job_state('ERROR', details='Out of cheese.')
+        stored_job = backend.get_job_object_from_id(job.unique_id)
+        self.assertEqual(stored_job.job_state, 'ERROR')
+        self.assertEqual(stored_job.version, 2)
+
+    def test_version_conflict(self):
+        """
+        Saving a stale copy of a job should fail rather than clobber the
+        newer one.
+        """
+        backend = get_job_state_backend()
+        job = self._create_job()
+        stale_job = backend.get_job_object_from_id(job.unique_id)
+        job.set_job_state('ENCODING')
+
+        self.assertRaises(JobVersionConflict, stale_job.set_job_state,
+                          'ABANDONED')
+        stored_job = backend.get_job_object_from_id(job.unique_id)
+        self.assertEqual(stored_job.job_state, 'ENCODING')
+
+        # A freshly loaded copy saves just fine.
+        stored_job.set_job_state('FINISHED')
+        self.assertEqual(stored_job.version, 3)
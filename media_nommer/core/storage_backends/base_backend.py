@@ -27,4 +27,17 @@ class BaseStorageBackend(object):
         :returns: Return value and type depends on backend.
         """
         msg = "Backend doesn't implement upload_file()"
-        raise NotImplementedError(msg)
\ No newline at end of file
+        raise NotImplementedError(msg)
+
+    @classmethod
+    def get_file_size(cls, uri):
+        """
+        Given a URI, find out how big the file is without downloading it.
+        Backends that can't tell don't have to override this.
+
+        :param str uri: The URI of a file.
+        :rtype: int or ``None``
+        :returns: The file's size (in bytes), or ``None`` if it can't be
+            determined.
+        """
+        return None
\ No newline at end of file
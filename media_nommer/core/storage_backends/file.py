@@ -41,6 +41,21 @@ class FileBackend(BaseStorageBackend):
         
         return fobj
 
+    @classmethod
+    def get_file_size(cls, uri):
+        """
+        Given a URI, find out how big the local file is.
+
+        :param str uri: The URI of a file.
+        :rtype: int or ``None``
+        :returns: The file's size (in bytes), or ``None`` if it doesn't
+            exist.
+        """
+        infile_path = cls._get_path_from_uri(uri)
+        if not os.path.exists(infile_path):
+            return None
+        return os.path.getsize(infile_path)
+
     @classmethod
     def upload_file(cls, uri, fobj):
         """
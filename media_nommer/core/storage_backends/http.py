@@ -2,6 +2,8 @@
 This module contains an HTTPBackend class for working with URIs that have
 an http:// or https:// protocol specified.
 """
+import socket
+import httplib
 import urllib2
 from media_nommer.utils import logger
 from media_nommer.core.storage_backends.exceptions import InfileNotFoundException
@@ -14,6 +16,10 @@ class HTTPBackend(BaseStorageBackend):
     .. note:: ``upload_file`` is not implemented yet, not sure how
         it should work.
     """
+    # How long (in seconds) to wait on the server when sizing up a file.
+    # Jobs aren't pulled while this is going on.
+    SIZE_LOOKUP_TIMEOUT = 10
+
     @classmethod
     def download_file(cls, uri, fobj):
         """
@@ -37,3 +43,35 @@ class HTTPBackend(BaseStorageBackend):
         logger.debug("HTTPBackend.download_file(): " \
                      "Download of %s completed." % uri)
         return fobj
+
+    @classmethod
+    def get_file_size(cls, uri):
+        """
+        Given a URI, find out how big the file is from the
+        ``Content-Length`` of a ``HEAD`` request.
+
+        :param str uri: The URI of a file.
+        :rtype: int or ``None``
+        :returns: The file's size (in bytes), or ``None`` if the server
+            doesn't say, or doesn't answer within
+            :py:attr:`SIZE_LOOKUP_TIMEOUT` seconds.
+        """
+        request = urllib2.Request(uri)
+        request.get_method = lambda: 'HEAD'
+
+        try:
+            response = urllib2.urlopen(request,
+                                       timeout=cls.SIZE_LOOKUP_TIMEOUT)
+            try:
+                content_length = response.info().getheader('Content-Length')
+            finally:
+                response.close()
+        except (urllib2.URLError, socket.error, httplib.HTTPException), e:
+            # socket.timeout is a socket.error.
+            logger.debug("HTTPBackend.get_file_size(): " \
+                         "Unable to size up %s: %s" % (uri, e))
+            return None
+
+        if not content_length or not content_length.isdigit():
+            return None
+        return int(content_length)
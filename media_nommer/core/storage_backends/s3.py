@@ -60,6 +60,26 @@ class S3Backend(BaseStorageBackend):
                      "Download of %s completed." % uri)
         return fobj
 
+    @classmethod
+    def get_file_size(cls, uri):
+        """
+        Given a URI, find out how big the file is without downloading it.
+
+        :param str uri: The URI of a file.
+        :rtype: int or ``None``
+        :returns: The key's size (in bytes), or ``None`` if it can't be
+            found.
+        """
+        values = get_values_from_media_uri(uri)
+
+        conn = cls._get_aws_s3_connection(values['username'],
+                                          values['password'])
+        bucket = conn.get_bucket(values['host'])
+        key = bucket.get_key(values['path'])
+        if key is None:
+            return None
+        return key.size
+
     @classmethod
     def upload_file(cls, uri, fobj):
         """
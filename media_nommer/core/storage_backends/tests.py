@@ -2,6 +2,8 @@
 Tests for the storage backends and support classes.
 """
 import os
+import time
+import socket
 import unittest2
 import tempfile
 from media_nommer.core.storage_backends.s3 import S3Backend
@@ -23,6 +25,26 @@ class HTTPBackendTests(unittest2.TestCase):
         storage.download_file(file_uri, fobj)
         self.assertEqual(os.path.getsize(fobj.name), 6909952)
 
+    def test_file_size_timeout(self):
+        """
+        A server that never answers shouldn't hold up sizing up a file.
+        """
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        # Connections are accepted, but nothing is ever sent back.
+        server.listen(1)
+        old_timeout = HTTPBackend.SIZE_LOOKUP_TIMEOUT
+        HTTPBackend.SIZE_LOOKUP_TIMEOUT = 0.5
+        try:
+            start = time.time()
+            size = HTTPBackend.get_file_size(
+                'http://127.0.0.1:%d/in.mp4' % server.getsockname()[1])
+        finally:
+            HTTPBackend.SIZE_LOOKUP_TIMEOUT = old_timeout
+            server.close()
+        self.assertEqual(size, None)
+        self.assertTrue(time.time() - start < 5)
+
 
 class S3BackendTests(unittest2.TestCase):
     """
@@ -0,0 +1,109 @@
+"""
+Contains the :py:class:`CPUAllocator` class, which splits this node's CPU
+cores between the jobs it's encoding.
+"""
+import threading
+from distutils.spawn import find_executable
+from media_nommer.conf import settings
+from media_nommer.utils import logger
+from media_nommer.ec2nommerd.resource_monitor import ResourceMonitor
+
+class CPUAllocator(object):
+    """
+    Hands each encoding job its share of the node's cores: the number of
+    cores divided by the number of slots. Encoders are pinned to their
+    share with taskset_ (see
+    :py:data:`NOMMERD_PIN_CPUS <media_nommer.conf.settings.NOMMERD_PIN_CPUS>`),
+    and told to run a thread per core, rather than each starting a thread
+    for every core on the node and fighting over them.
+
+    If there are more slots than cores, jobs share the least busy cores.
+
+    .. _taskset: http://man7.org/linux/man-pages/man1/taskset.1.html
+    """
+    # Maps the unique IDs of the jobs holding cores to lists of core numbers.
+    ASSIGNED = {}
+    # ASSIGNED is updated from the encoding threads.
+    LOCK = threading.Lock()
+    # The full path to taskset, once looked up. Do not refer to directly,
+    # use get_pinning_prefix().
+    __taskset_path = None
+
+    @classmethod
+    def get_cores_per_job(cls, num_slots):
+        """
+        :param int num_slots: How many slots this node has.
+        :rtype: int
+        :returns: How many cores each job gets.
+        """
+        return max(1, ResourceMonitor.get_num_cpus() // max(1, num_slots))
+
+    @classmethod
+    def acquire(cls, job, num_slots):
+        """
+        Assigns cores to a job. Call :py:meth:`release` once it's done.
+
+        :param EncodingJob job: The job to assign cores to.
+        :param int num_slots: How many slots this node has.
+        :rtype: list
+        :returns: The core numbers the job may use.
+        """
+        num_cpus = ResourceMonitor.get_num_cpus()
+        num_cores = cls.get_cores_per_job(num_slots)
+
+        cls.LOCK.acquire()
+        try:
+            usage = dict([(core, 0) for core in range(num_cpus)])
+            for cores in cls.ASSIGNED.values():
+                for core in cores:
+                    usage[core] = usage.get(core, 0) + 1
+            # Least busy first, then in order, so free cores are handed out
+            # next to each other.
+            by_usage = sorted(usage.keys(),
+                              key=lambda core: (usage[core], core))
+            cores = sorted(by_usage[:num_cores])
+            cls.ASSIGNED[job.unique_id] = cores
+        finally:
+            cls.LOCK.release()
+
+        logger.debug("CPUAllocator.acquire(): " \
+                     "Job %s gets cores %s" % (job.unique_id, cores))
+        return cores
+
+    @classmethod
+    def release(cls, job):
+        """
+        Frees up a job's cores. Harmless if it doesn't have any.
+
+        :param EncodingJob job: The job whose cores to free.
+        """
+        cls.LOCK.acquire()
+        try:
+            cls.ASSIGNED.pop(job.unique_id, None)
+        finally:
+            cls.LOCK.release()
+
+    @classmethod
+    def get_pinning_prefix(cls, cores):
+        """
+        :param list cores: The core numbers to pin a process to.
+        :rtype: list
+        :returns: The arguments to put in front of a command to pin it to
+            ``cores``. Empty if pinning is turned off, or taskset can't be
+            found.
+        """
+        if not settings.NOMMERD_PIN_CPUS or not cores:
+            return []
+
+        if cls.__taskset_path is None:
+            cls.__taskset_path = find_executable(
+                                    settings.NOMMERD_TASKSET_BIN_PATH) or ''
+            if not cls.__taskset_path:
+                logger.warning("CPUAllocator.get_pinning_prefix(): " \
+                               "Can't find %s, not pinning encoders." % (
+                                    settings.NOMMERD_TASKSET_BIN_PATH))
+        if not cls.__taskset_path:
+            return []
+
+        return [cls.__taskset_path, '-c',
+                ','.join([str(core) for core in cores])]
@@ -10,50 +10,42 @@ the interesting bits that actually do things.
 from twisted.internet import task, reactor
 from media_nommer.conf import settings
 from media_nommer.utils import logger
-from media_nommer.core.job_state_backend import JobStateBackend
 from media_nommer.ec2nommerd.node_state import NodeStateManager
+from media_nommer.ec2nommerd.slot_manager import SlotManager
+from media_nommer.ec2nommerd.job_puller import JobPuller
+from media_nommer.ec2nommerd.worker_pools import call_in_control_pool, \
+    get_worker_pool_stats
 
 def threaded_encode_job(job):
     """
-    Given a job, run it through its encoding workflow in a non-blocking manner.
+    Given a job, run it through its encoding workflow. Runs in the encoding
+    pool (see :py:mod:`media_nommer.ec2nommerd.worker_pools`).
+    The job's slot (see :py:class:`SlotManager <media_nommer.ec2nommerd.slot_manager.SlotManager>`)
+    is freed up once it's done, one way or another, and another job is
+    pulled to fill it right away.
     """
     # Update the timestamp for when the node last did something so it
     # won't terminate itself.
     NodeStateManager.i_did_something()
-    job.nommer.onomnom()
+    try:
+        job.nommer.onomnom()
+    finally:
+        SlotManager.release(job)
+        NodeStateManager.i_did_something()
+        reactor.callFromThread(JobPuller.request_pull, reset_backoff=True)
 
 def task_check_for_new_jobs():
     """
-    Looks at the number of currently active threads and compares it against the 
-    :py:data:`MAX_ENCODING_JOBS_PER_EC2_INSTANCE <media_nommer.conf.settings.MAX_ENCODING_JOBS_PER_EC2_INSTANCE>` 
-    setting. If we are under the max, fire up another thread for encoding 
-    additional job(s). 
-    
-    The interval at which :doc:`../ec2nommerd` checks for new jobs is 
-    determined by the 
+    Makes sure this node is pulling jobs if it has free slots. Jobs are
+    normally pulled as soon as slots free up (see
+    :py:class:`JobPuller <media_nommer.ec2nommerd.job_puller.JobPuller>`),
+    so this is mostly a safety net.
+
+    The interval at which this runs is determined by the
     :py:data:`NOMMERD_NEW_JOB_CHECK_INTERVAL <media_nommer.conf.settings.NOMMERD_NEW_JOB_CHECK_INTERVAL>`
     setting.
-    
-    Calls :py:func:`threaded_encode_job` for any jobs to encode.
     """
-    num_active_threads = NodeStateManager.get_num_active_threads()
-    max_threads = settings.MAX_ENCODING_JOBS_PER_EC2_INSTANCE
-    num_jobs_to_pop = max(0, max_threads - num_active_threads)
-
-    if num_jobs_to_pop > 0:
-        # We have more room for encoding threads, determine how many.
-        logger.debug("task_check_for_new_jobs: " \
-                     "Popping up to %d new jobs." % num_jobs_to_pop)
-        # This is an iterable of BaseEncodingJob sub-classed instances for
-        # each job returned from the queue.
-        jobs = JobStateBackend.pop_new_jobs_from_queue(num_jobs_to_pop)
-        if jobs:
-            logger.debug("* Popped %d jobs from the queue." % len(jobs))
-
-        for job in jobs:
-            # For each job returned, render in another thread.
-            logger.debug("* Starting encoder thread for job: %s" % job.unique_id)
-            reactor.callInThread(threaded_encode_job, job)
+    JobPuller.request_pull()
 
 def threaded_heartbeat():
     """
@@ -64,24 +56,60 @@ def threaded_heartbeat():
     The interval at which heartbeats occur is determined by the
     :py:data:`NOMMERD_HEARTBEAT_INTERVAL <media_nommer.conf.settings.NOMMERD_HEARTBEAT_INTERVAL` 
     setting.
+
+    If :doc:`../feederd` manages scale-in (see the
+    :py:data:`FEEDERD_MANAGE_SCALE_IN <media_nommer.conf.settings.FEEDERD_MANAGE_SCALE_IN>`
+    setting), the heartbeat also picks up drain requests, and reports
+    ``DRAINED`` once no jobs are running. Heartbeats stop once feederd marks
+    this instance ``TERMINATED``.
     """
+    if NodeStateManager.is_terminated:
+        return
+
+    if settings.FEEDERD_MANAGE_SCALE_IN:
+        # feederd decides when to terminate us, but just in case feederd is
+        # down (its lease on us has gone stale), don't sit idle forever.
+        max_inactivity = settings.NOMMERD_FALLBACK_MAX_INACTIVITY
+    else:
+        max_inactivity = settings.NOMMERD_MAX_INACTIVITY
+
     if settings.NOMMERD_TERMINATE_WHEN_IDLE:
-        # thread_count_mod factors out this thread when counting active threads.
-        is_terminated = NodeStateManager.contemplate_termination(thread_count_mod= -1)
+        is_terminated = NodeStateManager.contemplate_termination(
+                        max_inactivity=max_inactivity,
+                        require_stale_lease=settings.FEEDERD_MANAGE_SCALE_IN)
     else:
         is_terminated = False
 
     if not is_terminated:
-        NodeStateManager.send_instance_state_update()
+        state = 'ACTIVE'
+        was_draining = NodeStateManager.is_draining
+        if settings.FEEDERD_MANAGE_SCALE_IN and \
+           NodeStateManager.check_drain_request():
+            # Let feederd know once we're safe to terminate. Wait a heartbeat
+            # after the drain request, in case a job was being popped from
+            # the queue as it came in.
+            if was_draining and SlotManager.get_num_occupied() == 0:
+                state = 'DRAINED'
+            else:
+                state = 'DRAINING'
+        elif was_draining:
+            # Back to work.
+            reactor.callFromThread(JobPuller.request_pull, reset_backoff=True)
+        pool_stats = get_worker_pool_stats()
+        logger.debug("threaded_heartbeat(): Thread pools: %s" % pool_stats)
+        NodeStateManager.send_instance_state_update(state=state,
+                                                    pool_stats=pool_stats)
 
 def task_heartbeat():
     """
     Checks in with feederd in a non-blocking manner via 
-    :py:meth:`threaded_heartbeat`.
+    :py:meth:`threaded_heartbeat`. This runs in the control pool (see
+    :py:mod:`media_nommer.ec2nommerd.worker_pools`), so it isn't held up by
+    encoding jobs.
     
     Calls :py:func:`threaded_heartbeat`.
     """
-    reactor.callInThread(threaded_heartbeat)
+    call_in_control_pool(threaded_heartbeat)
 
 def register_tasks():
     """
@@ -0,0 +1,197 @@
+"""
+Contains the :py:class:`JobPuller` class, which pulls new jobs from the
+queue whenever this node has free slots.
+"""
+from twisted.internet import reactor
+from media_nommer.conf import settings
+from media_nommer.utils import logger
+from media_nommer.core.job_state_backend import get_job_state_backend
+from media_nommer.ec2nommerd.node_state import NodeStateManager
+from media_nommer.ec2nommerd.slot_manager import SlotManager
+from media_nommer.ec2nommerd.resource_monitor import ResourceMonitor
+from media_nommer.ec2nommerd.worker_pools import call_in_encoding_pool, \
+    call_in_control_pool
+
+class JobPuller(object):
+    """
+    Pulls new jobs from the queue as soon as there are free slots to run
+    them in, rather than on a fixed schedule.
+
+    * A pull is started when a job finishes, and right after a pull that
+      found jobs, as long as slots are free.
+    * Pulls long poll the queue for up to
+      :py:data:`NOMMERD_NEW_JOB_WAIT_TIME <media_nommer.conf.settings.NOMMERD_NEW_JOB_WAIT_TIME>`
+      seconds, so new jobs are picked up within seconds of being submitted.
+    * After each pull that comes up empty, the next waits a while longer,
+      starting at
+      :py:data:`NOMMERD_NEW_JOB_BACKOFF_MIN <media_nommer.conf.settings.NOMMERD_NEW_JOB_BACKOFF_MIN>`
+      seconds and doubling up to
+      :py:data:`NOMMERD_NEW_JOB_BACKOFF_MAX <media_nommer.conf.settings.NOMMERD_NEW_JOB_BACKOFF_MAX>`,
+      so an idle node doesn't call SQS_ any more often than it used to.
+    * Free slots are only filled as far as the node's CPU, memory and temp
+      disk space allow (see
+      :py:class:`ResourceMonitor <media_nommer.ec2nommerd.resource_monitor.ResourceMonitor>`).
+      Popped jobs that turn out not to fit are put back on the queue for
+      another node.
+
+    Only one pull is in progress at a time. Everything except
+    :py:meth:`threaded_pull` must be called from the reactor thread.
+    """
+    # True while a pull is in progress.
+    is_pulling = False
+    # The number of pulls in a row that came up empty.
+    num_empty_pulls = 0
+    # The delayed call for the next pull after an empty one, if any.
+    _next_pull_call = None
+
+    @classmethod
+    def get_backoff(cls):
+        """
+        :rtype: float
+        :returns: How long (in seconds) to wait before the next pull, going
+            by how many empty pulls there have been in a row.
+        """
+        if cls.num_empty_pulls == 0:
+            return 0
+        backoff = settings.NOMMERD_NEW_JOB_BACKOFF_MIN * \
+                  2 ** (cls.num_empty_pulls - 1)
+        return min(backoff, settings.NOMMERD_NEW_JOB_BACKOFF_MAX)
+
+    @classmethod
+    def request_pull(cls, reset_backoff=False):
+        """
+        Starts a pull in the control pool (see
+        :py:mod:`media_nommer.ec2nommerd.worker_pools`), unless one is
+        already in progress, there are no free slots, or the node is
+        draining or has been terminated. If there are free slots, but not the resources to fill
+        them, another try is scheduled.
+
+        :keyword bool reset_backoff: If ``True``, pull right away, even if
+            the last pulls came up empty. Used when a slot frees up.
+        """
+        if reset_backoff:
+            cls.num_empty_pulls = 0
+            cls._cancel_next_pull()
+        if cls.is_pulling or NodeStateManager.is_draining or \
+           NodeStateManager.is_terminated:
+            return
+        if cls._next_pull_call is not None:
+            # Backing off, the scheduled pull will get to it.
+            return
+        num_free = SlotManager.get_num_free(NodeStateManager.get_num_slots())
+        if num_free == 0:
+            return
+        num_to_pop = ResourceMonitor.get_num_to_pull(num_free)
+        if num_to_pop == 0:
+            # Check again once running jobs have had a chance to get further
+            # along, or sooner if one finishes.
+            cls._next_pull_call = reactor.callLater(
+                                        settings.NOMMERD_NEW_JOB_BACKOFF_MAX,
+                                        cls._backoff_done)
+            return
+
+        cls.is_pulling = True
+        call_in_control_pool(cls.threaded_pull, min(num_to_pop, 10))
+
+    @classmethod
+    def threaded_pull(cls, num_to_pop):
+        """
+        Pops up to ``num_to_pop`` jobs (long polling if the queue is empty),
+        and starts encoding the ones this node has the resources for. The
+        rest are put back on the queue. Runs outside the reactor thread.
+
+        :param int num_to_pop: The most jobs to pop.
+        """
+        try:
+            jobs = get_job_state_backend().pop_new_jobs_from_queue(
+                num_to_pop,
+                wait_time_seconds=settings.NOMMERD_NEW_JOB_WAIT_TIME)
+        except Exception:
+            logger.error("JobPuller.threaded_pull(): " \
+                         "Unable to pop new jobs.")
+            logger.error()
+            jobs = []
+
+        if jobs:
+            logger.debug("JobPuller.threaded_pull(): " \
+                         "Popped %d jobs from the queue." % len(jobs))
+        admitted = []
+        for job in jobs:
+            # The slot is taken now, rather than once the encoding thread
+            # gets going, so the next pull doesn't pop too many.
+            if ResourceMonitor.admit(job) or not cls._requeue(job):
+                admitted.append(job)
+        reactor.callFromThread(cls._pull_done, admitted)
+
+    @classmethod
+    def _requeue(cls, job):
+        """
+        Puts a job this node doesn't have the resources for back on the
+        queue. It stays hidden for
+        :py:data:`NOMMERD_REQUEUE_DELAY <media_nommer.conf.settings.NOMMERD_REQUEUE_DELAY>`
+        seconds, giving other nodes a shot at it.
+
+        :param EncodingJob job: The job to put back.
+        :rtype: bool
+        :returns: ``True`` if the job was put back. If not, it's been put in
+            a slot anyway, rather than lost.
+        """
+        try:
+            get_job_state_backend().requeue_new_job(
+                job, delay_seconds=settings.NOMMERD_REQUEUE_DELAY)
+        except Exception:
+            logger.error("JobPuller._requeue(): " \
+                         "Unable to requeue job %s, running it anyway." % (
+                            job.unique_id))
+            logger.error()
+            SlotManager.occupy(job)
+            return False
+
+        logger.info("JobPuller._requeue(): " \
+                    "Put job %s back on the queue." % job.unique_id)
+        return True
+
+    @classmethod
+    def _pull_done(cls, jobs):
+        """
+        Starts each popped job in the encoding pool, and schedules the next
+        pull.
+
+        :param list jobs: The jobs that were popped.
+        """
+        # Imported here, since interval_tasks imports this module.
+        from media_nommer.ec2nommerd.interval_tasks import threaded_encode_job
+
+        cls.is_pulling = False
+        for job in jobs:
+            logger.debug("JobPuller._pull_done(): " \
+                         "Starting encoder thread for job: %s" % job.unique_id)
+            call_in_encoding_pool(threaded_encode_job, job)
+
+        if jobs:
+            cls.num_empty_pulls = 0
+            # There may be more where those came from.
+            cls.request_pull()
+        else:
+            cls.num_empty_pulls += 1
+            cls._cancel_next_pull()
+            cls._next_pull_call = reactor.callLater(cls.get_backoff(),
+                                                    cls._backoff_done)
+
+    @classmethod
+    def _backoff_done(cls):
+        """
+        Pulls again once the wait after an empty pull is over.
+        """
+        cls._next_pull_call = None
+        cls.request_pull()
+
+    @classmethod
+    def _cancel_next_pull(cls):
+        """
+        Cancels the scheduled pull after an empty one, if there is one.
+        """
+        if cls._next_pull_call is not None:
+            if cls._next_pull_call.active():
+                cls._next_pull_call.cancel()
+            cls._next_pull_call = None
@@ -5,10 +5,13 @@ for storing and communicating the status of EC2_ nodes.
 import urllib2
 import datetime
 import boto
-from twisted.internet import reactor
+from boto.exception import SDBResponseError
 from media_nommer.conf import settings
 from media_nommer.utils import logger
 from media_nommer.utils.compat import total_seconds
+from media_nommer.core import instance_types
+from media_nommer.ec2nommerd.slot_manager import SlotManager
+from media_nommer.ec2nommerd.resource_monitor import ResourceMonitor
 
 class NodeStateManager(object):
     """
@@ -16,6 +19,15 @@ class NodeStateManager(object):
     itself if certain conditions of inactivity are met.
     """
     last_dtime_i_did_something = datetime.datetime.now()
+    # When feederd manages scale-in, it asks nodes to drain (stop taking new
+    # jobs) before terminating them.
+    is_draining = False
+    # Set once feederd has marked this instance TERMINATED. No more
+    # heartbeats are sent after that, so they can't overwrite the state.
+    is_terminated = False
+    # When (by this node's clock) feederd's lease on this instance was last
+    # seen to change. See EC2InstanceManager.renew_node_leases().
+    last_dtime_feederd_seen = datetime.datetime.now()
 
     # Used for lazy-loading the SDB connection. Do not refer to directly.
     __aws_sdb_connection = None
@@ -25,6 +37,14 @@ class NodeStateManager(object):
     __aws_ec2_connection = None
     # Store the instance ID for this EC2 node (if not local).
     __instance_id = None
+    # Store the instance type for this EC2 node.
+    __instance_type = None
+    # The state attribute this node expects to find in its SimpleDB item:
+    # what it last reported, or False if there isn't one yet. None until
+    # the item has been looked at.
+    __expected_state = None
+    # The last feederd_seen_dtime value found in this node's SimpleDB item.
+    __feederd_lease = None
 
     @classmethod
     def _aws_ec2_connection(cls):
@@ -89,6 +109,44 @@ class NodeStateManager(object):
 
         return cls.__instance_id
 
+    @classmethod
+    def get_instance_type(cls):
+        """
+        Determine this EC2 instance's type. Lazy load this, and avoid further
+        re-queries after the first one.
+
+        :rtype: str
+        :returns: The EC2 instance's type, or
+            :py:data:`EC2_INSTANCE_TYPE <media_nommer.conf.settings.EC2_INSTANCE_TYPE>`
+            if this isn't an EC2 instance.
+        """
+        if not cls.__instance_type:
+            if cls.is_ec2_instance():
+                aws_meta_url = 'http://169.254.169.254/latest/meta-data/instance-type'
+                response = urllib2.urlopen(aws_meta_url)
+                cls.__instance_type = response.read()
+            else:
+                cls.__instance_type = settings.EC2_INSTANCE_TYPE
+
+        return cls.__instance_type
+
+    @classmethod
+    def get_num_slots(cls):
+        """
+        :rtype: int
+        :returns: How many jobs this instance should run at once, going by
+            its type's entry in
+            :py:data:`EC2_INSTANCE_TYPES <media_nommer.conf.settings.EC2_INSTANCE_TYPES>`.
+            If :py:data:`NOMMERD_CORES_PER_JOB <media_nommer.conf.settings.NOMMERD_CORES_PER_JOB>`
+            is set, nodes with enough cores get more slots than that.
+        """
+        num_slots = instance_types.get_slots(cls.get_instance_type())
+        if settings.NOMMERD_CORES_PER_JOB:
+            num_cores = ResourceMonitor.get_num_cpus()
+            num_slots = max(num_slots,
+                            num_cores // settings.NOMMERD_CORES_PER_JOB)
+        return num_slots
+
     @classmethod
     def is_ec2_instance(cls):
         """
@@ -100,34 +158,153 @@ class NodeStateManager(object):
         return cls.get_instance_id() != 'local-dev'
 
     @classmethod
-    def send_instance_state_update(cls, state='ACTIVE'):
+    def send_instance_state_update(cls, state='ACTIVE', pool_stats=None):
         """
         Sends a status update to feederd through SimpleDB. Lets the daemon
         know how many jobs this instance is crunching right now. Also updates
         a timestamp field to let feederd know how long it has been since the
-        instance's last check-in.
+        instance's last check-in. The instance's type and number of job
+        slots are included, so feederd can keep track of capacity, along
+        with how many jobs are in each of the
+        :py:attr:`SlotManager.STAGES <media_nommer.ec2nommerd.slot_manager.SlotManager.STAGES>`.
         
         :keyword str state: If this EC2_ instance is anything but ``ACTIVE``,
             pass the state here. This is useful during node termination.
+        :keyword dict pool_stats: Thread pool stats to report, as per
+            :py:func:`get_worker_pool_stats <media_nommer.ec2nommerd.worker_pools.get_worker_pool_stats>`.
+            Each pool's busy thread and queued call counts are reported as
+            ``<pool>_pool_busy`` and ``<pool>_pool_queued``.
+        :rtype: bool
+        :returns: ``True`` if the update was sent. ``False`` if this isn't
+            an EC2 instance, or :doc:`../feederd` has marked it
+            ``TERMINATED`` (see :py:attr:`is_terminated`).
+
+        The update is only written if the item's ``state`` is still what this
+        instance last reported, so a late heartbeat can't overwrite the
+        ``TERMINATED`` state that feederd writes.
+        """
+        if not cls.is_ec2_instance() or cls.is_terminated:
+            return False
+
+        instance_id = cls.get_instance_id()
+        domain = cls._aws_sdb_nommer_state_domain()
+        if cls.__expected_state is None:
+            cls._update_from_item(
+                domain.get_item(instance_id, consistent_read=True))
+            if cls.is_terminated:
+                return False
+
+        attributes = {
+            'id': instance_id,
+            'active_jobs': SlotManager.get_num_occupied(),
+            'idle_seconds': int(cls.get_idle_seconds()),
+            'instance_type': cls.get_instance_type(),
+            'slots': cls.get_num_slots(),
+            'last_report_dtime': datetime.datetime.now(),
+            'state': state,
+        }
+        for stage, count in SlotManager.get_stage_counts().items():
+            attributes['%s_jobs' % stage.lower()] = count
+        for name, stats in (pool_stats or {}).items():
+            attributes['%s_pool_busy' % name] = stats['busy']
+            attributes['%s_pool_queued' % name] = stats['queued']
+
+        try:
+            domain.put_attributes(instance_id, attributes, replace=True,
+                            expected_value=['state', cls.__expected_state])
+        except SDBResponseError, e:
+            if e.error_code != 'ConditionalCheckFailed':
+                raise
+            # Someone else changed our state. Find out what to expect next
+            # time, and whether it's time to stop.
+            logger.info("NodeStateManager.send_instance_state_update(): " \
+                        "State changed by someone else, not sending.")
+            cls._update_from_item(
+                domain.get_item(instance_id, consistent_read=True))
+            return False
+        cls.__expected_state = state
+        return True
+
+    @classmethod
+    def _update_from_item(cls, item):
+        """
+        Picks up the state in this instance's SimpleDB item, and notes
+        whether :doc:`../feederd` has marked it ``TERMINATED``, or renewed
+        its lease (see :py:attr:`last_dtime_feederd_seen`).
+
+        :param item: This instance's boto SimpleDB item, or ``None`` if it
+            doesn't have one yet.
+        """
+        lease = item and item.get('feederd_seen_dtime')
+        if lease and lease != cls.__feederd_lease:
+            # Only compared for changes, so feederd's clock doesn't need to
+            # agree with ours.
+            cls.__feederd_lease = lease
+            cls.last_dtime_feederd_seen = datetime.datetime.now()
+
+        cls.__expected_state = item and item.get('state') or False
+        if cls.__expected_state == 'TERMINATED' and not cls.is_terminated:
+            logger.info("NodeStateManager._update_from_item(): " \
+                        "Marked as terminated, no more heartbeats.")
+            cls.is_terminated = True
+
+    @classmethod
+    def check_drain_request(cls):
+        """
+        Looks in this instance's entry in the
+        :py:data:`SIMPLEDB_EC2_NOMMER_STATE_DOMAIN <media_nommer.conf.settings.SIMPLEDB_EC2_NOMMER_STATE_DOMAIN>`
+        to see whether :doc:`../feederd` wants it to drain, and updates
+        :py:attr:`is_draining` to match. Also notices if feederd has marked
+        it ``TERMINATED`` (see :py:attr:`is_terminated`).
+
+        :rtype: bool
+        :returns: ``True`` if this instance should drain.
         """
         if cls.is_ec2_instance():
-            instance_id = cls.get_instance_id()
-            item = cls._aws_sdb_nommer_state_domain().new_item(instance_id)
-            item['id'] = instance_id
-            item['active_jobs'] = cls.get_num_active_threads() - 1
-            item['last_report_dtime'] = datetime.datetime.now()
-            item['state'] = state
-            item.save()
+            item = cls._aws_sdb_nommer_state_domain().get_item(
+                cls.get_instance_id(), consistent_read=True)
+            cls._update_from_item(item)
+            is_draining = bool(item) and item.get('drain') == '1'
+            if is_draining != cls.is_draining:
+                logger.info("NodeStateManager.check_drain_request(): " \
+                            "Draining: %s" % is_draining)
+            cls.is_draining = is_draining
+        return cls.is_draining
+
+    @classmethod
+    def get_idle_seconds(cls):
+        """
+        :rtype: float
+        :returns: How many seconds it's been since this node last did
+            something.
+        """
+        tdelt = datetime.datetime.now() - cls.last_dtime_i_did_something
+        return total_seconds(tdelt)
 
     @classmethod
-    def contemplate_termination(cls, thread_count_mod=0):
+    def get_seconds_since_feederd_seen(cls):
+        """
+        :rtype: float
+        :returns: How many seconds it's been since :doc:`../feederd` was
+            last seen renewing this node's lease.
+        """
+        tdelt = datetime.datetime.now() - cls.last_dtime_feederd_seen
+        return total_seconds(tdelt)
+
+    @classmethod
+    def contemplate_termination(cls, max_inactivity=None,
+                                require_stale_lease=False):
         """
         Looks at how long it's been since this worker has done something, and
         decides whether to self-terminate.
         
-        :param int thread_count_mod: Add this to the amount returned by the call
-            to :py:meth:`get_num_active_threads`. This is useful when calling
-            this method from a non-encoder thread.
+        :keyword int max_inactivity: Terminate after this many seconds of
+            inactivity. Defaults to
+            :py:data:`NOMMERD_MAX_INACTIVITY <media_nommer.conf.settings.NOMMERD_MAX_INACTIVITY>`.
+        :keyword bool require_stale_lease: If ``True``, only terminate if
+            :doc:`../feederd` hasn't renewed this node's lease for
+            ``max_inactivity`` seconds either. Used when feederd manages
+            scale-in, so it alone decides which idle nodes to keep.
         :rtype: bool
         :returns: ``True`` if this instance terminated itself, ``False``
             if not.
@@ -136,22 +313,25 @@ class NodeStateManager(object):
             # Developing locally, don't go here.
             return False
 
-        # This is -1 since this is also a thread doing the contemplation.
-        # This would always be 1, even if we had no jobs encoding, if we
-        # didn't take into account this thread.
-        num_active_threads = cls.get_num_active_threads() + thread_count_mod
-
-        if num_active_threads > 0:
+        if SlotManager.get_num_occupied() > 0:
             # Encoding right now, don't terminate.
             return False
 
-        tdelt = datetime.datetime.now() - cls.last_dtime_i_did_something
+        if max_inactivity is None:
+            max_inactivity = settings.NOMMERD_MAX_INACTIVITY
         # Total seconds of inactivity.
-        inactive_secs = total_seconds(tdelt)
+        inactive_secs = cls.get_idle_seconds()
 
         # If we're over the inactivity threshold...
-        if inactive_secs > settings.NOMMERD_MAX_INACTIVITY:
+        if inactive_secs > max_inactivity:
             instance_id = cls.get_instance_id()
+            if require_stale_lease:
+                cls._update_from_item(
+                    cls._aws_sdb_nommer_state_domain().get_item(
+                                            instance_id, consistent_read=True))
+                if cls.get_seconds_since_feederd_seen() <= max_inactivity:
+                    # feederd is still around, and decides when we go.
+                    return False
             conn = cls._aws_ec2_connection()
             # Find this particular EC2 instance via boto.
             reservations = conn.get_all_instances(instance_ids=[instance_id])
@@ -168,17 +348,6 @@ class NodeStateManager(object):
         # Continue existence, no termination.
         return False
 
-    @classmethod
-    def get_num_active_threads(cls):
-        """
-        Checks the reactor's threadpool to see how many threads are currently
-        working. This can be used to determine how busy this node is.
-        
-        :rtype: int
-        :returns: The number of active threads.
-        """
-        return len(reactor.getThreadPool().working)
-
     @classmethod
     def i_did_something(cls):
         """
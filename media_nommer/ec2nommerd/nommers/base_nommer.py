@@ -7,9 +7,12 @@ import os
 import traceback
 import tempfile
 import shutil
+from media_nommer.conf import settings
 from media_nommer.utils import logger
 from media_nommer.ec2nommerd.node_state import NodeStateManager
+from media_nommer.ec2nommerd.slot_manager import SlotManager
 from media_nommer.core.storage_backends import get_backend_for_uri
+from media_nommer.core.job_state_backends.exceptions import JobVersionConflict
 
 class BaseNommer(object):
     """
@@ -34,6 +37,13 @@ class BaseNommer(object):
 
         try:
             self._onomnom()
+        except JobVersionConflict:
+            # Someone else (probably feederd, abandoning the job) saved the
+            # job out from under us. Our copy is stale, so leave it be.
+            logger.error("BaseNommer.onomnom(): " \
+                         "Job %s was changed elsewhere, giving up on it." % (
+                            self.job.unique_id))
+            traceback.print_exc()
         except:
             # If we run into any un-handled exceptions, error out the job
             # and set as its state details.
@@ -52,10 +62,36 @@ class BaseNommer(object):
         """
         raise NotImplementedError
 
+    def estimate_resources(self):
+        """
+        Estimates how much temp disk space and memory this job will need, so
+        :doc:`../ec2nommerd` doesn't take on more than it can handle. Disk
+        space goes by the size of the source file, times
+        :py:data:`NOMMERD_JOB_DISK_FACTOR <media_nommer.conf.settings.NOMMERD_JOB_DISK_FACTOR>`.
+        Override this if your nommer knows better.
+
+        :rtype: dict
+        :returns: A dict with ``disk`` and ``memory`` keys, in bytes.
+        """
+        file_uri = self.job.source_path
+        source_size = get_backend_for_uri(file_uri).get_file_size(file_uri)
+        if source_size:
+            disk = int(source_size * settings.NOMMERD_JOB_DISK_FACTOR)
+        else:
+            # Can't tell, assume it's a typical one.
+            disk = settings.NOMMERD_JOB_DISK_ESTIMATE
+
+        return {
+            'disk': disk,
+            'memory': settings.NOMMERD_JOB_MEMORY_ESTIMATE,
+        }
+
     def wrapped_set_job_state(self, *args, **kwargs):
         """
         Wraps set_job_state() to perform extra actions before and/or after
-        job state updates.
+        job state updates. States that are also
+        :py:attr:`SlotManager.STAGES <media_nommer.ec2nommerd.slot_manager.SlotManager.STAGES>`
+        move the job's slot to that stage.
         
         :param str new_state: The job state to set.
         """
@@ -63,6 +99,8 @@ class BaseNommer(object):
         # terminating itself.
         NodeStateManager.i_did_something()
         self.job.set_job_state(*args, **kwargs)
+        if self.job.job_state in SlotManager.STAGES:
+            SlotManager.set_stage(self.job, self.job.job_state)
 
     def download_source_file(self):
         """
@@ -6,6 +6,8 @@ import os
 import tempfile
 import subprocess
 from media_nommer.utils import logger
+from media_nommer.ec2nommerd.node_state import NodeStateManager
+from media_nommer.ec2nommerd.cpu_allocator import CPUAllocator
 from media_nommer.ec2nommerd.nommers.base_nommer import BaseNommer
 from media_nommer.conf import settings
 
@@ -79,6 +81,12 @@ class FFmpegNommer(BaseNommer):
     Note that the ``an`` key in the ``outfile_options`` list of the first pass
     above has a ``None`` value. You'll need to do this for flags or options
     that don't require a value.
+
+    Each job gets its share of the node's cores (see
+    :py:class:`CPUAllocator <media_nommer.ec2nommerd.cpu_allocator.CPUAllocator>`),
+    and ffmpeg is pinned to them. If ``threads`` is ``0`` or left out, it's
+    set to the number of cores the job got. Any other ``threads`` value is
+    left alone.
     """
     def _onomnom(self):
         """
@@ -90,7 +98,11 @@ class FFmpegNommer(BaseNommer):
 
         # Encode the file. The return value is a tempfile with the output.
         self.wrapped_set_job_state('ENCODING')
-        out_fobj = self.__run_ffmpeg(fobj)
+        cores = CPUAllocator.acquire(self.job, NodeStateManager.get_num_slots())
+        try:
+            out_fobj = self.__run_ffmpeg(fobj, cores)
+        finally:
+            CPUAllocator.release(self.job)
 
         if not out_fobj:
             # Failure! We're going nowhere.
@@ -109,6 +121,66 @@ class FFmpegNommer(BaseNommer):
 
         return True
 
+    def estimate_resources(self):
+        """
+        Estimates how much temp disk space and memory this job will need.
+        On top of :py:meth:`BaseNommer.estimate_resources`, memory is scaled
+        by the output frame size, if the ``s`` option or a ``scale`` video
+        filter gives one.
+        :py:data:`NOMMERD_JOB_MEMORY_ESTIMATE <media_nommer.conf.settings.NOMMERD_JOB_MEMORY_ESTIMATE>`
+        is taken to be for 720p output.
+
+        :rtype: dict
+        :returns: A dict with ``disk`` and ``memory`` keys, in bytes.
+        """
+        resources = super(FFmpegNommer, self).estimate_resources()
+
+        num_pixels = 0
+        for encoding_pass_options in self.job.job_options:
+            for key, val in encoding_pass_options.get('outfile_options', []):
+                frame_size = self.__get_frame_size_from_option(key, val)
+                if frame_size:
+                    num_pixels = max(num_pixels, frame_size[0] * frame_size[1])
+
+        if num_pixels:
+            scale = num_pixels / float(1280 * 720)
+            # Not all of an encoder's memory goes to frames.
+            resources['memory'] = int(resources['memory'] * max(scale, 0.25))
+        return resources
+
+    def __get_frame_size_from_option(self, key, val):
+        """
+        Picks the output frame size out of an ffmpeg option, if it has one.
+
+        :param str key: The option's name, without the dash.
+        :param val: The option's value.
+        :rtype: tuple or ``None``
+        :returns: A ``(width, height)`` tuple, or ``None`` if the option
+            doesn't set a (usable) size. Heights of ``-1`` are assumed to
+            be for 16:9.
+        """
+        if key == 's':
+            dimensions = str(val).split('x')
+        elif key == 'vf':
+            dimensions = None
+            for video_filter in str(val).split(','):
+                if video_filter.startswith('scale='):
+                    dimensions = video_filter[len('scale='):].split(':')
+            if not dimensions:
+                return None
+        else:
+            return None
+
+        try:
+            width, height = [int(dimension) for dimension in dimensions[:2]]
+        except ValueError:
+            return None
+        if height < 0:
+            height = width * 9 / 16
+        if width <= 0 or height <= 0:
+            return None
+        return width, height
+
     def __append_inout_opts_to_cmd_list(self, option_dict, cmd_list):
         """
         Takes user or preset options and adds them as arguments to the
@@ -124,20 +196,43 @@ class FFmpegNommer(BaseNommer):
                 # None values are not used.
                 cmd_list.append(str(val))
 
+    def __get_outfile_opts_with_threads(self, outfile_opts, num_threads):
+        """
+        Fills in the ``threads`` option, if it's ``0`` (auto) or missing.
+
+        :param list outfile_opts: The pass's ``outfile_options``.
+        :param int num_threads: The number of threads to use.
+        :rtype: list
+        :returns: A copy of ``outfile_opts`` with ``threads`` filled in.
+        """
+        filled_opts = []
+        has_threads = False
+        for key, val in outfile_opts:
+            if key == 'threads':
+                has_threads = True
+                if not val or str(val) == '0':
+                    val = num_threads
+            filled_opts.append((key, val))
+        if not has_threads:
+            filled_opts.insert(0, ('threads', num_threads))
+        return filled_opts
+
     def __assemble_ffmpeg_cmd_list(self, encoding_pass_options, infile_obj,
                                    outfile_obj, is_two_pass=False,
-                                   is_second_pass=False):
+                                   is_second_pass=False, cores=None):
         """
         Assembles a command list that subprocess.Popen() will use within
         self.__run_ffmpeg() to run ffmpeg.
         
         :param file infile_obj: A file-like object for input.
         :param file outfile_obj: A file-like object to store the output.
+        :keyword list cores: The cores to pin ffmpeg to, and run a thread
+            on each of. If ``None``, ffmpeg is left to its own devices.
         :rtype: list
         :returns: A list to be passed to subprocess.Popen().
         """
         #ffmpeg [[infile options][-i infile]]... {[outfile options] outfile}...
-        ffmpeg_cmd = ['ffmpeg', '-y']
+        ffmpeg_cmd = CPUAllocator.get_pinning_prefix(cores) + ['ffmpeg', '-y']
 
         # Form the ffmpeg infile and outfile options from the options
         # stored in the SimpleDB domain.
@@ -148,9 +243,11 @@ class FFmpegNommer(BaseNommer):
         # Specify infile
         ffmpeg_cmd += ['-i', infile_obj.name]
 
-        if encoding_pass_options.has_key('outfile_options'):
-            outfile_opts = encoding_pass_options['outfile_options']
-            self.__append_inout_opts_to_cmd_list(outfile_opts, ffmpeg_cmd)
+        outfile_opts = encoding_pass_options.get('outfile_options', [])
+        if cores:
+            outfile_opts = self.__get_outfile_opts_with_threads(outfile_opts,
+                                                                len(cores))
+        self.__append_inout_opts_to_cmd_list(outfile_opts, ffmpeg_cmd)
 
         if is_two_pass and not is_second_pass:
             # First pass of a 2-pass encoding.
@@ -189,9 +286,13 @@ class FFmpegNommer(BaseNommer):
 
         return qtf_cmd
 
-    def __run_ffmpeg(self, fobj):
+    def __run_ffmpeg(self, fobj, cores=None):
         """
         Fire up ffmpeg and toss the results into a temporary file.
+
+        :param file fobj: The downloaded source file.
+        :keyword list cores: The cores this job got from
+            :py:class:`CPUAllocator <media_nommer.ec2nommerd.cpu_allocator.CPUAllocator>`.
         
         :rtype: file-like object or ``None``
         :returns: If the encoding succeeds, a file-like object is returned.
@@ -210,7 +311,8 @@ class FFmpegNommer(BaseNommer):
                              encoding_pass_options,
                              fobj, out_fobj,
                              is_two_pass=is_two_pass,
-                             is_second_pass=is_second_pass)
+                             is_second_pass=is_second_pass,
+                             cores=cores)
 
             # Do this for ffmpeg's sake. Allows more than one concurrent
             # encoding job per EC2 instance.
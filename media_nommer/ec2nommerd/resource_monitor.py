@@ -0,0 +1,216 @@
+"""
+Contains the :py:class:`ResourceMonitor` class, which decides how many jobs
+this node can take on, going by its CPU load, memory and temp disk space.
+"""
+import os
+import tempfile
+import multiprocessing
+from media_nommer.conf import settings
+from media_nommer.utils import logger
+from media_nommer.ec2nommerd.slot_manager import SlotManager
+
+class ResourceMonitor(object):
+    """
+    Checks the node's live resource usage before jobs are pulled, and each
+    popped job's estimated needs (see
+    :py:meth:`BaseNommer.estimate_resources <media_nommer.ec2nommerd.nommers.base_nommer.BaseNommer.estimate_resources>`)
+    before it's started. A node with free slots still won't pull new jobs
+    while:
+
+    * Its load average per core is over
+      :py:data:`NOMMERD_MAX_LOAD_PER_CORE <media_nommer.conf.settings.NOMMERD_MAX_LOAD_PER_CORE>`.
+    * It doesn't have the memory for another job.
+    * Another job would leave less than
+      :py:data:`NOMMERD_MIN_FREE_DISK <media_nommer.conf.settings.NOMMERD_MIN_FREE_DISK>`
+      free in the temp directory.
+
+    Jobs in slots that haven't got going yet have their estimates reserved,
+    since they don't show up in the live numbers. Everything can be turned
+    off with
+    :py:data:`NOMMERD_ADMISSION_CONTROL <media_nommer.conf.settings.NOMMERD_ADMISSION_CONTROL>`.
+    """
+    # Jobs in these stages aren't using their share of memory yet.
+    MEMORY_PENDING_STAGES = ['STARTING', 'DOWNLOADING']
+    # Jobs in these stages are still filling up the temp directory.
+    DISK_PENDING_STAGES = ['STARTING', 'DOWNLOADING', 'ENCODING']
+
+    @classmethod
+    def get_num_cpus(cls):
+        """
+        :rtype: int
+        :returns: The number of CPU cores this node has.
+        """
+        try:
+            return multiprocessing.cpu_count()
+        except NotImplementedError:
+            return 1
+
+    @classmethod
+    def get_load_average(cls):
+        """
+        :rtype: float or ``None``
+        :returns: The one minute load average, or ``None`` if the OS won't
+            say.
+        """
+        try:
+            return os.getloadavg()[0]
+        except (AttributeError, OSError):
+            return None
+
+    @classmethod
+    def get_available_memory(cls):
+        """
+        :rtype: int or ``None``
+        :returns: How much memory (in bytes) is available for new processes,
+            or ``None`` if there's no ``/proc/meminfo`` to go by.
+        """
+        try:
+            meminfo_file = open('/proc/meminfo')
+        except IOError:
+            return None
+
+        meminfo = {}
+        try:
+            for line in meminfo_file:
+                fields = line.split()
+                if len(fields) >= 2 and fields[1].isdigit():
+                    # Values are in kB.
+                    meminfo[fields[0].rstrip(':')] = int(fields[1]) * 1024
+        finally:
+            meminfo_file.close()
+
+        if 'MemAvailable' in meminfo:
+            return meminfo['MemAvailable']
+        # Older kernels don't estimate this for us.
+        return meminfo.get('MemFree', 0) + meminfo.get('Buffers', 0) + \
+               meminfo.get('Cached', 0)
+
+    @classmethod
+    def get_free_disk_space(cls):
+        """
+        :rtype: int
+        :returns: How much space (in bytes) is free in the temp directory,
+            where nommers download and encode to.
+        """
+        stats = os.statvfs(tempfile.gettempdir())
+        return stats.f_bavail * stats.f_frsize
+
+    @classmethod
+    def get_memory_headroom(cls):
+        """
+        :rtype: int or ``None``
+        :returns: How much memory (in bytes) is left for new jobs, after
+            what's reserved for jobs that haven't started encoding. ``None``
+            if available memory can't be determined.
+        """
+        available = cls.get_available_memory()
+        if available is None:
+            return None
+        return available - SlotManager.get_reserved('memory',
+                                                    cls.MEMORY_PENDING_STAGES)
+
+    @classmethod
+    def get_disk_headroom(cls):
+        """
+        :rtype: int
+        :returns: How much temp disk space (in bytes) is left for new jobs,
+            after what's reserved for running jobs, and
+            :py:data:`NOMMERD_MIN_FREE_DISK <media_nommer.conf.settings.NOMMERD_MIN_FREE_DISK>`.
+        """
+        reserved = SlotManager.get_reserved('disk', cls.DISK_PENDING_STAGES)
+        return cls.get_free_disk_space() - reserved - \
+               settings.NOMMERD_MIN_FREE_DISK
+
+    @classmethod
+    def is_cpu_overloaded(cls):
+        """
+        :rtype: bool
+        :returns: ``True`` if the load average per core is over
+            :py:data:`NOMMERD_MAX_LOAD_PER_CORE <media_nommer.conf.settings.NOMMERD_MAX_LOAD_PER_CORE>`.
+        """
+        load = cls.get_load_average()
+        if load is None:
+            return False
+        return load / cls.get_num_cpus() > settings.NOMMERD_MAX_LOAD_PER_CORE
+
+    @classmethod
+    def get_num_to_pull(cls, num_free):
+        """
+        Figures out how many jobs to pull, going by the node's resources and
+        the default estimates for jobs that haven't been looked at yet.
+
+        :param int num_free: How many slots are free.
+        :rtype: int
+        :returns: How many jobs to pull, no more than ``num_free``.
+        """
+        if not settings.NOMMERD_ADMISSION_CONTROL or num_free == 0:
+            return num_free
+
+        if cls.is_cpu_overloaded():
+            logger.debug("ResourceMonitor.get_num_to_pull(): " \
+                         "CPU load is too high to take on more jobs.")
+            return 0
+
+        num_to_pull = num_free
+        memory_headroom = cls.get_memory_headroom()
+        if memory_headroom is not None:
+            num_to_pull = min(num_to_pull, int(
+                memory_headroom // settings.NOMMERD_JOB_MEMORY_ESTIMATE))
+        num_to_pull = min(num_to_pull, int(
+            cls.get_disk_headroom() // settings.NOMMERD_JOB_DISK_ESTIMATE))
+        num_to_pull = max(0, num_to_pull)
+
+        if num_to_pull < num_free:
+            logger.debug("ResourceMonitor.get_num_to_pull(): " \
+                         "Only room for %d more jobs." % num_to_pull)
+        return num_to_pull
+
+    @classmethod
+    def estimate_resources(cls, job):
+        """
+        :param EncodingJob job: The job to size up.
+        :rtype: dict
+        :returns: The job's estimated ``disk`` and ``memory`` needs (in
+            bytes), as per its nommer. The default estimates are used if the
+            nommer can't say.
+        """
+        try:
+            return job.nommer.estimate_resources()
+        except Exception:
+            logger.error("ResourceMonitor.estimate_resources(): " \
+                         "Unable to size up job %s." % job.unique_id)
+            logger.error()
+            return {
+                'disk': settings.NOMMERD_JOB_DISK_ESTIMATE,
+                'memory': settings.NOMMERD_JOB_MEMORY_ESTIMATE,
+            }
+
+    @classmethod
+    def admit(cls, job):
+        """
+        Puts a newly popped job in a slot, if the node has the memory and
+        temp disk space it needs.
+
+        :param EncodingJob job: A job popped from the new job queue.
+        :rtype: bool
+        :returns: ``True`` if the job was put in a slot, ``False`` if it
+            won't fit on this node right now.
+        """
+        if not settings.NOMMERD_ADMISSION_CONTROL:
+            SlotManager.occupy(job)
+            return True
+
+        resources = cls.estimate_resources(job)
+        disk_headroom = cls.get_disk_headroom()
+        memory_headroom = cls.get_memory_headroom()
+        if resources['disk'] > disk_headroom or \
+           (memory_headroom is not None and \
+            resources['memory'] > memory_headroom):
+            logger.info("ResourceMonitor.admit(): " \
+                        "Job %s needs %s, but only %s disk and %s memory " \
+                        "are free." % (job.unique_id, resources,
+                                       disk_headroom, memory_headroom))
+            return False
+
+        SlotManager.occupy(job, resources=resources)
+        return True
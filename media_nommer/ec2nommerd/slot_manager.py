@@ -0,0 +1,134 @@
+"""
+Contains the :py:class:`SlotManager` class, which keeps track of the jobs
+this node is running, and what each is up to.
+"""
+import threading
+from media_nommer.utils import logger
+
+class SlotManager(object):
+    """
+    Tracks which jobs are occupying this node's encoding slots, and which
+    stage each is in. A job occupies a slot from the moment it's popped
+    from the queue until its nommer is done with it. Encoding jobs run in
+    a pool with a thread per slot (see
+    :py:mod:`media_nommer.ec2nommerd.worker_pools`).
+
+    How many slots the node has is up to
+    :py:meth:`NodeStateManager.get_num_slots <media_nommer.ec2nommerd.node_state.NodeStateManager.get_num_slots>`.
+    """
+    # The stages a job goes through while occupying a slot. Nommers move
+    # jobs between them by setting job states of the same names.
+    STAGES = ['STARTING', 'DOWNLOADING', 'ENCODING', 'UPLOADING']
+    # Maps the unique IDs of the jobs occupying slots to their stages.
+    OCCUPIED = {}
+    # Maps the unique IDs of the jobs occupying slots to the resources
+    # reserved for them, as per ResourceMonitor.estimate_resources().
+    RESERVED = {}
+    # OCCUPIED is updated from the reactor thread and the encoding threads.
+    LOCK = threading.Lock()
+
+    @classmethod
+    def occupy(cls, job, resources=None):
+        """
+        Puts a job in a slot, in the ``STARTING`` stage. Call this as
+        soon as the job is popped from the queue, so the slot isn't handed
+        out twice.
+
+        :param EncodingJob job: The job to put in a slot.
+        :keyword dict resources: The resources to reserve for the job, as
+            per
+            :py:meth:`ResourceMonitor.estimate_resources <media_nommer.ec2nommerd.resource_monitor.ResourceMonitor.estimate_resources>`.
+        """
+        cls.LOCK.acquire()
+        try:
+            cls.OCCUPIED[job.unique_id] = 'STARTING'
+            cls.RESERVED[job.unique_id] = resources or {}
+        finally:
+            cls.LOCK.release()
+
+    @classmethod
+    def set_stage(cls, job, stage):
+        """
+        Moves a job to another stage. Jobs that aren't in a slot (those run
+        outside of :doc:`../ec2nommerd`'s pull loop) are left alone.
+
+        :param EncodingJob job: The job whose stage to set.
+        :param str stage: One of :py:attr:`STAGES`.
+        """
+        cls.LOCK.acquire()
+        try:
+            if job.unique_id in cls.OCCUPIED:
+                cls.OCCUPIED[job.unique_id] = stage
+        finally:
+            cls.LOCK.release()
+
+    @classmethod
+    def release(cls, job):
+        """
+        Frees up a job's slot. Harmless if the job isn't in one.
+
+        :param EncodingJob job: The job whose slot to free.
+        """
+        cls.LOCK.acquire()
+        try:
+            stage = cls.OCCUPIED.pop(job.unique_id, None)
+            cls.RESERVED.pop(job.unique_id, None)
+        finally:
+            cls.LOCK.release()
+        if stage is None:
+            logger.warning("SlotManager.release(): " \
+                           "Job %s wasn't in a slot." % job.unique_id)
+
+    @classmethod
+    def get_num_occupied(cls):
+        """
+        :rtype: int
+        :returns: The number of jobs occupying slots.
+        """
+        return len(cls.OCCUPIED)
+
+    @classmethod
+    def get_num_free(cls, num_slots):
+        """
+        :param int num_slots: How many slots this node has.
+        :rtype: int
+        :returns: How many more jobs this node can take.
+        """
+        return max(0, num_slots - cls.get_num_occupied())
+
+    @classmethod
+    def get_stage_counts(cls):
+        """
+        :rtype: dict
+        :returns: A dict with each of :py:attr:`STAGES` as keys, and how
+            many jobs are in that stage as values.
+        """
+        counts = dict([(stage, 0) for stage in cls.STAGES])
+        cls.LOCK.acquire()
+        try:
+            for stage in cls.OCCUPIED.values():
+                counts[stage] = counts.get(stage, 0) + 1
+        finally:
+            cls.LOCK.release()
+        return counts
+
+    @classmethod
+    def get_reserved(cls, resource, stages):
+        """
+        Adds up a resource reserved for the jobs in some of the stages.
+
+        :param str resource: The resource to add up (``disk`` or
+            ``memory``).
+        :param list stages: Only count jobs in these stages.
+        :rtype: int
+        :returns: The total reserved for those jobs.
+        """
+        total = 0
+        cls.LOCK.acquire()
+        try:
+            for unique_id, stage in cls.OCCUPIED.items():
+                if stage in stages:
+                    total += cls.RESERVED.get(unique_id, {}).get(resource, 0)
+        finally:
+            cls.LOCK.release()
+        return total
@@ -0,0 +1,379 @@
+"""
+Tests for ec2nommerd's slot accounting, job pulling, thread pools,
+resource-aware admission, CPU allocation and heartbeats.
+"""
+import datetime
+import threading
+import unittest
+from boto.exception import SDBResponseError
+from media_nommer.conf import settings
+from media_nommer.utils import thread_pools
+from media_nommer.ec2nommerd.slot_manager import SlotManager
+from media_nommer.ec2nommerd.job_puller import JobPuller
+from media_nommer.ec2nommerd.resource_monitor import ResourceMonitor
+from media_nommer.ec2nommerd.cpu_allocator import CPUAllocator
+from media_nommer.ec2nommerd.node_state import NodeStateManager
+from media_nommer.ec2nommerd.interval_tasks import threaded_encode_job
+
+class FakeNommer(object):
+    """
+    A nommer that blows up part way through.
+    """
+    # What estimate_resources() returns.
+    resources = {'disk': 1000, 'memory': 100}
+
+    def estimate_resources(self):
+        return self.resources
+
+    def onomnom(self):
+        raise RuntimeError('Out of cheese.')
+
+class FakeJob(object):
+    """
+    Just enough of an EncodingJob for the slot manager.
+    """
+    def __init__(self, unique_id):
+        self.unique_id = unique_id
+        self.nommer = FakeNommer()
+
+class SlotManagerTests(unittest.TestCase):
+    def setUp(self):
+        SlotManager.OCCUPIED.clear()
+        SlotManager.RESERVED.clear()
+
+    tearDown = setUp
+
+    def test_stages(self):
+        """
+        Jobs should hold their slots through each stage, until released.
+        """
+        job_a = FakeJob('a')
+        job_b = FakeJob('b')
+        SlotManager.occupy(job_a)
+        SlotManager.occupy(job_b)
+        self.assertEqual(SlotManager.get_num_free(3), 1)
+        self.assertEqual(SlotManager.get_num_free(1), 0)
+
+        SlotManager.set_stage(job_a, 'ENCODING')
+        SlotManager.set_stage(job_b, 'UPLOADING')
+        # Jobs that never took a slot don't get one this way.
+        SlotManager.set_stage(FakeJob('c'), 'ENCODING')
+        self.assertEqual(SlotManager.get_stage_counts(), {
+            'STARTING': 0, 'DOWNLOADING': 0, 'ENCODING': 1, 'UPLOADING': 1})
+
+        SlotManager.release(job_a)
+        self.assertEqual(SlotManager.get_num_occupied(), 1)
+        SlotManager.release(job_a)
+        self.assertEqual(SlotManager.get_num_occupied(), 1)
+
+    def test_release_on_error(self):
+        """
+        A job's slot should be freed up even if its nommer blows up.
+        """
+        job = FakeJob('a')
+        SlotManager.occupy(job)
+        self.assertRaises(RuntimeError, threaded_encode_job, job)
+        self.assertEqual(SlotManager.get_num_occupied(), 0)
+
+class JobPullerTests(unittest.TestCase):
+    def tearDown(self):
+        JobPuller.num_empty_pulls = 0
+
+    def test_backoff(self):
+        """
+        The wait between pulls should double with each empty pull, up to
+        the maximum.
+        """
+        self.assertEqual(JobPuller.get_backoff(), 0)
+        backoffs = []
+        for i in range(7):
+            JobPuller.num_empty_pulls += 1
+            backoffs.append(JobPuller.get_backoff())
+        min_backoff = settings.NOMMERD_NEW_JOB_BACKOFF_MIN
+        max_backoff = settings.NOMMERD_NEW_JOB_BACKOFF_MAX
+        self.assertEqual(backoffs[:3], [min_backoff, min_backoff * 2,
+                                        min_backoff * 4])
+        self.assertEqual(backoffs[-1], max_backoff)
+        self.assertEqual(backoffs, sorted(backoffs))
+
+class FakeResourceMonitor(ResourceMonitor):
+    """
+    A ResourceMonitor with made up readings.
+    """
+    num_cpus = 4
+    load = 1.0
+    memory = 1000
+    disk = 10000
+
+    @classmethod
+    def get_num_cpus(cls):
+        return cls.num_cpus
+
+    @classmethod
+    def get_load_average(cls):
+        return cls.load
+
+    @classmethod
+    def get_available_memory(cls):
+        return cls.memory
+
+    @classmethod
+    def get_free_disk_space(cls):
+        return cls.disk
+
+class ResourceMonitorTests(unittest.TestCase):
+    def setUp(self):
+        SlotManager.OCCUPIED.clear()
+        SlotManager.RESERVED.clear()
+        self.old_settings = (settings.NOMMERD_JOB_MEMORY_ESTIMATE,
+                             settings.NOMMERD_JOB_DISK_ESTIMATE,
+                             settings.NOMMERD_MIN_FREE_DISK)
+        settings.NOMMERD_JOB_MEMORY_ESTIMATE = 100
+        settings.NOMMERD_JOB_DISK_ESTIMATE = 1000
+        settings.NOMMERD_MIN_FREE_DISK = 500
+
+    def tearDown(self):
+        SlotManager.OCCUPIED.clear()
+        SlotManager.RESERVED.clear()
+        settings.NOMMERD_JOB_MEMORY_ESTIMATE, \
+            settings.NOMMERD_JOB_DISK_ESTIMATE, \
+            settings.NOMMERD_MIN_FREE_DISK = self.old_settings
+
+    def test_num_to_pull(self):
+        """
+        Free slots should only be filled as far as the CPU, memory and temp
+        disk space allow.
+        """
+        # Room for 9 by disk, 10 by memory.
+        self.assertEqual(FakeResourceMonitor.get_num_to_pull(4), 4)
+        self.assertEqual(FakeResourceMonitor.get_num_to_pull(20), 9)
+
+        FakeResourceMonitor.load = 8.0
+        try:
+            self.assertEqual(FakeResourceMonitor.get_num_to_pull(4), 0)
+        finally:
+            FakeResourceMonitor.load = 1.0
+
+    def test_admit(self):
+        """
+        Jobs should be admitted until their reservations use up the temp
+        disk space, and reservations should go away with their slots.
+        """
+        jobs = [FakeJob(str(i)) for i in range(10)]
+        admitted = [job for job in jobs if FakeResourceMonitor.admit(job)]
+        self.assertEqual(len(admitted), 9)
+        self.assertEqual(SlotManager.get_reserved('disk', ['STARTING']), 9000)
+
+        # Encoding jobs are using their memory, so it's no longer reserved.
+        SlotManager.set_stage(admitted[0], 'ENCODING')
+        self.assertEqual(SlotManager.get_reserved('memory',
+                            FakeResourceMonitor.MEMORY_PENDING_STAGES), 800)
+
+        SlotManager.release(admitted[0])
+        self.assertTrue(FakeResourceMonitor.admit(jobs[-1]))
+
+        # Too big for this node, whatever else is running.
+        SlotManager.OCCUPIED.clear()
+        SlotManager.RESERVED.clear()
+        huge_job = FakeJob('huge')
+        huge_job.nommer.resources = {'disk': 20000, 'memory': 100}
+        self.assertFalse(FakeResourceMonitor.admit(huge_job))
+
+class CPUAllocatorTests(unittest.TestCase):
+    def tearDown(self):
+        CPUAllocator.ASSIGNED.clear()
+
+    def test_acquire(self):
+        """
+        Jobs should get their own cores until there aren't enough to go
+        around, then share the least busy ones.
+        """
+        num_cpus = ResourceMonitor.get_num_cpus()
+        self.assertEqual(CPUAllocator.acquire(FakeJob('all'), 1),
+                         range(num_cpus))
+        CPUAllocator.release(FakeJob('all'))
+
+        jobs = [FakeJob(str(i)) for i in range(num_cpus + 1)]
+        assigned = [CPUAllocator.acquire(job, num_cpus) for job in jobs]
+        self.assertEqual(assigned[:-1], [[core] for core in range(num_cpus)])
+        self.assertEqual(assigned[-1], [0])
+
+        CPUAllocator.release(jobs[-1])
+        CPUAllocator.release(jobs[-2])
+        self.assertEqual(CPUAllocator.acquire(FakeJob('new'), num_cpus),
+                         [num_cpus - 1])
+
+    def test_pinning_prefix(self):
+        """
+        Without pinning, commands should be left as they are.
+        """
+        old_pin_cpus = settings.NOMMERD_PIN_CPUS
+        settings.NOMMERD_PIN_CPUS = False
+        try:
+            self.assertEqual(CPUAllocator.get_pinning_prefix([0, 1]), [])
+        finally:
+            settings.NOMMERD_PIN_CPUS = old_pin_cpus
+
+class WorkerPoolTests(unittest.TestCase):
+    def tearDown(self):
+        pool = thread_pools._POOLS.pop('test-pool', None)
+        if pool is not None:
+            pool.stop()
+
+    def test_pool_stats(self):
+        """
+        Calls that can't get a thread right away should show up as queued.
+        """
+        self.assertEqual(thread_pools.get_pool_stats('test-pool')['queued'],
+                         0)
+        started = threading.Event()
+        release = threading.Event()
+        def blocker():
+            started.set()
+            release.wait(5)
+
+        thread_pools.call_in_named_pool('test-pool', 1, blocker)
+        thread_pools.call_in_named_pool('test-pool', 1, blocker)
+        started.wait(5)
+        stats = thread_pools.get_pool_stats('test-pool')
+        self.assertEqual(stats['max_threads'], 1)
+        self.assertEqual(stats['busy'], 1)
+        self.assertEqual(stats['queued'], 1)
+        release.set()
+
+class FakeSDBDomain(object):
+    """
+    Stands in for the boto SimpleDB domain that heartbeats are sent to,
+    including conditional puts.
+    """
+    def __init__(self):
+        self.items = {}
+        self.num_puts = 0
+
+    def get_item(self, item_name, consistent_read=False):
+        return self.items.get(item_name)
+
+    def put_attributes(self, item_name, attributes, replace=True,
+                       expected_value=None):
+        if expected_value:
+            name, value = expected_value
+            current = self.items.get(item_name, {}).get(name)
+            if (value is False and current is not None) or \
+               (value is not False and current != value):
+                raise SDBResponseError(409, 'Conflict',
+                    '<Response><Errors><Error>'
+                    '<Code>ConditionalCheckFailed</Code>'
+                    '<Message>Conditional check failed</Message>'
+                    '</Error></Errors></Response>')
+        self.num_puts += 1
+        self.items.setdefault(item_name, {}).update(
+            dict([(key, str(value)) for key, value in attributes.items()]))
+
+class FakeEC2Instance(object):
+    """
+    Stands in for this node's boto EC2 Instance.
+    """
+    is_terminated = False
+
+    def terminate(self):
+        self.is_terminated = True
+
+class FakeReservation(object):
+    """
+    Stands in for a boto Reservation.
+    """
+    def __init__(self, instances):
+        self.instances = instances
+
+class FakeEC2Connection(object):
+    """
+    Stands in for the boto EC2 connection a node looks itself up with.
+    """
+    def __init__(self, instances):
+        self.instances = instances
+
+    def get_all_instances(self, instance_ids=None):
+        return [FakeReservation(self.instances)]
+
+class NodeStateManagerTests(unittest.TestCase):
+    def setUp(self):
+        self.domain = FakeSDBDomain()
+        NodeStateManager._NodeStateManager__instance_id = 'i-1'
+        NodeStateManager._NodeStateManager__instance_type = 'c1.medium'
+        NodeStateManager._NodeStateManager__aws_sdb_nommer_state_domain = \
+            self.domain
+        NodeStateManager._NodeStateManager__expected_state = None
+        NodeStateManager.is_terminated = False
+        NodeStateManager.is_draining = False
+        SlotManager.OCCUPIED.clear()
+
+    def tearDown(self):
+        NodeStateManager._NodeStateManager__instance_id = None
+        NodeStateManager._NodeStateManager__instance_type = None
+        NodeStateManager._NodeStateManager__aws_sdb_nommer_state_domain = None
+        NodeStateManager._NodeStateManager__expected_state = None
+        NodeStateManager._NodeStateManager__aws_ec2_connection = None
+        NodeStateManager.is_terminated = False
+        NodeStateManager.is_draining = False
+        NodeStateManager.i_did_something()
+
+    def test_late_heartbeat(self):
+        """
+        Once feederd marks the instance TERMINATED, heartbeats should stop,
+        rather than overwriting the state.
+        """
+        self.assertTrue(NodeStateManager.send_instance_state_update())
+        self.assertTrue(
+            NodeStateManager.send_instance_state_update(state='DRAINED'))
+        self.assertEqual(self.domain.items['i-1']['state'], 'DRAINED')
+
+        # feederd terminates the instance.
+        self.domain.items['i-1']['state'] = 'TERMINATED'
+        self.assertFalse(
+            NodeStateManager.send_instance_state_update(state='DRAINED'))
+        self.assertEqual(self.domain.items['i-1']['state'], 'TERMINATED')
+        self.assertTrue(NodeStateManager.is_terminated)
+        self.assertFalse(NodeStateManager.send_instance_state_update())
+        self.assertEqual(self.domain.num_puts, 2)
+
+    def test_terminated_before_start(self):
+        """
+        An instance that comes up already marked TERMINATED should never
+        send a heartbeat, and one that notices while checking for drain
+        requests should stop.
+        """
+        self.domain.items['i-1'] = {'state': 'TERMINATED'}
+        self.assertFalse(NodeStateManager.send_instance_state_update())
+        self.assertEqual(self.domain.num_puts, 0)
+
+        NodeStateManager.is_terminated = False
+        NodeStateManager._NodeStateManager__expected_state = 'ACTIVE'
+        self.domain.items['i-1'] = {'state': 'TERMINATED', 'drain': '1'}
+        self.assertTrue(NodeStateManager.check_drain_request())
+        self.assertTrue(NodeStateManager.is_terminated)
+
+    def test_floor_node_stays_up(self):
+        """
+        An idle node should outlive the fallback window while feederd keeps
+        renewing its lease, and only terminate itself once the lease goes
+        stale.
+        """
+        instance = FakeEC2Instance()
+        NodeStateManager._NodeStateManager__aws_ec2_connection = \
+            FakeEC2Connection([instance])
+        hours_ago = datetime.datetime.now() - datetime.timedelta(hours=3)
+        NodeStateManager.last_dtime_i_did_something = hours_ago
+        NodeStateManager.last_dtime_feederd_seen = hours_ago
+
+        for lease in ['2026-01-01 00:00:00', '2026-01-01 00:01:00']:
+            self.domain.items['i-1'] = {'state': 'ACTIVE',
+                                        'feederd_seen_dtime': lease}
+            self.assertFalse(NodeStateManager.contemplate_termination(
+                max_inactivity=3600, require_stale_lease=True))
+            self.assertFalse(instance.is_terminated)
+
+        # feederd stops renewing the lease.
+        NodeStateManager.last_dtime_feederd_seen = hours_ago
+        self.assertTrue(NodeStateManager.contemplate_termination(
+            max_inactivity=3600, require_stale_lease=True))
+        self.assertTrue(instance.is_terminated)
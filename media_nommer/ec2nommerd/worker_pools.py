@@ -0,0 +1,54 @@
+"""
+The thread pools :doc:`../ec2nommerd` runs its blocking work in. Encoding
+jobs get a pool of their own, with a thread per slot, and everything else
+(heartbeats, popping jobs from the queue) goes through a small control
+pool. No matter how many long encoding jobs are running, heartbeats still
+go out on time, so :doc:`../feederd` doesn't mistake a busy node for a
+dead one.
+"""
+from media_nommer.conf import settings
+from media_nommer.utils.thread_pools import call_in_named_pool, get_pool_stats
+from media_nommer.ec2nommerd.node_state import NodeStateManager
+
+# Runs the nommers, see threaded_encode_job().
+ENCODING_POOL = 'nommerd-encoding'
+# Runs heartbeats and job pulls.
+CONTROL_POOL = 'nommerd-control'
+
+def call_in_encoding_pool(func, *args, **kwargs):
+    """
+    Runs a blocking call in the encoding pool, which has as many threads as
+    this node has slots (see
+    :py:meth:`NodeStateManager.get_num_slots <media_nommer.ec2nommerd.node_state.NodeStateManager.get_num_slots>`).
+    Only call this from the reactor thread.
+
+    :param callable func: The blocking callable. Any other args and kwargs
+        are passed on to it.
+    """
+    call_in_named_pool(ENCODING_POOL, NodeStateManager.get_num_slots(),
+                       func, *args, **kwargs)
+
+def call_in_control_pool(func, *args, **kwargs):
+    """
+    Runs a blocking call in the control pool, which has
+    :py:data:`NOMMERD_CONTROL_THREADS <media_nommer.conf.settings.NOMMERD_CONTROL_THREADS>`
+    threads. Only call this from the reactor thread.
+
+    :param callable func: The blocking callable. Any other args and kwargs
+        are passed on to it.
+    """
+    call_in_named_pool(CONTROL_POOL, settings.NOMMERD_CONTROL_THREADS,
+                       func, *args, **kwargs)
+
+def get_worker_pool_stats():
+    """
+    :rtype: dict
+    :returns: A dict with ``encoding`` and ``control`` as keys, and each
+        pool's stats (as per
+        :py:func:`get_pool_stats <media_nommer.utils.thread_pools.get_pool_stats>`)
+        as values.
+    """
+    return {
+        'encoding': get_pool_stats(ENCODING_POOL),
+        'control': get_pool_stats(CONTROL_POOL),
+    }
@@ -2,20 +2,61 @@
 Contains the :py:class:`EC2InstanceManager` class, which helps manage the
 currently active instances.
 """
+import time
+import datetime
+import threading
 import boto
 from boto.exception import EC2ResponseError
 from media_nommer.conf import settings
 from media_nommer.utils import logger
-from media_nommer.core.job_state_backend import JobStateBackend
+from media_nommer.utils.compat import total_seconds
+from media_nommer.core import instance_types
+from media_nommer.feederd.job_cache import JobCache
+from media_nommer.feederd.scaling_policy import get_scaling_policy, \
+    get_pending_job_durations, JobStatistics
+from media_nommer.feederd import release_bundle
 
 class EC2InstanceManager(object):
     """
     This class managers and creates EC2_ instances from the configured
-    encoder AMI. Additional instances are spawned based on the size of the job 
-    queue in relation to the amount of manpower available at any point in time.
+    encoder AMI. Additional instances are spawned as the configured
+    :py:mod:`scaling policy <media_nommer.feederd.scaling_policy>` sees fit.
+
+    If :py:data:`FEEDERD_MANAGE_SCALE_IN <media_nommer.conf.settings.FEEDERD_MANAGE_SCALE_IN>`
+    is ``True``, idle instances are also terminated from here (see
+    :py:meth:`scale_in_if_needed`), rather than by the instances themselves.
     """
     # Used for lazy-loading the EC2 connection. Do not refer to directly.
     __aws_ec2_connection = None
+    # Used for lazy-loading the SDB heartbeat domain. Do not refer to directly.
+    __aws_sdb_nommer_state_domain = None
+    # Instances are billed by the hour.
+    BILLING_PERIOD = instance_types.BILLING_PERIOD
+    # The instances from the last get_instances() lookup, and when it was
+    # done. Shared by all of feederd's tasks.
+    _instances_cache = None
+    _instances_cache_time = 0
+    _instances_cache_lock = threading.Lock()
+    # The encoder AMI, looked up once by get_image().
+    _image_cache = None
+    # EC2 error codes that mean a pool (an instance type and availability
+    # zone) can't take any more instances right now.
+    CAPACITY_ERROR_CODES = ['InsufficientInstanceCapacity', 'Unsupported']
+    # How long each phase of the last spawn_instances() call took, in
+    # seconds.
+    last_spawn_timings = {}
+    # How many times to try tagging new instances, and how long (in seconds)
+    # to wait before the first retry. The wait doubles after each try. EC2
+    # often doesn't know about new instances for a few seconds.
+    TAG_ATTEMPTS = 5
+    TAG_RETRY_DELAY = 1
+    # Spawned instances that tag-filtered lookups may not find yet. Keys are
+    # instance IDs, values are (instance, spawn time) tuples. Guarded by
+    # _instances_cache_lock.
+    _recently_spawned = {}
+    # How long (in seconds) recently spawned instances are counted, while
+    # waiting for them to show up in tag-filtered lookups.
+    RECENTLY_SPAWNED_TTL = 600
 
     @classmethod
     def _aws_ec2_connection(cls):
@@ -26,47 +67,192 @@ class EC2InstanceManager(object):
         :returns: A boto connection to Amazon's EC2 interface.
         """
         if not cls.__aws_ec2_connection:
-            cls.__aws_ec2_connection = boto.connect_ec2(
-                settings.AWS_ACCESS_KEY_ID,
-                settings.AWS_SECRET_ACCESS_KEY)
+            cls.__aws_ec2_connection = cls._new_aws_ec2_connection()
         return cls.__aws_ec2_connection
 
     @classmethod
-    def get_instances(cls):
+    def _new_aws_ec2_connection(cls):
+        """
+        Opens a new EC2 boto connection. boto connections aren't thread-safe,
+        so threads started from here each need their own.
+
+        :returns: A boto connection to Amazon's EC2 interface.
+        """
+        return boto.connect_ec2(settings.AWS_ACCESS_KEY_ID,
+                                settings.AWS_SECRET_ACCESS_KEY)
+
+    @classmethod
+    def _aws_sdb_nommer_state_domain(cls):
+        """
+        Lazy-loading of the SimpleDB domain that instances send their
+        heartbeats to. Refer to this instead of referencing
+        cls.__aws_sdb_nommer_state_domain directly.
+
+        :returns: A boto SimpleDB domain.
+        """
+        if not cls.__aws_sdb_nommer_state_domain:
+            conn = boto.connect_sdb(settings.AWS_ACCESS_KEY_ID,
+                                    settings.AWS_SECRET_ACCESS_KEY)
+            cls.__aws_sdb_nommer_state_domain = conn.create_domain(
+                                    settings.SIMPLEDB_EC2_NOMMER_STATE_DOMAIN)
+        return cls.__aws_sdb_nommer_state_domain
+
+    @classmethod
+    def _get_instance_filters(cls):
+        """
+        :rtype: dict
+        :returns: The DescribeInstances filters that pick out active
+            media-nommer instances, so EC2_ does the filtering rather than us.
+        """
+        filters = {
+            'image-id': settings.EC2_AMI_ID,
+            # Instances must be in these states to make it through the filter.
+            'instance-state-name': ['running', 'pending'],
+        }
+        if settings.EC2_FILTER_BY_TAGS:
+            for tag_name, tag_value in settings.EC2_INSTANCE_TAGS.items():
+                filters['tag:%s' % tag_name] = tag_value
+        return filters
+
+    @classmethod
+    def get_instances(cls, max_age=None):
         """
         Returns a list of boto 
         :py:class:`Instance <boto.ec2.instance.Instance>` objects matching the
         media-nommer AMI, as per 
-        :py:data:`media_nommer.conf.settings.EC2_AMI_ID`. Also filters only
-        running instances.
-        
+        :py:data:`media_nommer.conf.settings.EC2_AMI_ID`. Also filters
+        only running instances.
+
+        If :py:data:`EC2_FILTER_BY_TAGS <media_nommer.conf.settings.EC2_FILTER_BY_TAGS>`
+        is ``True``, only instances with the tags in
+        :py:data:`media_nommer.conf.settings.EC2_INSTANCE_TAGS` are
+        returned, along with instances spawned in the last
+        :py:attr:`RECENTLY_SPAWNED_TTL` seconds whose tags haven't shown up
+        yet. Otherwise, they'd go uncounted, and more would be spawned.
+
+        The result is cached for
+        :py:data:`FEEDERD_EC2_INSTANCE_CACHE_TTL <media_nommer.conf.settings.FEEDERD_EC2_INSTANCE_CACHE_TTL>`
+        seconds.
+
+        :keyword int max_age: If specified, the most seconds old a cached
+            result may be. ``0`` forces a fresh lookup.
         :rtype: list
         :returns: A list of :py:class:`boto.ec2.instance.Instance` objects 
             representing currently active media-nommer 
             :doc:`../ec2nommerd` instances.
         """
-        # Instances must be in these states to make it through the filter.
-        counted_states = ['running', 'pending']
-        # Get a list of reservations for all running instances.
-        reservations = cls._aws_ec2_connection().get_all_instances()
-        # Hold a list of Instance objects to return.
-        instances = []
-        for r in reservations:
-            for i in r.instances:
-                if i.image_id == settings.EC2_AMI_ID and i.state in counted_states:
-                    # Passed filters, this is a media-nommer instance.
-                    instances.append(i)
+        if max_age is None:
+            max_age = settings.FEEDERD_EC2_INSTANCE_CACHE_TTL
+
+        with cls._instances_cache_lock:
+            cache_age = time.time() - cls._instances_cache_time
+            if cls._instances_cache is not None and cache_age < max_age:
+                return list(cls._instances_cache)
+
+            # Get a list of reservations for matching instances.
+            reservations = cls._aws_ec2_connection().get_all_instances(
+                filters=cls._get_instance_filters())
+            # Hold a list of Instance objects to return.
+            instances = []
+            for r in reservations:
+                instances.extend(r.instances)
+            if settings.EC2_FILTER_BY_TAGS:
+                instances.extend(cls._get_untagged_recently_spawned(instances))
 
-        return instances
+            cls._instances_cache = instances
+            cls._instances_cache_time = time.time()
+            return list(instances)
+
+    @classmethod
+    def _get_untagged_recently_spawned(cls, instances):
+        """
+        Picks out the recently spawned instances that a tag-filtered lookup
+        didn't find, and forgets those that were found, or are too old to
+        wait on any longer. Call with :py:attr:`_instances_cache_lock` held.
+
+        :param list instances: The instances the lookup found.
+        :rtype: list
+        :returns: The recently spawned instances that weren't found.
+        """
+        found_ids = set([instance.id for instance in instances])
+        now = time.time()
+        untagged = []
+        for instance_id, (instance, spawn_time) in \
+                                        cls._recently_spawned.items():
+            if instance_id in found_ids:
+                # Its tags have shown up.
+                del cls._recently_spawned[instance_id]
+            elif now - spawn_time > cls.RECENTLY_SPAWNED_TTL:
+                logger.error("EC2InstanceManager." \
+                             "_get_untagged_recently_spawned(): " \
+                             "Instance %s never showed up with its tags, no " \
+                             "longer counting it." % instance_id)
+                del cls._recently_spawned[instance_id]
+            else:
+                untagged.append(instance)
+        return untagged
+
+    @classmethod
+    def clear_instance_cache(cls):
+        """
+        Forgets the cached :py:meth:`get_instances` result, so the next
+        lookup hits EC2_. Call this after starting or stopping instances.
+        """
+        with cls._instances_cache_lock:
+            cls._instances_cache = None
+
+    @classmethod
+    def get_capacity(cls, instances, node_states=None):
+        """
+        Adds up the capacity of some instances, as per
+        :py:mod:`media_nommer.core.instance_types`.
+
+        :param list instances: A list of
+            :py:class:`boto.ec2.instance.Instance` objects.
+        :keyword dict node_states: Heartbeats, as per
+            :py:meth:`get_node_states`. If given, the instance types and
+            slot counts the instances report are used over EC2_'s and ours.
+        :rtype: float
+        :returns: The instances' total capacity, in baseline slots.
+        """
+        node_states = node_states or {}
+        capacity = 0.0
+        for instance in instances:
+            node_state = node_states.get(instance.id, {})
+            instance_type = node_state.get('instance_type',
+                                           instance.instance_type)
+            info = instance_types.get_instance_type_info(instance_type)
+            slots = int(node_state.get('slots', info['slots']))
+            capacity += slots * info['throughput']
+        return capacity
+
+    @classmethod
+    def get_num_baseline_instances(cls, capacity):
+        """
+        Scaling policies count instances of
+        :py:data:`MAX_ENCODING_JOBS_PER_EC2_INSTANCE <media_nommer.conf.settings.MAX_ENCODING_JOBS_PER_EC2_INSTANCE>`
+        baseline slots each. This converts a capacity into such a count.
+
+        :param float capacity: A capacity, in baseline slots.
+        :rtype: int
+        :returns: The number of baseline instances with that much capacity.
+        """
+        return int(round(capacity /
+                         float(settings.MAX_ENCODING_JOBS_PER_EC2_INSTANCE)))
 
     @classmethod
     def spawn_if_needed(cls):
         """
         Spawns additional EC2 instances if needed.
         
-        :rtype: :py:class:`boto.ec2.instance.Reservation` or ``None``
-        :returns: If instances are spawned, return a boto Reservation
-            object. If no instances are spawned, ``None`` is returned.
+        :rtype: list or ``None``
+        :returns: If instances are spawned, a list of boto Reservation
+            objects, as per :py:meth:`spawn_instances`. If no instances are
+            spawned, ``None`` is returned.
+
+        The instance types to spawn are picked by
+        :py:func:`choose_instance_types <media_nommer.core.instance_types.choose_instance_types>`,
+        going by the jobs waiting to run.
         """
         instances = cls.get_instances()
         num_instances = len(instances)
@@ -77,116 +263,497 @@ class EC2InstanceManager(object):
             # No more instances, no spawning allowed.
             return
 
-        unfinished_jobs = JobStateBackend.get_unfinished_jobs()
-        num_unfinished_jobs = len(unfinished_jobs)
-        logger.debug("EC2InstanceManager.spawn_if_needed(): " \
-                     "Current unfinished jobs: %d" % num_unfinished_jobs)
+        policy = get_scaling_policy()
+        num_baseline_instances = cls.get_num_baseline_instances(
+                                                cls.get_capacity(instances))
+        num_new_baseline_instances = policy.get_desired_num_instances(
+                                num_baseline_instances) - num_baseline_instances
+        capacity_needed = num_new_baseline_instances * \
+                          settings.MAX_ENCODING_JOBS_PER_EC2_INSTANCE
+        max_num_new_instances = settings.MAX_NUM_EC2_INSTANCES - num_instances
 
-        if num_unfinished_jobs == 0:
-            # No unfinished jobs, no need to go any further.
-            return
+        new_instance_types = []
+        if capacity_needed > 0:
+            logger.info("EC2InstanceManager.spawn_if_needed(): " \
+                        "%s wants %d more slots." % (policy.__name__,
+                                                     capacity_needed))
+            new_instance_types = instance_types.choose_instance_types(
+                capacity_needed, max_num_new_instances,
+                get_pending_job_durations(),
+                JobStatistics.get_mean_duration())
+        # Top up to the warm pool, if need be.
+        num_short_of_min = min(settings.MIN_NUM_EC2_INSTANCES,
+                               settings.MAX_NUM_EC2_INSTANCES) - \
+                           num_instances - len(new_instance_types)
+        if num_short_of_min > 0:
+            new_instance_types += instance_types.choose_instance_types(
+                float('inf'), num_short_of_min, [],
+                JobStatistics.get_mean_duration())
+
+        if not new_instance_types:
+            # No new instances.
+            return None
+
+        reservations = []
+        for instance_type in sorted(set(new_instance_types)):
+            reservations += cls.spawn_instances(
+                new_instance_types.count(instance_type),
+                instance_type=instance_type)
+        return reservations
+
+    @classmethod
+    def get_node_states(cls):
+        """
+        Looks up the latest heartbeats from the instances.
+
+        :rtype: dict
+        :returns: A dict with instance IDs as keys, and dicts of heartbeat
+            attributes (``active_jobs``, ``idle_seconds``, ``state``, and
+            ``drain`` if the instance has been asked to drain) as values.
+        """
+        query_str = "SELECT * FROM `%s`" % (
+            settings.SIMPLEDB_EC2_NOMMER_STATE_DOMAIN)
+        node_states = {}
+        for item in cls._aws_sdb_nommer_state_domain().select(
+                                                query_str, consistent_read=True):
+            node_states[item.name] = dict(item)
+        return node_states
 
-        job_capacity = num_instances * settings.MAX_ENCODING_JOBS_PER_EC2_INSTANCE
+    @classmethod
+    def renew_node_leases(cls, node_states):
+        """
+        Lets instances know that feederd is still around to manage them, by
+        stamping ``feederd_seen_dtime`` on their heartbeat items. Instances
+        only fall back to terminating themselves once this stops changing
+        (see
+        :py:data:`NOMMERD_FALLBACK_MAX_INACTIVITY <media_nommer.conf.settings.NOMMERD_FALLBACK_MAX_INACTIVITY>`),
+        so idle instances kept for
+        :py:data:`MIN_NUM_EC2_INSTANCES <media_nommer.conf.settings.MIN_NUM_EC2_INSTANCES>`
+        stay up.
 
-        if job_capacity == 0:
-            # Don't factor in overflow thresh or anything if we have no
-            # instances or capacity.
-            cap_plus_thresh = 0
+        :param dict node_states: As per :py:meth:`get_node_states`.
+            Instances marked ``TERMINATED`` are skipped.
+        """
+        now = str(datetime.datetime.now())
+        instance_ids = [instance_id
+                        for instance_id, node_state in node_states.items()
+                        if node_state.get('state') != 'TERMINATED']
+        domain = cls._aws_sdb_nommer_state_domain()
+        # SimpleDB takes up to 25 items per batch.
+        for i in range(0, len(instance_ids), 25):
+            domain.batch_put_attributes(
+                dict([(instance_id, {'feederd_seen_dtime': now})
+                      for instance_id in instance_ids[i:i + 25]]),
+                replace=True)
+
+    @classmethod
+    def set_node_draining(cls, instance_id, is_draining):
+        """
+        Asks an instance to drain (stop taking new jobs) ahead of being
+        terminated, or to go back to work.
+
+        :param str instance_id: The instance's ID.
+        :param bool is_draining: ``True`` to drain, ``False`` to un-drain.
+        """
+        domain = cls._aws_sdb_nommer_state_domain()
+        if is_draining:
+            domain.put_attributes(instance_id, {'drain': '1'}, replace=True)
         else:
-            cap_plus_thresh = job_capacity + settings.JOB_OVERFLOW_THRESH
+            domain.delete_attributes(instance_id, ['drain'])
 
-        logger.debug("EC2InstanceManager.spawn_if_needed(): " \
-                     "Job capacity (%d w/ thresh): %d" % (job_capacity,
-                                                         cap_plus_thresh))
-
-        is_over_capacity = num_unfinished_jobs >= cap_plus_thresh
-        # Disgregard the overflow thresh if there are jobs but no instances.
-        if is_over_capacity or num_instances == 0:
-            overage = num_unfinished_jobs - job_capacity
-            if job_capacity > 0:
-                # Only factor overhold threshold in when we have capacity
-                # available in some form.
-                overage -= settings.JOB_OVERFLOW_THRESH
-
-            if overage <= 0:
-                # Adding in the overflow thresh brought this under the
-                # overage level. No need for spawning instances.
-                return None
+    @classmethod
+    def terminate_instances(cls, instances):
+        """
+        Terminates instances, and marks them as such in the heartbeat domain.
 
-            logger.info("EC2InstanceManager.spawn_if_needed(): " \
-                         "Observed labor shortage of: %d" % overage)
+        :param list instances: A list of
+            :py:class:`boto.ec2.instance.Instance` objects to terminate.
+        """
+        instance_ids = [instance.id for instance in instances]
+        logger.info("EC2InstanceManager.terminate_instances(): " \
+                    "Terminating: %s" % instance_ids)
+        cls._aws_ec2_connection().terminate_instances(instance_ids=instance_ids)
+        for instance_id in instance_ids:
+            cls._aws_sdb_nommer_state_domain().put_attributes(
+                instance_id, {'state': 'TERMINATED'}, replace=True)
+        cls.clear_instance_cache()
 
-            # Raw # of instances needing to be spawned.
-            num_new_instances = overage / settings.MAX_ENCODING_JOBS_PER_EC2_INSTANCE
-            # At this point, we know there's an overage, even with the overflow
-            # thresh factored in (if there is at least one EC2 instance
-            # already running).
-            num_new_instances = max(num_new_instances, 1)
-            # Also don't spawn more than the max configured instances.
-            num_new_instances = min(num_new_instances, settings.MAX_NUM_EC2_INSTANCES)
+    @classmethod
+    def get_instance_uptime(cls, instance):
+        """
+        :param instance: A :py:class:`boto.ec2.instance.Instance`.
+        :rtype: float
+        :returns: How many seconds the instance has been running.
+        """
+        # Along the lines of '2012-01-20T16:32:04.000Z', in UTC.
+        launch_dtime = datetime.datetime.strptime(instance.launch_time[:19],
+                                                  '%Y-%m-%dT%H:%M:%S')
+        return total_seconds(datetime.datetime.utcnow() - launch_dtime)
 
-            # The boto Reservation object. Its 'instances' attribute is the
-            # important bit.
-            if num_new_instances > 0:
-                return cls.spawn_instances(num_new_instances)
-        # No new instances.
-        return None
+    @classmethod
+    def get_seconds_until_billing_boundary(cls, instance):
+        """
+        :param instance: A :py:class:`boto.ec2.instance.Instance`.
+        :rtype: float
+        :returns: How many seconds until the instance starts another
+            billing period. Terminating right before then gets the most out
+            of the period already paid for.
+        """
+        uptime = cls.get_instance_uptime(instance)
+        return cls.BILLING_PERIOD - (uptime % cls.BILLING_PERIOD)
 
     @classmethod
-    def spawn_instances(cls, num_instances):
+    def scale_in_if_needed(cls):
         """
-        Spawns the number of instances specified.
-        
-        :param int num_instances: The number of instances to spawn.
-        :rtype: :py:class:`boto.ec2.instance.Reservation`
-        :returns: A boto Reservation for the started instance(s).
+        Terminates idle instances that aren't needed, as long as
+        :py:data:`MIN_NUM_EC2_INSTANCES <media_nommer.conf.settings.MIN_NUM_EC2_INSTANCES>`
+        and the scaling policy's
+        :py:meth:`get_min_num_instances <media_nommer.feederd.scaling_policy.ScalingPolicy.get_min_num_instances>`
+        are left running. Instances are drained before being terminated,
+        so they don't pick up any new jobs on the way out. Instances that
+        have been idle for
+        :py:data:`NOMMERD_MAX_INACTIVITY <media_nommer.conf.settings.NOMMERD_MAX_INACTIVITY>`
+        are drained once they're within
+        :py:data:`FEEDERD_SCALE_IN_BILLING_WINDOW <media_nommer.conf.settings.FEEDERD_SCALE_IN_BILLING_WINDOW>`
+        seconds of their next billing period, closest first. Capacity is
+        counted as per :py:meth:`get_capacity`, so an idle big instance may
+        be kept where a small one wouldn't be.
+
+        If new jobs come in, draining instances are put back to work. Each
+        pass also renews the instances' leases (see
+        :py:meth:`renew_node_leases`).
+
+        :rtype: list
+        :returns: The instances that were terminated.
         """
-        logger.info("EC2InstanceManager.spawn_instances(): " \
-                     "Spawning %d new instances" % num_instances)
+        instances = cls.get_instances()
+        node_states = cls.get_node_states()
+        cls.renew_node_leases(node_states)
+        draining = [instance for instance in instances
+                    if node_states.get(instance.id, {}).get('drain') == '1']
+
+        if JobCache.get_state_counts().get('PENDING'):
+            # Jobs are waiting, and draining instances can take them sooner
+            # than new ones could.
+            for instance in draining:
+                logger.info("EC2InstanceManager.scale_in_if_needed(): " \
+                            "Jobs are waiting, un-draining %s" % instance.id)
+                cls.set_node_draining(instance.id, False)
+            return []
+
+        # Instances that have finished draining are safe to terminate.
+        drained = [instance for instance in draining
+                   if node_states[instance.id].get('state') == 'DRAINED']
+        if drained:
+            cls.terminate_instances(drained)
+
+        remaining = [instance for instance in instances
+                     if instance not in draining]
+        remaining_capacity = cls.get_capacity(remaining, node_states)
+        num_baseline_instances = cls.get_num_baseline_instances(
+                                cls.get_capacity(instances, node_states))
+        capacity_to_keep = get_scaling_policy().get_min_num_instances(
+                                num_baseline_instances) * \
+                           settings.MAX_ENCODING_JOBS_PER_EC2_INSTANCE
+        num_remaining = len(remaining)
+        if num_remaining <= settings.MIN_NUM_EC2_INSTANCES or \
+           remaining_capacity <= capacity_to_keep:
+            return drained
+
+        candidates = []
+        for instance in instances:
+            node_state = node_states.get(instance.id)
+            if not node_state or instance in draining:
+                # No heartbeat yet, probably still booting.
+                continue
+            if int(node_state.get('active_jobs', 1)) > 0 or \
+               float(node_state.get('idle_seconds', 0)) < settings.NOMMERD_MAX_INACTIVITY:
+                continue
+            seconds_left = cls.get_seconds_until_billing_boundary(instance)
+            if seconds_left <= settings.FEEDERD_SCALE_IN_BILLING_WINDOW:
+                candidates.append((seconds_left, instance))
+
+        candidates.sort(key=lambda candidate: candidate[0])
+        for seconds_left, instance in candidates:
+            if num_remaining <= settings.MIN_NUM_EC2_INSTANCES:
+                break
+            capacity = cls.get_capacity([instance], node_states)
+            if remaining_capacity - capacity < capacity_to_keep:
+                # A smaller one might still go.
+                continue
+            num_remaining -= 1
+            remaining_capacity -= capacity
+            logger.info("EC2InstanceManager.scale_in_if_needed(): " \
+                        "Draining %s (%d seconds left in its billing " \
+                        "period)" % (instance.id, seconds_left))
+            cls.set_node_draining(instance.id, True)
+        return drained
+
+    @classmethod
+    def get_image(cls):
+        """
+        Looks up the encoder AMI in
+        :py:data:`EC2_AMI_ID <media_nommer.conf.settings.EC2_AMI_ID>`. The
+        result is cached, so spawning doesn't wait on an extra EC2_ round
+        trip each time.
+
+        :rtype: :py:class:`boto.ec2.image.Image` or ``None``
+        :returns: The AMI, or ``None`` if it couldn't be found.
+        """
+        image = cls._image_cache
+        if image is not None and image.id == settings.EC2_AMI_ID:
+            return image
 
-        conn = cls._aws_ec2_connection()
         try:
-            image = conn.get_all_images(image_ids=settings.EC2_AMI_ID)
-            image = image[0]
-        except EC2ResponseError:
-            logger.error("EC2InstanceManager.spawn_instances(): " \
+            image = cls._aws_ec2_connection().get_all_images(
+                                            image_ids=[settings.EC2_AMI_ID])[0]
+        except (EC2ResponseError, IndexError):
+            logger.error("EC2InstanceManager.get_image(): " \
                          "No AMI with ID %s could be found." % settings.EC2_AMI_ID)
             logger.error()
-            return
-        except IndexError:
-            logger.error("EC2InstanceManager.spawn_instances(): " \
-                         "No AMI with ID %s could be found." % settings.EC2_AMI_ID)
-            logger.error()
-            return
+            return None
+        cls._image_cache = image
+        return image
+
+    @classmethod
+    def get_spawn_pools(cls, instance_type=None):
+        """
+        :keyword str instance_type: The preferred instance type. Defaults
+            to :py:data:`EC2_INSTANCE_TYPE <media_nommer.conf.settings.EC2_INSTANCE_TYPE>`.
+        :rtype: list
+        :returns: A list of ``(instance_type, availability_zone)`` tuples
+            to spawn instances in, the preferred one first. The others are
+            only used when the preferred one is short on capacity. An
+            availability zone of ``None`` leaves the choice to EC2_.
+        """
+        type_names = [instance_type or settings.EC2_INSTANCE_TYPE]
+        for type_name in settings.EC2_FALLBACK_INSTANCE_TYPES:
+            if type_name not in type_names:
+                type_names.append(type_name)
+        zones = settings.EC2_AVAILABILITY_ZONES or [None]
+        # Prefer a different zone over a different instance type.
+        return [(type_name, zone) for type_name in type_names
+                                  for zone in zones]
+
+    @classmethod
+    def _run_instances(cls, image, num_instances, pool, conn=None):
+        """
+        Starts up to ``num_instances`` instances in one pool. Fewer may be
+        started if the pool is short on capacity.
 
-        # The boto Reservation object. Its 'instances' attribute is the
-        # important bit.
-        return image.run(min_count=num_instances, max_count=num_instances,
-                         instance_type=settings.EC2_INSTANCE_TYPE,
-                         security_groups=settings.EC2_SECURITY_GROUPS,
-                         key_name=settings.EC2_KEY_NAME,
-                         user_data=cls._gen_ec2_user_data())
+        :param image: The :py:class:`boto.ec2.image.Image` to run.
+        :param int num_instances: How many instances to start.
+        :param tuple pool: An ``(instance_type, availability_zone)`` tuple,
+            as per :py:meth:`get_spawn_pools`.
+        :param conn: The EC2 boto connection to use. Defaults to the shared
+            one, which must only be used from one thread at a time.
+        :rtype: :py:class:`boto.ec2.instance.Reservation` or ``None``
+        :returns: A boto Reservation, or ``None`` if the pool couldn't
+            take any instances.
+        """
+        instance_type, zone = pool
+        if conn is None:
+            conn = cls._aws_ec2_connection()
+        try:
+            return conn.run_instances(
+                                image.id,
+                                min_count=1,
+                                max_count=num_instances,
+                                instance_type=instance_type,
+                                placement=zone,
+                                security_groups=settings.EC2_SECURITY_GROUPS,
+                                key_name=settings.EC2_KEY_NAME,
+                                user_data=cls._gen_ec2_user_data())
+        except EC2ResponseError, e:
+            if e.error_code in cls.CAPACITY_ERROR_CODES:
+                logger.warning("EC2InstanceManager._run_instances(): " \
+                               "No capacity for %s in %s: %s" % (
+                                   instance_type, zone or 'any zone',
+                                   e.error_message))
+            else:
+                logger.error("EC2InstanceManager._run_instances(): " \
+                             "Unable to spawn %s instances in %s." % (
+                                 instance_type, zone or 'any zone'))
+                logger.error()
+            return None
+
+    @classmethod
+    def _run_instances_in_parallel(cls, image, num_instances, pools):
+        """
+        Spreads ``num_instances`` over several pools, starting them all at
+        once. Each pool is run from its own thread, with its own EC2
+        connection.
+
+        :param image: The :py:class:`boto.ec2.image.Image` to run.
+        :param int num_instances: How many instances to start in total.
+        :param list pools: A list of pools, as per
+            :py:meth:`get_spawn_pools`.
+        :rtype: list
+        :returns: A list of boto Reservations, one for each pool that
+            took instances.
+        """
+        reservations = []
+        threads = []
+        for i, pool in enumerate(pools):
+            # Spread the remainder over the first few pools.
+            pool_num_instances = num_instances // len(pools)
+            if i < num_instances % len(pools):
+                pool_num_instances += 1
+            if pool_num_instances == 0:
+                continue
+            thread = threading.Thread(
+                target=lambda pool=pool, pool_num=pool_num_instances:
+                    reservations.append(
+                        cls._run_instances(image, pool_num, pool,
+                                           cls._new_aws_ec2_connection())))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return [reservation for reservation in reservations if reservation]
+
+    @classmethod
+    def spawn_instances(cls, num_instances, instance_type=None):
+        """
+        Spawns the number of instances specified. They're started in the
+        first pool from :py:meth:`get_spawn_pools`. Whatever that pool
+        can't take is spread over the rest of the pools, in parallel.
+
+        How long each phase took ends up in :py:attr:`last_spawn_timings`,
+        and the log.
+
+        :param int num_instances: The number of instances to spawn.
+        :keyword str instance_type: The preferred instance type. Defaults
+            to :py:data:`EC2_INSTANCE_TYPE <media_nommer.conf.settings.EC2_INSTANCE_TYPE>`.
+        :rtype: list
+        :returns: A list of boto Reservations for the started instance(s).
+            Their ``instances`` attributes are the important bit.
+        """
+        logger.info("EC2InstanceManager.spawn_instances(): " \
+                     "Spawning %d new %s instances" % (
+                         num_instances,
+                         instance_type or settings.EC2_INSTANCE_TYPE))
+
+        timings = {}
+        phase_start = spawn_start = time.time()
+        image = cls.get_image()
+        timings['image_lookup'] = time.time() - phase_start
+        if not image:
+            return []
+
+        pools = cls.get_spawn_pools(instance_type)
+        phase_start = time.time()
+        reservations = []
+        reservation = cls._run_instances(image, num_instances, pools[0])
+        if reservation:
+            reservations.append(reservation)
+        timings['run'] = time.time() - phase_start
+
+        num_started = sum([len(r.instances) for r in reservations])
+        if num_started < num_instances and len(pools) > 1:
+            phase_start = time.time()
+            logger.info("EC2InstanceManager.spawn_instances(): " \
+                        "Spreading %d instances over %d fallback " \
+                        "pools." % (num_instances - num_started,
+                                    len(pools) - 1))
+            reservations.extend(cls._run_instances_in_parallel(
+                image, num_instances - num_started, pools[1:]))
+            timings['fallback_run'] = time.time() - phase_start
+
+        instances = []
+        for reservation in reservations:
+            instances.extend(reservation.instances)
+        phase_start = time.time()
+        cls._tag_instances(instances)
+        timings['tag'] = time.time() - phase_start
+        with cls._instances_cache_lock:
+            spawn_time = time.time()
+            for instance in instances:
+                cls._recently_spawned[instance.id] = (instance, spawn_time)
+        # The cached instance list no longer reflects reality.
+        cls.clear_instance_cache()
+        timings['total'] = time.time() - spawn_start
+
+        cls.last_spawn_timings = timings
+        logger.info("EC2InstanceManager.spawn_instances(): " \
+                    "Started %d of %d instances. Timings: %s" % (
+                        len(instances), num_instances,
+                        ', '.join(['%s %.2fs' % (phase, timings[phase])
+                                   for phase in sorted(timings)])))
+        return reservations
+
+    @classmethod
+    def _tag_instances(cls, instances):
+        """
+        Applies the tags in
+        :py:data:`media_nommer.conf.settings.EC2_INSTANCE_TAGS` to newly
+        spawned instances, so :py:meth:`get_instances` can find them. EC2_
+        often claims new instances don't exist for a few seconds, so this is
+        tried up to :py:attr:`TAG_ATTEMPTS` times, backing off between
+        tries.
+
+        :param list instances: A list of
+            :py:class:`boto.ec2.instance.Instance` objects to tag.
+        :rtype: bool
+        :returns: ``True`` if the instances were tagged (or there was
+            nothing to do), ``False`` if every try failed.
+        """
+        if not settings.EC2_INSTANCE_TAGS or not instances:
+            return True
+
+        instance_ids = [instance.id for instance in instances]
+        delay = cls.TAG_RETRY_DELAY
+        for attempt in range(1, cls.TAG_ATTEMPTS + 1):
+            try:
+                cls._aws_ec2_connection().create_tags(
+                                        instance_ids,
+                                        settings.EC2_INSTANCE_TAGS)
+                return True
+            except EC2ResponseError, e:
+                if attempt == cls.TAG_ATTEMPTS:
+                    logger.error("EC2InstanceManager._tag_instances(): " \
+                                 "Unable to tag instances: %s" % instance_ids)
+                    return False
+                logger.warning("EC2InstanceManager._tag_instances(): " \
+                               "Tagging failed (%s), retrying in %ss." % (
+                                   e.error_code, delay))
+                time.sleep(delay)
+                delay *= 2
 
     @classmethod
     def _gen_ec2_user_data(cls):
         """
         Generates the User-Data param to pass to Ubuntu Server's cloud-init.
         This will cause certain things to be done at startup time.
+
+        If :doc:`../feederd` has published a
+        :py:mod:`release bundle <media_nommer.feederd.release_bundle>`, the
+        instance installs media-nommer from that. Otherwise, it installs the
+        latest from GitHub.
         
         :rtype: str
         :returns: A user data string for :py:meth:`spawn_instances` to use.
         """
+        if release_bundle.PUBLISHED_KEY:
+            install_commands = release_bundle.get_install_commands(
+                release_bundle.PUBLISHED_KEY)
+        else:
+            install_commands = [
+                "sudo -u nom -i /home/nom/.virtualenvs/media_nommer/bin/pip install --upgrade git+http://github.com/duointeractive/media-nommer.git#egg=media_nommer > /tmp/media_nom_upgrade.log",
+            ]
+
         user_data = "#cloud-config\n" \
                     "apt_update: false\n\n" \
                     "apt_upgrade: false\n\n" \
                     "runcmd:\n" \
                     " - chmod 777 /tmp\n" \
                     " - echo \"s3://%s:%s@%s/nomconf.py\" > /home/nom/.nommerd_s3.cfg\n" \
-                    " - chown nom:nom /home/nom/.nommerd_s3.cfg\n" \
-                    " - sudo -u nom -i /home/nom/.virtualenvs/media_nommer/bin/pip install --upgrade git+http://github.com/duointeractive/media-nommer.git#egg=media_nommer > /tmp/media_nom_upgrade.log\n" \
-                    " - supervisorctl start ec2nommerd > /tmp/superv_start.log" % (
+                    " - chown nom:nom /home/nom/.nommerd_s3.cfg\n" % (
                         settings.AWS_ACCESS_KEY_ID,
                         settings.AWS_SECRET_ACCESS_KEY,
                         settings.CONFIG_S3_BUCKET,
                     )
+        for command in install_commands:
+            user_data += " - %s\n" % command
+        user_data += " - supervisorctl start ec2nommerd > /tmp/superv_start.log"
         return user_data
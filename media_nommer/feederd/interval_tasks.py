@@ -10,9 +10,12 @@ the interesting bits that actually do things.
 from twisted.internet import task, reactor
 from media_nommer.conf import settings
 from media_nommer.utils import logger
+from media_nommer.core.job_state_backend import get_job_state_backend
 from media_nommer.feederd.job_cache import JobCache
 from media_nommer.feederd.ec2_instance_manager import EC2InstanceManager
+from media_nommer.feederd.scaling_policy import JobStatistics
 from media_nommer.feederd import job_state_notifier
+from media_nommer.feederd.job_state_stream import publish_jobs_from_thread
 
 def threaded_check_for_job_state_changes():
     """
@@ -25,11 +28,22 @@ def threaded_check_for_job_state_changes():
     setting.
     """
     changed_jobs = JobCache.refresh_jobs_with_state_changes()
-    for job in changed_jobs:
-        job_state_notifier.send_notification(job)
+    # Job durations feed into the scaling policy.
+    JobStatistics.record_state_changes(changed_jobs)
+    # Notifications are sent through the reactor's shared connection pool.
+    reactor.callFromThread(job_state_notifier.send_notifications,
+                           changed_jobs)
+    # Let anyone watching the /job/events stream know.
+    publish_jobs_from_thread(changed_jobs)
     # If jobs have completed, remove them from the job cache.
     JobCache.uncache_finished_jobs()
 
+    # Anything still in the queue at this point is backlog that we'll have
+    # to catch up on during the next check.
+    backlog = get_job_state_backend().get_state_change_queue_backlog()
+    if backlog:
+        logger.info("Job state change queue backlog: %d" % backlog)
+
 def task_check_for_job_state_changes():
     """
     Checks for job state changes in a non-blocking manner.
@@ -50,7 +64,8 @@ def threaded_prune_jobs():
     (a day or so) that are probably dead. It marks them with an ``ABANDONED``
     state, letting us know something went really wrong.
     """
-    JobCache.abandon_stale_jobs()
+    abandoned_jobs = JobCache.abandon_stale_jobs()
+    publish_jobs_from_thread(abandoned_jobs)
     # Expire any newly abandoned jobs, too. Removes them from job cache.
     JobCache.uncache_finished_jobs()
 
@@ -64,17 +79,42 @@ def task_prune_jobs():
     """
     reactor.callInThread(threaded_prune_jobs)
 
+def threaded_reconcile_job_counts():
+    """
+    The autoscaler goes by the job cache's running count of unfinished jobs.
+    This makes sure that count hasn't drifted from the job state backend's,
+    re-syncing the job cache if it has.
+
+    See
+    :py:meth:`media_nommer.feederd.job_cache.JobCache.reconcile_unfinished_job_count`.
+    """
+    JobCache.reconcile_unfinished_job_count()
+
+def task_reconcile_job_counts():
+    """
+    Reconciles job counts in a non-blocking manner.
+
+    Calls :py:func:`threaded_reconcile_job_counts`.
+    """
+    reactor.callInThread(threaded_reconcile_job_counts)
+
 def threaded_manage_ec2_instances():
     """
     Looks at the current number of jobs needing encoding and compares them
     to the pool of currently running EC2_ instances. Spawns more instances
-    as needed.
+    as needed, and terminates idle ones if
+    :py:data:`FEEDERD_MANAGE_SCALE_IN <media_nommer.conf.settings.FEEDERD_MANAGE_SCALE_IN>`
+    is ``True``.
 
     See source of
     :py:meth:`media_nommer.feederd.ec2_instance_manager.EC2InstanceManager.spawn_if_needed`
+    and
+    :py:meth:`media_nommer.feederd.ec2_instance_manager.EC2InstanceManager.scale_in_if_needed`
     for the logic behind this.
     """
     EC2InstanceManager.spawn_if_needed()
+    if settings.FEEDERD_MANAGE_SCALE_IN:
+        EC2InstanceManager.scale_in_if_needed()
 
 def task_manage_ec2_instances():
     """
@@ -88,6 +128,8 @@ def register_tasks():
     """
     Registers all tasks. Called by the :doc:`../feederd` Twisted_ plugin.
     """
+    job_state_notifier.NotificationOutbox.start()
+
     task.LoopingCall(task_check_for_job_state_changes).start(
                             settings.FEEDERD_JOB_STATE_CHANGE_CHECK_INTERVAL,
                             now=False)
@@ -96,6 +138,10 @@ def register_tasks():
                             settings.FEEDERD_PRUNE_JOBS_INTERVAL,
                             now=True)
 
+    task.LoopingCall(task_reconcile_job_counts).start(
+                            settings.FEEDERD_RECONCILE_JOB_COUNTS_INTERVAL,
+                            now=False)
+
     # Only register the instance auto-spawning if enabled.
     if settings.FEEDERD_ALLOW_EC2_LAUNCHES:
         logger.debug("feederd will automatically scale EC2 instances.")
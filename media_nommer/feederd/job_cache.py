@@ -2,9 +2,12 @@
 Basic job caching module.
 """
 import datetime
+import threading
+from collections import OrderedDict
 from media_nommer.conf import settings
 from media_nommer.utils import logger
-from media_nommer.core.job_state_backend import JobStateBackend
+from media_nommer.core.job_state_backend import get_job_state_backend
+from media_nommer.core.job_state_backends.exceptions import JobVersionConflict
 from media_nommer.utils.compat import total_seconds
 
 class JobCache(dict):
@@ -15,6 +18,38 @@ class JobCache(dict):
     :py:attr:`media_nommer.core.job_state_backend.JobStateBackend.FINISHED_STATES`.
     """
     CACHE = {}
+    # Recently finished jobs, oldest first. Finished jobs don't change, so
+    # these can answer status lookups without going to the backend.
+    FINISHED_CACHE = OrderedDict()
+    # FINISHED_CACHE is updated from several threads.
+    FINISHED_CACHE_LOCK = threading.Lock()
+    # The number of cached jobs in each state. Keys are job states, values
+    # are counts.
+    STATE_COUNTS = {}
+    # The state each cached job was counted under, in case a cached job
+    # object's state is changed in place. Keys are unique IDs.
+    COUNTED_STATES = {}
+    # CACHE, STATE_COUNTS, and COUNTED_STATES are updated together under this.
+    COUNTS_LOCK = threading.RLock()
+
+    @classmethod
+    def _count_job(cls, unique_id, job_state):
+        """
+        Moves a job's count to a new state. Must be called with
+        :py:attr:`COUNTS_LOCK` held.
+
+        :param str unique_id: The job's unique ID.
+        :param job_state: The job's new state, or ``None`` if the job is
+            leaving the cache.
+        """
+        old_state = cls.COUNTED_STATES.pop(unique_id, None)
+        if old_state is not None:
+            cls.STATE_COUNTS[old_state] -= 1
+            if not cls.STATE_COUNTS[old_state]:
+                del cls.STATE_COUNTS[old_state]
+        if job_state is not None:
+            cls.COUNTED_STATES[unique_id] = job_state
+            cls.STATE_COUNTS[job_state] = cls.STATE_COUNTS.get(job_state, 0) + 1
 
     @classmethod
     def update_job(cls, job):
@@ -26,7 +61,12 @@ class JobCache(dict):
         :type job: :py:class:`EncodingJob <media_nommer.core.job_state_backend.EncodingJob>`
         :param job: The job to update (or create) a cache entry for.
         """
-        cls.CACHE[job.unique_id] = job
+        cls.COUNTS_LOCK.acquire()
+        try:
+            cls.CACHE[job.unique_id] = job
+            cls._count_job(job.unique_id, job.job_state)
+        finally:
+            cls.COUNTS_LOCK.release()
 
     @classmethod
     def get_job(cls, job):
@@ -56,7 +96,12 @@ class JobCache(dict):
             key = job
         else:
             key = job.unique_id
-        del cls.CACHE[key]
+        cls.COUNTS_LOCK.acquire()
+        try:
+            del cls.CACHE[key]
+            cls._count_job(key, None)
+        finally:
+            cls.COUNTS_LOCK.release()
 
     @classmethod
     def is_job_cached(cls, job):
@@ -76,6 +121,41 @@ class JobCache(dict):
             key = job.unique_id
         return cls.CACHE.has_key(key)
 
+    @classmethod
+    def cache_finished_job(cls, job):
+        """
+        Keeps a finished job around for status lookups. Only the
+        :py:data:`FEEDERD_FINISHED_JOB_CACHE_SIZE <media_nommer.conf.settings.FEEDERD_FINISHED_JOB_CACHE_SIZE>`
+        most recently finished jobs are kept.
+
+        :type job: :py:class:`EncodingJob <media_nommer.core.job_state_backend.EncodingJob>`
+        :param job: The finished job.
+        """
+        cls.FINISHED_CACHE_LOCK.acquire()
+        try:
+            cls.FINISHED_CACHE.pop(job.unique_id, None)
+            cls.FINISHED_CACHE[job.unique_id] = job
+            while len(cls.FINISHED_CACHE) > settings.FEEDERD_FINISHED_JOB_CACHE_SIZE:
+                cls.FINISHED_CACHE.popitem(last=False)
+        finally:
+            cls.FINISHED_CACHE_LOCK.release()
+
+    @classmethod
+    def lookup_job(cls, unique_id):
+        """
+        Looks for a job among both the un-finished and the recently
+        finished jobs.
+
+        :param str unique_id: The job's unique ID.
+        :rtype: :py:class:`EncodingJob <media_nommer.core.job_state_backend.EncodingJob>`
+            or ``None``
+        :returns: The cached job, or ``None`` if it isn't cached.
+        """
+        job = cls.CACHE.get(unique_id)
+        if job is None:
+            job = cls.FINISHED_CACHE.get(unique_id)
+        return job
+
     @classmethod
     def get_cached_jobs(cls):
         """
@@ -90,6 +170,91 @@ class JobCache(dict):
         """
         return cls.CACHE
 
+    @classmethod
+    def get_state_counts(cls):
+        """
+        Returns the number of cached jobs in each state. The counts are kept
+        up to date as jobs are cached and un-cached, so this is cheap.
+
+        :rtype: dict
+        :returns: A dict with job states as keys, and the number of cached
+            jobs in each state as values.
+        """
+        cls.COUNTS_LOCK.acquire()
+        try:
+            return dict(cls.STATE_COUNTS)
+        finally:
+            cls.COUNTS_LOCK.release()
+
+    @classmethod
+    def get_num_unfinished_jobs(cls):
+        """
+        :rtype: int
+        :returns: The number of cached jobs that aren't in one of the
+            :py:attr:`media_nommer.core.job_state_backend.JobStateBackend.FINISHED_STATES`.
+        """
+        finished_states = get_job_state_backend().FINISHED_STATES
+        return sum([count for job_state, count in
+                    cls.get_state_counts().items()
+                    if job_state not in finished_states])
+
+    @classmethod
+    def reconcile_unfinished_job_count(cls):
+        """
+        Compares the cache's count of unfinished jobs with the backend's.
+        If they disagree while no state changes are waiting to be processed
+        (meaning they really should agree), the cache has drifted, and is
+        re-synced with the backend.
+
+        :rtype: bool
+        :returns: ``True`` if the cache had to be re-synced.
+        """
+        backend = get_job_state_backend()
+        cached_count = cls.get_num_unfinished_jobs()
+        backend_count = backend.count_unfinished_jobs()
+        if cached_count == backend_count:
+            return False
+
+        backlog = backend.get_state_change_queue_backlog()
+        if backlog:
+            # The difference is probably waiting in the queue.
+            logger.debug("JobCache.reconcile_unfinished_job_count(): " \
+                         "Cached %d unfinished jobs, backend has %d, with " \
+                         "%d state changes pending." % (cached_count,
+                                                        backend_count,
+                                                        backlog))
+            return False
+
+        logger.warning("JobCache.reconcile_unfinished_job_count(): " \
+                       "Cached %d unfinished jobs, backend has %d. " \
+                       "Re-syncing job cache." % (cached_count, backend_count))
+        cls.resync_unfinished_jobs()
+        return True
+
+    @classmethod
+    def resync_unfinished_jobs(cls):
+        """
+        Re-loads all of the un-finished jobs from the backend. Jobs the
+        backend considers finished are moved out of the cache.
+        """
+        backend = get_job_state_backend()
+        unfinished_ids = set()
+        jobs = backend.iter_unfinished_jobs(
+                    num_segments=settings.FEEDERD_UNFINISHED_JOB_SCAN_SEGMENTS)
+        for job in jobs:
+            unfinished_ids.add(job.unique_id)
+            cls.update_job(job)
+
+        for unique_id in set(cls.CACHE.keys()) - unfinished_ids:
+            # Finished (or gone) as far as the backend is concerned.
+            try:
+                cls.update_job(backend.get_job_object_from_id(unique_id))
+            except Exception:
+                logger.warning("JobCache.resync_unfinished_jobs(): " \
+                               "Job %s is gone, un-caching it." % unique_id)
+                cls.remove_job(unique_id)
+        cls.uncache_finished_jobs()
+
     @classmethod
     def get_jobs_with_state(cls, state):
         """
@@ -110,34 +275,47 @@ class JobCache(dict):
         performed when :doc:`../feederd` starts.
         """
         # Use print here because logging isn't fully configured at this point?
-        print("Populating job cache from SimpleDB.")
-        jobs = JobStateBackend.get_unfinished_jobs()
+        print("Populating job cache from the job state backend.")
+        jobs = get_job_state_backend().iter_unfinished_jobs(
+                    num_segments=settings.FEEDERD_UNFINISHED_JOB_SCAN_SEGMENTS)
         for job in jobs:
             cls.update_job(job)
-
-        print("Jobs loaded from SDB to cache:")
-        for job in jobs:
             print('* %s (State: %s -- Finished: %s)' % (
                 job.unique_id, job.job_state,
                 job.is_finished())
             )
+        print("Jobs loaded to cache: %d" % len(cls.CACHE))
 
     @classmethod
     def refresh_jobs_with_state_changes(cls):
         """
         Looks at the state SQS queue specified by the
         :py:data:`SQS_JOB_STATE_CHANGE_QUEUE_NAME <media_nommer.conf.settings.SQS_JOB_STATE_CHANGE_QUEUE_NAME>`
-        setting and refreshes any jobs that have changed. This simply reloads
-        the job's details from SimpleDB_.
+        setting and refreshes any jobs that have changed. The job's details
+        come from the snapshot carried in each state change message. If a
+        snapshot is older than the cached copy of the job, the job's details
+        are re-loaded from SimpleDB_ instead.
+
+        If the
+        :py:data:`FEEDERD_JOB_STATE_CHANGE_DRAIN <media_nommer.conf.settings.FEEDERD_JOB_STATE_CHANGE_DRAIN>`
+        setting is ``True``, the queue is drained until empty (or until
+        :py:data:`FEEDERD_JOB_STATE_CHANGE_MAX_PER_TICK <media_nommer.conf.settings.FEEDERD_JOB_STATE_CHANGE_MAX_PER_TICK>`
+        is hit). Otherwise, only one batch of up to 10 is popped.
 
         :rtype: ``list`` of :py:class:`EncodingJob <media_nommer.core.job_state_backend.EncodingJob>`
         :returns: A list of changed :py:class:`EncodingJob` objects.
         """
         logger.debug("JobCache.refresh_jobs_with_state_changes(): " \
                     "Checking state change queue.")
-        # Pops up to 10 changed jobs that we think may have changed. There are
-        # some false alarms in here, whch brings us to...
-        popped_changed_jobs = JobStateBackend.pop_state_changes_from_queue(10)
+        backend = get_job_state_backend()
+        # Pops jobs that we think may have changed. There are some false
+        # alarms in here, whch brings us to...
+        if settings.FEEDERD_JOB_STATE_CHANGE_DRAIN:
+            popped_changed_jobs = backend.drain_state_changes_from_queue(
+                settings.FEEDERD_JOB_STATE_CHANGE_MAX_PER_TICK,
+                num_receivers=settings.FEEDERD_JOB_STATE_CHANGE_RECEIVERS)
+        else:
+            popped_changed_jobs = backend.pop_state_changes_from_queue(10)
         # A temporary list that stores the jobs that actually changed. This
         # will be returned at the completion of this method's path.
         changed_jobs = []
@@ -146,7 +324,14 @@ class JobCache(dict):
             logger.debug("Potential job state changes found: %s" % popped_changed_jobs)
             for job in popped_changed_jobs:
                 if cls.is_job_cached(job):
-                    current_state = cls.get_job(job).job_state
+                    cached_job = cls.get_job(job)
+                    if job.get_freshness_key() < \
+                       cached_job.get_freshness_key():
+                        # This snapshot is older than what we already have.
+                        # Go to the source to find out where the job is at.
+                        job = backend.get_job_object_from_id(job.unique_id)
+
+                    current_state = cached_job.job_state
                     new_state = job.job_state
 
                     if current_state != new_state:
@@ -178,9 +363,13 @@ class JobCache(dict):
         via the
         :py:data:`FEEDERD_ABANDON_INACTIVE_JOBS_THRESH <media_nommer.conf.settings.FEEDERD_ABANDON_INACTIVE_JOBS_THRESH>`
         setting.
+
+        :rtype: ``list`` of :py:class:`EncodingJob <media_nommer.core.job_state_backend.EncodingJob>`
+        :returns: The jobs that were abandoned.
         """
         logger.debug("JobCache.abandon_stale_jobs(): "\
                      "Looking for stale jobs.")
+        abandoned_jobs = []
         for id, job in cls.get_cached_jobs().items():
             if not job.is_finished():
                 now_dtime = datetime.datetime.now()
@@ -191,7 +380,20 @@ class JobCache(dict):
 
                 if inactive_seconds >= settings.FEEDERD_ABANDON_INACTIVE_JOBS_THRESH:
                     cls.remove_job(job)
-                    job.set_job_state('ABANDONED', job.job_state_details)
+                    try:
+                        job.set_job_state('ABANDONED', job.job_state_details)
+                        cls.cache_finished_job(job)
+                        abandoned_jobs.append(job)
+                    except JobVersionConflict:
+                        # A nommer updated the job since we last heard of
+                        # it, so it isn't stale after all. Pick up the
+                        # current copy instead.
+                        logger.info("JobCache.abandon_stale_jobs(): "\
+                                    "Job %s changed, not abandoning." % id)
+                        job = get_job_state_backend().get_job_object_from_id(id)
+                        if job and not job.is_finished():
+                            cls.update_job(job)
+        return abandoned_jobs
 
     @classmethod
     def uncache_finished_jobs(cls):
@@ -205,3 +407,4 @@ class JobCache(dict):
             if job.is_finished():
                 logger.info("Removing job %s from job cache." % id)
                 cls.remove_job(id)
+                cls.cache_finished_job(job)
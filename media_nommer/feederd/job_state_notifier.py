@@ -2,94 +2,647 @@
 This module contains code that handles notifying external services of state
 changes in EncodingJobs. For example, when the state changes from
 PENDING to DOWNLOADING, or ENCODING to FINISHED.
+
+Notifications go through the :py:class:`NotificationOutbox`, which keeps
+them on disk until they are delivered. Receivers that would rather get
+notifications in batches may be listed in the
+:py:data:`FEEDERD_NOTIFY_BATCH_URLS <media_nommer.conf.settings.FEEDERD_NOTIFY_BATCH_URLS>`
+setting.
+
+All notifications share one pool of persistent HTTP connections, and no
+more than
+:py:data:`FEEDERD_NOTIFY_MAX_CONNECTIONS_PER_HOST <media_nommer.conf.settings.FEEDERD_NOTIFY_MAX_CONNECTIONS_PER_HOST>`
+requests are sent to any one host at a time. Everything in here must run
+on the reactor thread. The outbox's database work is handed off to a
+thread of its own.
 """
+import os
+import json
+import time
+import random
+import sqlite3
 import urllib
-from twisted.internet import reactor
-from twisted.web.client import Agent
+import threading
+import urlparse
+from twisted.internet import reactor, task
+from twisted.internet.defer import DeferredSemaphore, succeed
+from twisted.web.client import Agent, HTTPConnectionPool, readBody, \
+    PartialDownloadError
 from twisted.web.http_headers import Headers
 
+from media_nommer.conf import settings
 from media_nommer.utils.http import StringProducer
+from media_nommer.utils.thread_pools import defer_to_named_pool
 from media_nommer.utils import logger
 
-def cb_response_received(response, unique_id, req_url):
+class CountingHTTPConnectionPool(HTTPConnectionPool):
     """
-    This is a callback function that is hit when a response comes back from
-    the remote server given in EncodingJob.notify_url. We'll just log it here
-    for troubleshooting purposes.
+    An HTTPConnectionPool that keeps track of how often connections are
+    re-used rather than opened anew.
 
-    :param str unique_id: The job's unique ID.
-    :param str req_url: The URL that we notified.
+    :ivar int num_requests: How many connections have been asked for.
+    :ivar int num_new_connections: How many of those needed a new connection.
     """
-    # Shouldn't ever happen in this case, but...
-    http_code = getattr(response, 'code', 'N/A')
+    def __init__(self, reactor, persistent=True):
+        HTTPConnectionPool.__init__(self, reactor, persistent=persistent)
+        self.num_requests = 0
+        self.num_new_connections = 0
+
+    def getConnection(self, key, endpoint):
+        self.num_requests += 1
+        return HTTPConnectionPool.getConnection(self, key, endpoint)
 
-    logger.info(
-        'Job state change notification (HTTP %s) Response received for job: %s' % (
-            http_code,
-            unique_id
-        )
-    )
+    def _newConnection(self, key, endpoint):
+        self.num_new_connections += 1
+        return HTTPConnectionPool._newConnection(self, key, endpoint)
 
-def cb_on_error(response, unique_id, req_url):
+# The following are lazy-loaded. Do not refer to directly.
+_CONNECTION_POOL = None
+_AGENT = None
+# Keys are (scheme, host, port) tuples, values are DeferredSemaphores that
+# cap the number of in-flight requests to said host.
+_HOST_SEMAPHORES = {}
+
+def get_agent():
     """
-    This is a callback function that is hit when the HTTP notification to
-    the job's callback URL failed.
+    Lazy-loading of the Agent that all notifications are sent through.
 
-    :param str unique_id: The job's unique ID.
-    :param str req_url: The URL that we attempted to notify.
+    :rtype: twisted.web.client.Agent
+    :returns: An Agent backed by the shared connection pool.
     """
-    # If no connection could be made, there won't be an HTTP code returned.
-    http_code = getattr(response, 'code', 'N/A')
+    global _CONNECTION_POOL, _AGENT
+    if _AGENT is None:
+        _CONNECTION_POOL = CountingHTTPConnectionPool(reactor, persistent=True)
+        # Keep as many idle connections around as we'll ever use at once.
+        _CONNECTION_POOL.maxPersistentPerHost = \
+            settings.FEEDERD_NOTIFY_MAX_CONNECTIONS_PER_HOST
+        _AGENT = Agent(reactor, pool=_CONNECTION_POOL)
+    return _AGENT
 
-    logger.warning(
-        'Job state change notification (HTTP %s) failed for job %s to: %s' % (
-            http_code,
-            unique_id,
-            req_url
-        )
-    )
+def get_host_semaphore(url):
+    """
+    Lazy-loading of the per-host semaphores that cap in-flight requests.
 
-def send_notification(job):
+    :param str url: The URL about to be requested.
+    :rtype: twisted.internet.defer.DeferredSemaphore
+    :returns: The semaphore for the URL's host.
     """
-    Given an EncodingJob, see if it has a ``notify_url`` set, and dispatch
-    a notification to said URL (if set). Don't do any processing of the response.
+    parsed = urlparse.urlparse(url)
+    key = (parsed.scheme, parsed.hostname, parsed.port)
+    semaphore = _HOST_SEMAPHORES.get(key)
+    if semaphore is None:
+        semaphore = DeferredSemaphore(
+            settings.FEEDERD_NOTIFY_MAX_CONNECTIONS_PER_HOST)
+        _HOST_SEMAPHORES[key] = semaphore
+    return semaphore
 
-    :param EncodingJob job: The job whose state has changed.
+def post_to_url(url, headers, body):
+    """
+    POSTs to a URL through the shared connection pool, waiting its turn
+    behind any other requests to the same host. The response body is read
+    (and thrown away), so the connection can go back into the pool.
+
+    :param str url: The URL to POST to.
+    :param Headers headers: The request headers.
+    :param body: An IBodyProducer with the request body, or ``None``.
+    :rtype: Deferred
+    :returns: A Deferred that fires with the response once its body has
+        been read.
+    """
+    def request():
+        deferred = get_agent().request('POST', url, headers, body)
+        deferred.addCallback(cb_read_body)
+        return deferred
+    return get_host_semaphore(url).run(request)
+
+def cb_read_body(response):
     """
-    if not job.notify_url:
-        # No URL to notify, hang it up here.
-        return
+    Reads and discards a response's body.
 
+    :returns: A Deferred that fires with the response.
+    """
+    deferred = readBody(response)
+    # Responses without a Content-Length are fine by us.
+    deferred.addErrback(lambda failure: failure.trap(PartialDownloadError))
+    deferred.addCallback(lambda result: response)
+    return deferred
+
+def get_connection_stats():
+    """
+    :rtype: dict
+    :returns: A dict with the number of notification ``requests`` made so
+        far, and how many of them used a ``new`` or ``reused`` connection.
+    """
+    if _CONNECTION_POOL is None:
+        return {'requests': 0, 'new': 0, 'reused': 0}
+    requests = _CONNECTION_POOL.num_requests
+    new = _CONNECTION_POOL.num_new_connections
+    return {'requests': requests, 'new': new, 'reused': requests - new}
+
+def get_notification_data(job):
+    """
+    :param EncodingJob job: The job whose state has changed.
+    :rtype: dict
+    :returns: The details about the job that are sent to its ``notify_url``.
+    """
     job_state_details = job.job_state_details
     if not job_state_details:
         # Make sure we're not passing a 'None' string in like a silly boy.
         job_state_details = ''
 
-    # This will be JSON-serialized and POSTed to the notify_url.
-    data = {
+    return {
         'unique_id': job.unique_id,
         'job_state': job.job_state,
         'job_state_details': job_state_details,
     }
 
-    agent = Agent(reactor)
-    headers = Headers({
+def get_notification_headers(content_type='application/x-www-form-urlencoded'):
+    """
+    :keyword str content_type: The notification body's content type.
+    :rtype: Headers
+    :returns: The headers sent along with notifications.
+    """
+    return Headers({
         'User-Agent': ['media-nommer feederd'],
-        'Content-Type': ['application/x-www-form-urlencoded'],
+        'Content-Type': [content_type],
     })
-    body = StringProducer(urllib.urlencode(data)) if data else None
-    
-    request_deferred = agent.request(
-        'POST',
+
+def is_batched_url(notify_url):
+    """
+    :param str notify_url: A job's ``notify_url``.
+    :rtype: bool
+    :returns: ``True`` if notifications to this URL are coalesced into
+        batches, as per the
+        :py:data:`FEEDERD_NOTIFY_BATCH_URLS <media_nommer.conf.settings.FEEDERD_NOTIFY_BATCH_URLS>`
+        setting.
+    """
+    for prefix in settings.FEEDERD_NOTIFY_BATCH_URLS:
+        if notify_url.startswith(prefix):
+            return True
+    return False
+
+class NotificationOutbox(object):
+    """
+    Notifications waiting to be delivered, kept in an SQLite database at
+    :py:data:`FEEDERD_NOTIFICATION_OUTBOX_DB_PATH <media_nommer.conf.settings.FEEDERD_NOTIFICATION_OUTBOX_DB_PATH>`
+    so they survive :doc:`../feederd` restarts. A notification is only
+    removed once the receiver has accepted it. Failed deliveries are retried
+    with exponential backoff, and each job's notifications are delivered
+    one at a time, in the order they were sent.
+
+    Each notification has an ordering key, and only one notification per
+    key is delivered at a time. Normally, the key is the job's unique ID.
+    Notifications to URLs that take batches share a key per URL (prefixed
+    with :py:attr:`BATCH_KEY_PREFIX`), and everything waiting under that key
+    goes out together as one JSON array.
+
+    Everything in here must be called from the reactor thread, unless noted
+    otherwise. Database work is run in the :py:attr:`DB_POOL_NAME` thread
+    pool, which has a single thread so that writes happen in the order they
+    were asked for.
+    """
+    BATCH_KEY_PREFIX = 'batch:'
+    """Ordering keys of batched notifications start with this."""
+    DB_POOL_NAME = 'feederd-notification-outbox'
+    """The name of the thread pool that database work is run in."""
+
+    # Each thread's SQLite connection, and the database it's connected to.
+    # Do not refer to directly, use _get_db_connection().
+    __local = threading.local()
+    # True while pump() is waiting on the database.
+    _pumping = False
+    # Set if pump() was called while already pumping.
+    _pump_again = False
+    # Notifications being delivered right now. Keys are the outbox row ID of
+    # the first (or only) notification being delivered, values are ordering
+    # keys.
+    IN_FLIGHT = {}
+    # Periodically delivers anything that has come due.
+    _pump_loop = None
+    # A pending reactor.callLater() of pump(), if any.
+    _pump_call = None
+    # HTTP codes that mean the receiver is having trouble, and we should
+    # try again later. Anything else in the 4xx range won't get any better.
+    RETRYABLE_CLIENT_ERROR_CODES = [408, 429]
+
+    @classmethod
+    def _get_db_connection(cls):
+        """
+        Lazy-loading of this thread's SQLite connection. Refer to this instead
+        of referencing cls.__local directly.
+
+        :returns: An SQLite connection in autocommit mode.
+        """
+        db_path = os.path.expanduser(
+            settings.FEEDERD_NOTIFICATION_OUTBOX_DB_PATH)
+        if getattr(cls.__local, 'db_path', None) != db_path:
+            # Either the first connection in this thread, or the setting has
+            # been changed to point at another database.
+            conn = sqlite3.connect(db_path, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            # Durable enough to survive a feederd crash, without an fsync
+            # on every delivery.
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            # unique_id is the ordering key, see the class docstring.
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS outbox ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "unique_id TEXT NOT NULL, "
+                "notify_url TEXT NOT NULL, "
+                "body TEXT NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, "
+                "next_attempt_at REAL NOT NULL)")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS outbox_unique_id "
+                "ON outbox (unique_id, id)")
+            cls.__local.connection = conn
+            cls.__local.db_path = db_path
+        return cls.__local.connection
+
+    @classmethod
+    def _defer_to_db(cls, func, *args, **kwargs):
+        """
+        Runs a blocking database call in the :py:attr:`DB_POOL_NAME` thread
+        pool.
+
+        :param callable func: The blocking callable. Any other args and
+            kwargs are passed on to it.
+        :rtype: Deferred
+        :returns: A Deferred that fires with the call's return value.
+        """
+        return defer_to_named_pool(cls.DB_POOL_NAME, 1, func, *args, **kwargs)
+
+    @classmethod
+    def add(cls, entries, delay=0):
+        """
+        Adds notifications to the outbox, and starts delivering them.
+
+        :param list entries: A list of ``(key, notify_url, body)`` tuples.
+            See the class docstring for ordering keys. Bodies are
+            form-encoded strings, or JSON objects for batched notifications.
+        :keyword float delay: Hold the notifications for this many seconds
+            before delivering them.
+        :rtype: Deferred
+        :returns: A Deferred that fires once the notifications are on disk.
+        """
+        if not entries:
+            return succeed(None)
+        deferred = cls._defer_to_db(cls._insert_rows, entries, delay)
+        deferred.addCallback(lambda result: cls.pump())
+        return deferred
+
+    @classmethod
+    def _insert_rows(cls, entries, delay):
+        """
+        Writes notifications to the outbox. Runs in the database thread.
+
+        :param list entries: A list of ``(key, notify_url, body)`` tuples.
+        :param float delay: How many seconds to hold the notifications for.
+        """
+        conn = cls._get_db_connection()
+        next_attempt_at = time.time() + delay
+        conn.execute("BEGIN")
+        try:
+            conn.executemany(
+                "INSERT INTO outbox (unique_id, notify_url, body, "
+                "next_attempt_at) VALUES (?, ?, ?, ?)",
+                [(key, notify_url, body, next_attempt_at)
+                 for key, notify_url, body in entries])
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+
+    @classmethod
+    def get_num_pending(cls):
+        """
+        Blocks on the database, so keep this off the reactor thread.
+
+        :rtype: int
+        :returns: The number of notifications waiting to be delivered.
+        """
+        return cls._get_db_connection().execute(
+            "SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    @classmethod
+    def _get_due_rows(cls, limit, busy_keys=None):
+        """
+        Finds notifications that are ready to go out. Only the oldest
+        notification for each ordering key is considered, and only if no
+        other notification with the key is in flight. Runs in the database
+        thread.
+
+        :param int limit: The most notifications to return.
+        :keyword set busy_keys: The ordering keys with notifications in
+            flight. Defaults to those in :py:attr:`IN_FLIGHT`, which is only
+            safe to read from the reactor thread.
+        :rtype: list
+        :returns: A list of outbox rows, oldest first.
+        """
+        if busy_keys is None:
+            busy_keys = set(cls.IN_FLIGHT.values())
+        rows = cls._get_db_connection().execute(
+            "SELECT * FROM outbox WHERE id IN "
+            "(SELECT MIN(id) FROM outbox GROUP BY unique_id) "
+            "AND next_attempt_at <= ? ORDER BY id LIMIT ?",
+            (time.time(), limit + len(busy_keys))).fetchall()
+        rows = [row for row in rows if row['unique_id'] not in busy_keys]
+        return rows[:limit]
+
+    @classmethod
+    def _get_batch_rows(cls, key):
+        """
+        Runs in the database thread.
+
+        :param str key: A batch ordering key.
+        :rtype: list
+        :returns: The oldest notifications waiting under the key, up to
+            :py:data:`FEEDERD_NOTIFY_BATCH_MAX_SIZE <media_nommer.conf.settings.FEEDERD_NOTIFY_BATCH_MAX_SIZE>`
+            of them.
+        """
+        return cls._get_db_connection().execute(
+            "SELECT * FROM outbox WHERE unique_id = ? ORDER BY id LIMIT ?",
+            (key, settings.FEEDERD_NOTIFY_BATCH_MAX_SIZE)).fetchall()
+
+    @classmethod
+    def _get_batch_body(cls, rows):
+        """
+        Collapses a batch of notifications down to the latest one for each
+        job.
+
+        :param list rows: The batch's outbox rows, oldest first.
+        :rtype: str
+        :returns: A JSON array of notifications, in the order the jobs
+            last changed.
+        """
+        latest = {}
+        for index, row in enumerate(rows):
+            data = json.loads(row['body'])
+            latest[data['unique_id']] = (index, data)
+        return json.dumps([data for index, data in sorted(latest.values())])
+
+    @classmethod
+    def _get_due_deliveries(cls, limit, busy_keys):
+        """
+        Gathers up the notifications that are ready to go out, with their
+        request bodies. Runs in the database thread.
+
+        :param int limit: The most deliveries to return.
+        :param set busy_keys: The ordering keys with notifications in flight.
+        :rtype: list
+        :returns: A list of ``(rows, body, content_type)`` tuples, one for
+            each delivery.
+        """
+        deliveries = []
+        for row in cls._get_due_rows(limit, busy_keys):
+            if row['unique_id'].startswith(cls.BATCH_KEY_PREFIX):
+                rows = cls._get_batch_rows(row['unique_id'])
+                deliveries.append((rows, cls._get_batch_body(rows),
+                                   'application/json'))
+            else:
+                deliveries.append(([row], row['body'],
+                                   'application/x-www-form-urlencoded'))
+        return deliveries
+
+    @classmethod
+    def pump(cls):
+        """
+        Starts delivering any notifications that have come due, up to
+        :py:data:`FEEDERD_NOTIFY_MAX_IN_FLIGHT <media_nommer.conf.settings.FEEDERD_NOTIFY_MAX_IN_FLIGHT>`
+        at a time. Only one lookup runs at a time, so nothing is delivered
+        twice. Calls made while one is running are rolled into another
+        lookup once it's done.
+
+        :rtype: Deferred
+        :returns: A Deferred that fires once the due notifications are on
+            their way.
+        """
+        if cls._pumping:
+            cls._pump_again = True
+            return succeed(None)
+        room = settings.FEEDERD_NOTIFY_MAX_IN_FLIGHT - len(cls.IN_FLIGHT)
+        if room <= 0:
+            return succeed(None)
+
+        cls._pumping = True
+        cls._pump_again = False
+        deferred = cls._defer_to_db(cls._get_due_deliveries, room,
+                                    set(cls.IN_FLIGHT.values()))
+        deferred.addCallback(cls._cb_deliver_all)
+        deferred.addErrback(
+            lambda failure: logger.error(failure.getTraceback()))
+        deferred.addBoth(cls._cb_pump_done)
+        return deferred
+
+    @classmethod
+    def _cb_deliver_all(cls, deliveries):
+        """
+        Sends each of the deliveries found by :py:meth:`pump`.
+
+        :param list deliveries: As per :py:meth:`_get_due_deliveries`.
+        """
+        for rows, body, content_type in deliveries:
+            cls._deliver(rows, body, content_type)
+
+    @classmethod
+    def _cb_pump_done(cls, result):
+        """
+        Lets the next :py:meth:`pump` through, and runs it right away if one
+        was asked for in the meantime.
+        """
+        cls._pumping = False
+        if cls._pump_again:
+            return cls.pump()
+
+    @classmethod
+    def _deliver(cls, rows, body, content_type):
+        """
+        Sends a notification.
+
+        :param list rows: The outbox rows being delivered. All have the same
+            ordering key and notify_url.
+        :param str body: The request body.
+        :param str content_type: The body's content type.
+        """
+        cls.IN_FLIGHT[rows[0]['id']] = rows[0]['unique_id']
+        headers = get_notification_headers(content_type)
+        deferred = post_to_url(str(rows[0]['notify_url']), headers,
+                               StringProducer(str(body)))
+        deferred.addCallbacks(cls._cb_response_received,
+                              cls._eb_delivery_failed,
+                              callbackArgs=(rows,), errbackArgs=(rows,))
+        deferred.addErrback(
+            lambda failure: logger.error(failure.getTraceback()))
+        deferred.addBoth(cls._cb_delivery_done, rows)
+
+    @classmethod
+    def _cb_response_received(cls, response, rows):
+        """
+        Removes the notification from the outbox if the receiver accepted
+        it, otherwise schedules a retry.
+
+        :param response: The receiver's response.
+        :param list rows: The outbox rows that were delivered.
+        :rtype: Deferred
+        :returns: A Deferred that fires once the outbox has been updated.
+        """
+        code = response.code
+        key = rows[0]['unique_id']
+        if code < 400:
+            logger.info("Job state change notification (HTTP %d) " \
+                        "delivered for job: %s" % (code, key))
+            return cls._remove(rows)
+        elif code >= 500 or code in cls.RETRYABLE_CLIENT_ERROR_CODES:
+            return cls._schedule_retry(rows, 'HTTP %d' % code)
+        else:
+            logger.warning("Job state change notification (HTTP %d) " \
+                           "rejected for job %s, giving up: %s" % (
+                                code, key, rows[0]['notify_url']))
+            return cls._remove(rows)
+
+    @classmethod
+    def _eb_delivery_failed(cls, failure, rows):
+        """
+        Schedules a retry after the notification couldn't be sent at all
+        (connection refused, for example).
+
+        :param failure: The Failure.
+        :param list rows: The outbox rows that couldn't be delivered.
+        :rtype: Deferred
+        :returns: A Deferred that fires once the retry is on disk.
+        """
+        return cls._schedule_retry(rows, failure.getErrorMessage())
+
+    @classmethod
+    def _cb_delivery_done(cls, result, rows):
+        """
+        Makes room for more deliveries once one finishes, one way or another.
+        """
+        cls.IN_FLIGHT.pop(rows[0]['id'], None)
+        # Send this job's next notification, if it has one. Deliveries that
+        # finish together share a single pump.
+        if cls._pump_call is None or not cls._pump_call.active():
+            cls._pump_call = reactor.callLater(0, cls.pump)
+
+    @classmethod
+    def _remove(cls, rows):
+        """
+        :param list rows: The outbox rows to remove.
+        :rtype: Deferred
+        :returns: A Deferred that fires once they're gone.
+        """
+        return cls._defer_to_db(cls._delete_rows, rows)
+
+    @classmethod
+    def _delete_rows(cls, rows):
+        """
+        Runs in the database thread.
+
+        :param list rows: The outbox rows to delete.
+        """
+        cls._get_db_connection().executemany(
+            "DELETE FROM outbox WHERE id = ?", [(row['id'],) for row in rows])
+
+    @classmethod
+    def _schedule_retry(cls, rows, reason):
+        """
+        Puts notifications off for a while, backing off exponentially with
+        each failed attempt. Gives up after
+        :py:data:`FEEDERD_NOTIFY_MAX_ATTEMPTS <media_nommer.conf.settings.FEEDERD_NOTIFY_MAX_ATTEMPTS>`.
+
+        :param list rows: The outbox rows that failed.
+        :param str reason: Why they failed.
+        :rtype: Deferred
+        :returns: A Deferred that fires once the outbox has been updated.
+        """
+        key = rows[0]['unique_id']
+        attempts = rows[0]['attempts'] + 1
+        if attempts >= settings.FEEDERD_NOTIFY_MAX_ATTEMPTS:
+            logger.error("Job state change notification failed for job %s " \
+                         "after %d attempts (%s), giving up: %s" % (
+                            key, attempts, reason, rows[0]['notify_url']))
+            return cls._remove(rows)
+
+        delay = min(settings.FEEDERD_NOTIFY_RETRY_BASE_DELAY * 2 ** (attempts - 1),
+                    settings.FEEDERD_NOTIFY_RETRY_MAX_DELAY)
+        # Jitter, so everything that failed together doesn't retry together.
+        delay *= random.uniform(0.5, 1.0)
+        logger.warning("Job state change notification failed for job %s " \
+                       "(%s), retrying in %.0f seconds: %s" % (
+                            key, reason, delay, rows[0]['notify_url']))
+        return cls._defer_to_db(cls._postpone_rows, rows, attempts,
+                                time.time() + delay)
+
+    @classmethod
+    def _postpone_rows(cls, rows, attempts, next_attempt_at):
+        """
+        Runs in the database thread.
+
+        :param list rows: The outbox rows to put off.
+        :param int attempts: How many delivery attempts have been made.
+        :param float next_attempt_at: When to try again, as a UNIX timestamp.
+        """
+        cls._get_db_connection().executemany(
+            "UPDATE outbox SET attempts = ?, next_attempt_at = ? WHERE id = ?",
+            [(attempts, next_attempt_at, row['id']) for row in rows])
+
+    @classmethod
+    def start(cls):
+        """
+        Starts periodically delivering notifications, including any left
+        over from before a restart. Called when :doc:`../feederd` starts.
+        """
+        if cls._pump_loop is None:
+            cls._pump_loop = task.LoopingCall(cls.pump)
+            cls._pump_loop.start(settings.FEEDERD_NOTIFY_RETRY_CHECK_INTERVAL,
+                                 now=True)
+
+def send_notification(job):
+    """
+    Given an EncodingJob, see if it has a ``notify_url`` set, and queue
+    a notification to said URL (if set) in the :py:class:`NotificationOutbox`.
+    Must be called from the reactor thread.
+
+    :param EncodingJob job: The job whose state has changed.
+    """
+    send_notifications([job])
+
+def send_notifications(jobs):
+    """
+    Queues notifications for a list of jobs, as per
+    :py:func:`send_notification`, and logs how well connections are being
+    re-used. Must be called from the reactor thread.
+
+    Notifications to URLs in
+    :py:data:`FEEDERD_NOTIFY_BATCH_URLS <media_nommer.conf.settings.FEEDERD_NOTIFY_BATCH_URLS>`
+    are held for
+    :py:data:`FEEDERD_NOTIFY_BATCH_WINDOW <media_nommer.conf.settings.FEEDERD_NOTIFY_BATCH_WINDOW>`
+    seconds, then sent together.
+
+    :param list jobs: The EncodingJobs whose state has changed.
+    """
+    entries = []
+    batched_entries = []
+    for job in jobs:
+        if not job.notify_url:
+            # No URL to notify, hang it up here.
+            continue
         # TODO: See if Twisted can be made to accept unicode.
-        str(job.notify_url),
-        headers,
-        body)
-
-    cb_args = (job.unique_id, job.notify_url)
-    # This callback will handle the success only.
-    request_deferred.addCallbacks(
-        cb_response_received,
-        cb_on_error,
-        callbackArgs=cb_args,
-        errbackArgs=cb_args)
\ No newline at end of file
+        notify_url = str(job.notify_url)
+        data = get_notification_data(job)
+        if is_batched_url(notify_url):
+            key = NotificationOutbox.BATCH_KEY_PREFIX + notify_url
+            batched_entries.append((key, notify_url, json.dumps(data)))
+        else:
+            entries.append((job.unique_id, notify_url, urllib.urlencode(data)))
+
+    NotificationOutbox.add(entries)
+    NotificationOutbox.add(batched_entries,
+                           delay=settings.FEEDERD_NOTIFY_BATCH_WINDOW)
+
+    if jobs:
+        stats = get_connection_stats()
+        logger.debug("Notification connections: %d requests, " \
+                     "%d new, %d reused." % (stats['requests'], stats['new'],
+                                             stats['reused']))
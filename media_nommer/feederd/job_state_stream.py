@@ -0,0 +1,295 @@
+"""
+This module keeps a short, in-memory log of job state changes for the
+``/job/events`` JSON API call to stream to watchers. Rather than having
+dashboards and the like poll for job state, they hold a connection open
+(either as a long-poll or as a stream of server-sent events) and are handed
+state changes as :doc:`../feederd` finds out about them.
+
+Each state change is given a sequence number. Watchers resume where they
+left off by passing the cursor of the last event they saw. Cursors include
+an ID that is unique to each run of :doc:`../feederd`, so cursors from
+before a restart are recognized as such.
+
+Everything in here must be called from the reactor thread. Threads should
+use :py:func:`publish_jobs_from_thread`.
+"""
+import json
+import time
+from collections import deque
+from twisted.internet import reactor, task
+from media_nommer.conf import settings
+from media_nommer.utils import logger
+
+class JobStateWatcher(object):
+    """
+    Something waiting to hear about job state changes. Sub-classes handle
+    getting the events to the user.
+    """
+    def __init__(self, unique_ids=None):
+        """
+        :keyword list unique_ids: If specified, only events for these jobs
+            are sent to the watcher.
+        """
+        self.unique_ids = set(unique_ids) if unique_ids else None
+
+    def send(self, events):
+        """
+        Hands events to the watcher.
+
+        :param list events: A list of event dicts, oldest first.
+        """
+        raise NotImplementedError
+
+
+class LongPollWatcher(JobStateWatcher):
+    """
+    Waits for the next batch of events, then stops watching. Fires
+    :py:attr:`deferred` with the events, or an empty list if
+    :py:data:`FEEDERD_JOB_STATE_LONG_POLL_TIMEOUT <media_nommer.conf.settings.FEEDERD_JOB_STATE_LONG_POLL_TIMEOUT>`
+    passes first.
+
+    :ivar Deferred deferred: Fires with a list of events.
+    """
+    def __init__(self, deferred, unique_ids=None):
+        """
+        :param Deferred deferred: Fired with the events.
+        :keyword list unique_ids: See :py:class:`JobStateWatcher`.
+        """
+        JobStateWatcher.__init__(self, unique_ids=unique_ids)
+        self.deferred = deferred
+        self.timeout_call = reactor.callLater(
+            settings.FEEDERD_JOB_STATE_LONG_POLL_TIMEOUT, self.send, [])
+
+    def send(self, events):
+        JobStateStream.remove_watcher(self)
+        if self.timeout_call.active():
+            self.timeout_call.cancel()
+        if not self.deferred.called:
+            self.deferred.callback(events)
+
+    def cancel(self):
+        """
+        Stops watching without firing the Deferred. Used when the client
+        goes away.
+        """
+        JobStateStream.remove_watcher(self)
+        if self.timeout_call.active():
+            self.timeout_call.cancel()
+
+
+class EventStreamWatcher(JobStateWatcher):
+    """
+    Writes events to an open request as server-sent events, until the client
+    disconnects.
+    """
+    def __init__(self, request, unique_ids=None):
+        """
+        :param request: The request to write events to.
+        :keyword list unique_ids: See :py:class:`JobStateWatcher`.
+        """
+        JobStateWatcher.__init__(self, unique_ids=unique_ids)
+        self.request = request
+
+    def send(self, events):
+        lines = []
+        for event in events:
+            lines.append('id: %s\nevent: job_state\ndata: %s\n\n' % (
+                event['cursor'], json.dumps(event)))
+        self.request.write(''.join(lines))
+
+    def send_keepalive(self):
+        """
+        Writes an SSE comment, which keeps proxies from timing out the
+        connection.
+        """
+        self.request.write(':\n\n')
+
+
+class JobStateStream(object):
+    """
+    The log of recent job state changes, and the watchers waiting on them.
+    """
+    # Unique to this run of feederd, so stale cursors can be spotted.
+    RUN_ID = '%x' % int(time.time() * 1000)
+    # The sequence number of the most recent event.
+    LAST_SEQ = 0
+    # The most recent events, oldest first.
+    EVENTS = deque()
+    # Watchers that want to hear about every job.
+    WATCHERS_ALL = set()
+    # Watchers that only want to hear about certain jobs. Keys are job
+    # unique IDs, values are sets of watchers.
+    WATCHERS_BY_JOB_ID = {}
+    # Sends keepalives to EventStreamWatchers while there are any.
+    _keepalive_loop = None
+
+    @classmethod
+    def get_cursor(cls, seq=None):
+        """
+        :keyword int seq: A sequence number. Defaults to that of the most
+            recent event.
+        :rtype: str
+        :returns: A cursor for the given sequence number.
+        """
+        if seq is None:
+            seq = cls.LAST_SEQ
+        return '%s-%d' % (cls.RUN_ID, seq)
+
+    @classmethod
+    def parse_cursor(cls, cursor):
+        """
+        :param str cursor: A cursor, as per :py:meth:`get_cursor`.
+        :rtype: int or ``None``
+        :returns: The sequence number, or ``None`` if the cursor is invalid
+            or from a different run of :doc:`../feederd`.
+        """
+        try:
+            run_id, seq = str(cursor).rsplit('-', 1)
+            seq = int(seq)
+        except ValueError:
+            return None
+        if run_id != cls.RUN_ID or seq > cls.LAST_SEQ:
+            return None
+        return seq
+
+    @classmethod
+    def publish_jobs(cls, jobs):
+        """
+        Logs a state change event for each job, and sends the events to
+        anyone watching.
+
+        :param list jobs: A list of
+            :py:class:`EncodingJob <media_nommer.core.job_state_backend.EncodingJob>`
+            instances whose state has changed.
+        """
+        events = []
+        for job in jobs:
+            cls.LAST_SEQ += 1
+            events.append({
+                'cursor': cls.get_cursor(),
+                'seq': cls.LAST_SEQ,
+                'job_id': job.unique_id,
+                'job_state': job.job_state,
+                'job_state_details': job.job_state_details,
+                'last_modified_dtime': job._get_string_from_dtime(
+                    job.last_modified_dtime),
+            })
+        if not events:
+            return
+
+        cls.EVENTS.extend(events)
+        while len(cls.EVENTS) > settings.FEEDERD_JOB_STATE_STREAM_BACKLOG:
+            cls.EVENTS.popleft()
+
+        # Group the events up by watcher, so each only gets one send().
+        watcher_events = {}
+        for watcher in cls.WATCHERS_ALL:
+            watcher_events[watcher] = events
+        for event in events:
+            for watcher in cls.WATCHERS_BY_JOB_ID.get(event['job_id'], ()):
+                watcher_events.setdefault(watcher, []).append(event)
+
+        for watcher, watcher_batch in watcher_events.items():
+            try:
+                watcher.send(watcher_batch)
+            except Exception:
+                # One bad watcher shouldn't keep the rest from hearing.
+                logger.error("JobStateStream.publish_jobs(): " \
+                             "Unable to send events to %s" % watcher)
+                cls.remove_watcher(watcher)
+
+    @classmethod
+    def get_events_since(cls, seq, unique_ids=None):
+        """
+        :param int seq: Return events that came after this sequence number.
+        :keyword list unique_ids: If specified, only return events for
+            these jobs.
+        :rtype: tuple
+        :returns: A tuple with a list of events, and a bool that is ``True``
+            if some events after ``seq`` have already been dropped from
+            the log.
+        """
+        events = [event for event in cls.EVENTS if event['seq'] > seq]
+        if cls.EVENTS:
+            missed = cls.EVENTS[0]['seq'] > seq + 1
+        else:
+            missed = cls.LAST_SEQ > seq
+        if unique_ids:
+            events = [event for event in events
+                      if event['job_id'] in unique_ids]
+        return events, missed
+
+    @classmethod
+    def add_watcher(cls, watcher):
+        """
+        Starts sending events to a watcher.
+
+        :param JobStateWatcher watcher: The watcher to add.
+        """
+        if watcher.unique_ids:
+            for unique_id in watcher.unique_ids:
+                cls.WATCHERS_BY_JOB_ID.setdefault(unique_id, set()).add(watcher)
+        else:
+            cls.WATCHERS_ALL.add(watcher)
+
+        if isinstance(watcher, EventStreamWatcher) and \
+           cls._keepalive_loop is None:
+            cls._keepalive_loop = task.LoopingCall(cls._send_keepalives)
+            cls._keepalive_loop.start(
+                settings.FEEDERD_JOB_STATE_STREAM_KEEPALIVE_INTERVAL,
+                now=False)
+
+    @classmethod
+    def remove_watcher(cls, watcher):
+        """
+        Stops sending events to a watcher. Harmless if the watcher has
+        already been removed.
+
+        :param JobStateWatcher watcher: The watcher to remove.
+        """
+        cls.WATCHERS_ALL.discard(watcher)
+        for unique_id in watcher.unique_ids or ():
+            watchers = cls.WATCHERS_BY_JOB_ID.get(unique_id)
+            if watchers is not None:
+                watchers.discard(watcher)
+                if not watchers:
+                    del cls.WATCHERS_BY_JOB_ID[unique_id]
+
+    @classmethod
+    def get_watchers(cls):
+        """
+        :rtype: set
+        :returns: All current watchers.
+        """
+        watchers = set(cls.WATCHERS_ALL)
+        for job_watchers in cls.WATCHERS_BY_JOB_ID.values():
+            watchers.update(job_watchers)
+        return watchers
+
+    @classmethod
+    def _send_keepalives(cls):
+        """
+        Sends a keepalive to each EventStreamWatcher. Stops the keepalive
+        loop once there are none left.
+        """
+        stream_watchers = [watcher for watcher in cls.get_watchers()
+                           if isinstance(watcher, EventStreamWatcher)]
+        if not stream_watchers:
+            cls._keepalive_loop.stop()
+            cls._keepalive_loop = None
+            return
+        for watcher in stream_watchers:
+            watcher.send_keepalive()
+
+def publish_jobs_from_thread(jobs):
+    """
+    Publishes job state changes from outside of the reactor thread (from
+    an interval task, for example). All of the jobs go out in a single
+    reactor callback.
+
+    :param list jobs: A list of
+        :py:class:`EncodingJob <media_nommer.core.job_state_backend.EncodingJob>`
+        instances whose state has changed.
+    """
+    if jobs:
+        reactor.callFromThread(JobStateStream.publish_jobs, list(jobs))
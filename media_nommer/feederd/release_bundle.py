@@ -0,0 +1,241 @@
+"""
+Release bundles let freshly spawned EC2_ instances install the same
+media-nommer code that :doc:`../feederd` is running, without a trip to
+GitHub. When :doc:`../feederd` starts, it packs up its copy of
+:py:mod:`media_nommer` (along with a pinned list of its dependencies) into a
+tarball, and uploads it to the
+:py:data:`CONFIG_S3_BUCKET <media_nommer.conf.settings.CONFIG_S3_BUCKET>`
+next to ``nomconf.py``.
+
+Bundles are named after a hash of their contents, so an unchanged bundle
+is never re-uploaded, and instances keep downloaded bundles in
+:py:data:`EC2_RELEASE_BUNDLE_CACHE_DIR <media_nommer.conf.settings.EC2_RELEASE_BUNDLE_CACHE_DIR>`
+in case they're baked into an AMI.
+
+Each bundle contains:
+
+* ``media_nommer/``, the package itself.
+* ``requirements.txt``, the exact versions of the dependencies
+  :doc:`../feederd` is running with. These are always installed, from PyPI
+  if there are no wheels (which does nothing if the AMI already has the
+  same versions).
+* ``wheels/``, wheels for said dependencies, if
+  :py:data:`EC2_RELEASE_BUNDLE_INCLUDE_DEPENDENCIES <media_nommer.conf.settings.EC2_RELEASE_BUNDLE_INCLUDE_DEPENDENCIES>`
+  is ``True``.
+* ``install.sh``, which installs all of the above into the instance's
+  virtualenv. Like ``setup.py``, it puts the Twisted_ plugins in place and
+  re-generates Twisted's plugin cache, so ``twistd`` finds them.
+"""
+import os
+import shutil
+import hashlib
+import tarfile
+import tempfile
+import subprocess
+import pkg_resources
+import boto
+import media_nommer
+from media_nommer.conf import settings
+from media_nommer.utils import logger
+
+# The dependencies pinned in each bundle's requirements.txt.
+DEPENDENCIES = ['boto', 'twisted', 'qtfaststart']
+# The S3 key prefix that bundles are uploaded under.
+S3_KEY_PREFIX = 'bundles/'
+# The virtualenv media-nommer runs out of on the EC2 instances.
+NODE_VIRTUALENV = '/home/nom/.virtualenvs/media_nommer'
+
+INSTALL_SCRIPT = """#!/bin/sh
+# Installs this media-nommer release bundle into the node's virtualenv.
+set -e
+cd "$(dirname "$0")"
+VIRTUALENV=${VIRTUALENV:-%(virtualenv)s}
+if [ -d wheels ]; then
+    "$VIRTUALENV/bin/pip" install --no-index --find-links wheels \\
+        -r requirements.txt
+else
+    "$VIRTUALENV/bin/pip" install -r requirements.txt
+fi
+SITE_PACKAGES=$("$VIRTUALENV/bin/python" -c \\
+    "from distutils.sysconfig import get_python_lib; print(get_python_lib())")
+rm -rf "$SITE_PACKAGES/media_nommer"
+cp -R media_nommer "$SITE_PACKAGES/media_nommer"
+mkdir -p "$SITE_PACKAGES/twisted/plugins"
+for plugin in %(plugins)s; do
+    rm -f "$SITE_PACKAGES/twisted/plugins/$plugin"c
+    cp "media_nommer/twisted/plugins/$plugin" "$SITE_PACKAGES/twisted/plugins/"
+done
+"$VIRTUALENV/bin/python" -c \\
+    "from twisted.plugin import IPlugin, getPlugins; list(getPlugins(IPlugin))"
+"""
+# The Twisted plugins that setup.py installs into twisted/plugins.
+TWISTED_PLUGINS = ['feederd.py', 'ec2nommerd.py']
+
+# The S3 key of the bundle uploaded by this feederd, once it has been.
+PUBLISHED_KEY = None
+
+def get_pinned_requirements():
+    """
+    :rtype: list
+    :returns: A list of ``name==version`` strings for the dependencies
+        that are installed here. Those that aren't are left out.
+    """
+    requirements = []
+    for name in DEPENDENCIES:
+        try:
+            version = pkg_resources.get_distribution(name).version
+        except pkg_resources.DistributionNotFound:
+            logger.warning("release_bundle.get_pinned_requirements(): " \
+                           "%s isn't installed, leaving it out." % name)
+            continue
+        requirements.append('%s==%s' % (name, version))
+    return requirements
+
+def _iter_package_files():
+    """
+    :rtype: generator
+    :returns: Yields ``(path, archive_name)`` tuples for each file in the
+        :py:mod:`media_nommer` package, in a stable order. Byte-code is
+        skipped.
+    """
+    package_dir = os.path.dirname(os.path.abspath(media_nommer.__file__))
+    root_dir = os.path.dirname(package_dir)
+    for dir_path, dir_names, file_names in os.walk(package_dir):
+        dir_names.sort()
+        for file_name in sorted(file_names):
+            if file_name.endswith(('.pyc', '.pyo')):
+                continue
+            path = os.path.join(dir_path, file_name)
+            yield path, os.path.relpath(path, root_dir)
+
+def build_bundle(dest_dir):
+    """
+    Builds a release bundle.
+
+    :param str dest_dir: The directory to write the bundle to.
+    :rtype: str
+    :returns: The path to the bundle. The filename includes the
+        media-nommer version and a hash of the bundle's contents.
+    """
+    requirements = '\n'.join(get_pinned_requirements()) + '\n'
+    install_script = INSTALL_SCRIPT % {
+        'virtualenv': NODE_VIRTUALENV,
+        'plugins': ' '.join(TWISTED_PLUGINS),
+    }
+
+    # Hash the contents rather than the tarball, since gzip and tar stamp
+    # their own times on everything.
+    content_hash = hashlib.sha1()
+    package_files = list(_iter_package_files())
+    for path, archive_name in package_files:
+        content_hash.update(archive_name)
+        content_hash.update(open(path, 'rb').read())
+    content_hash.update(requirements)
+    content_hash.update(install_script)
+    if settings.EC2_RELEASE_BUNDLE_INCLUDE_DEPENDENCIES:
+        content_hash.update('wheels')
+
+    bundle_name = 'media_nommer-%s-%s' % (media_nommer.VERSION,
+                                          content_hash.hexdigest()[:12])
+    bundle_path = os.path.join(dest_dir, bundle_name + '.tar.gz')
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        extra_files = {'requirements.txt': requirements,
+                       'install.sh': install_script}
+        for file_name, contents in extra_files.items():
+            fobj = open(os.path.join(work_dir, file_name), 'w')
+            fobj.write(contents)
+            fobj.close()
+        os.chmod(os.path.join(work_dir, 'install.sh'), 0755)
+
+        wheel_dir = os.path.join(work_dir, 'wheels')
+        if settings.EC2_RELEASE_BUNDLE_INCLUDE_DEPENDENCIES:
+            subprocess.check_call(['pip', 'wheel', '--wheel-dir', wheel_dir,
+                                   '-r', os.path.join(work_dir,
+                                                      'requirements.txt')])
+
+        tar = tarfile.open(bundle_path, 'w:gz')
+        try:
+            for path, archive_name in package_files:
+                tar.add(path, os.path.join(bundle_name, archive_name))
+            for file_name in ['requirements.txt', 'install.sh', 'wheels']:
+                path = os.path.join(work_dir, file_name)
+                if os.path.exists(path):
+                    tar.add(path, os.path.join(bundle_name, file_name))
+        finally:
+            tar.close()
+    finally:
+        shutil.rmtree(work_dir)
+
+    return bundle_path
+
+def publish_bundle():
+    """
+    Builds a release bundle and uploads it to the
+    :py:data:`CONFIG_S3_BUCKET <media_nommer.conf.settings.CONFIG_S3_BUCKET>`,
+    unless an identical one is already there. New EC2_ instances are told
+    to install from it.
+
+    :rtype: str or ``None``
+    :returns: The bundle's S3 key, or ``None`` if it couldn't be published.
+        New instances install from GitHub instead, in that case.
+    """
+    global PUBLISHED_KEY
+
+    build_dir = tempfile.mkdtemp()
+    try:
+        bundle_path = build_bundle(build_dir)
+        key_name = S3_KEY_PREFIX + os.path.basename(bundle_path)
+
+        conn = boto.connect_s3(settings.AWS_ACCESS_KEY_ID,
+                               settings.AWS_SECRET_ACCESS_KEY)
+        bucket = conn.create_bucket(settings.CONFIG_S3_BUCKET)
+        if bucket.get_key(key_name) is None:
+            logger.info("Uploading release bundle %s to S3." % key_name)
+            bucket.new_key(key_name).set_contents_from_filename(bundle_path)
+        else:
+            logger.info("Release bundle %s is already on S3." % key_name)
+    except Exception:
+        logger.error("release_bundle.publish_bundle(): " \
+                     "Unable to publish release bundle.")
+        logger.error()
+        return None
+    finally:
+        shutil.rmtree(build_dir)
+
+    PUBLISHED_KEY = key_name
+    return key_name
+
+def get_install_commands(key_name):
+    """
+    Generates the cloud-init ``runcmd`` commands that fetch a bundle
+    (unless it's already in the instance's bundle cache) and install it.
+
+    :param str key_name: The bundle's S3 key.
+    :rtype: list
+    :returns: A list of shell command strings, to be run as root.
+    """
+    bundle_file = os.path.basename(key_name)
+    bundle_name = bundle_file[:-len('.tar.gz')]
+    cache_dir = settings.EC2_RELEASE_BUNDLE_CACHE_DIR
+    fetch_script = "import os, boto; " \
+        "d = '%(cache_dir)s'; p = os.path.join(d, '%(bundle_file)s'); " \
+        "os.path.isdir(d) or os.makedirs(d); " \
+        "os.path.exists(p) or boto.connect_s3('%(key_id)s', '%(secret)s')" \
+        ".get_bucket('%(bucket)s', validate=False).get_key('%(key_name)s')" \
+        ".get_contents_to_filename(p)" % {
+            'cache_dir': cache_dir,
+            'bundle_file': bundle_file,
+            'key_id': settings.AWS_ACCESS_KEY_ID,
+            'secret': settings.AWS_SECRET_ACCESS_KEY,
+            'bucket': settings.CONFIG_S3_BUCKET,
+            'key_name': key_name,
+        }
+    return [
+        'sudo -u nom -i %s/bin/python -c "%s"' % (NODE_VIRTUALENV,
+                                                  fetch_script),
+        'sudo -u nom -i sh -c "cd %s && rm -rf %s && tar xzf %s && ' \
+        'sh %s/install.sh" > /tmp/media_nom_upgrade.log 2>&1' % (
+            cache_dir, bundle_name, bundle_file, bundle_name),
+    ]
@@ -0,0 +1,365 @@
+"""
+Scaling policies decide how many EC2_ instances :doc:`../feederd` should
+have running. The policy is selected via the
+:py:data:`FEEDERD_SCALING_POLICY <media_nommer.conf.settings.FEEDERD_SCALING_POLICY>`
+setting, and consulted by
+:py:meth:`EC2InstanceManager.spawn_if_needed <media_nommer.feederd.ec2_instance_manager.EC2InstanceManager.spawn_if_needed>`.
+
+To write your own, sub-class :py:class:`ScalingPolicy` and point the setting
+at your class's FQPN. :py:class:`JobStatistics` keeps track of recent job
+arrivals and durations, should your policy need them.
+
+Policies count instances in *baseline instances*, each with
+:py:data:`MAX_ENCODING_JOBS_PER_EC2_INSTANCE <media_nommer.conf.settings.MAX_ENCODING_JOBS_PER_EC2_INSTANCE>`
+slots of baseline throughput (see :py:mod:`media_nommer.core.instance_types`).
+With a single instance type, that's the same as counting instances.
+:py:class:`EC2InstanceManager <media_nommer.feederd.ec2_instance_manager.EC2InstanceManager>`
+converts to and from the actual mix of instance types.
+"""
+import math
+import time
+import threading
+from collections import deque
+from media_nommer.conf import settings
+from media_nommer.utils import logger
+from media_nommer.utils.mod_importing import import_class_from_module_string
+from media_nommer.feederd.job_cache import JobCache
+
+def get_scaling_policy():
+    """
+    Returns the scaling policy class selected by the
+    :py:data:`FEEDERD_SCALING_POLICY <media_nommer.conf.settings.FEEDERD_SCALING_POLICY>`
+    setting.
+
+    :rtype: :py:class:`ScalingPolicy`
+    :returns: A reference to the configured scaling policy class.
+    """
+    return import_class_from_module_string(settings.FEEDERD_SCALING_POLICY)
+
+def get_nommer_name(job):
+    """
+    :param EncodingJob job: The job whose nommer to name.
+    :rtype: str
+    :returns: The FQPN of the job's nommer.
+    """
+    return '%s.%s' % (job.nommer.__class__.__module__,
+                      job.nommer.__class__.__name__)
+
+def get_pending_job_durations():
+    """
+    :rtype: list
+    :returns: The expected duration (in seconds) of each cached job that is
+        still waiting to run, as per
+        :py:meth:`JobStatistics.get_mean_duration`.
+    """
+    return [JobStatistics.get_mean_duration(get_nommer_name(job))
+            for job in JobCache.get_cached_jobs().values()
+            if job.job_state == 'PENDING']
+
+class JobStatistics(object):
+    """
+    Keeps track of how fast jobs are arriving, and how long each nommer's
+    jobs take to run, for scaling policies to base their decisions on.
+
+    A job's duration is measured from the first state change out of
+    ``PENDING`` that :doc:`../feederd` hears of, to ``FINISHED``.
+    """
+    # Arrival times of recently submitted jobs, oldest first.
+    ARRIVALS = deque()
+    # When each running job was first seen running. Keys are unique IDs.
+    STARTED = {}
+    # Recent job durations (in seconds). Keys are nommer FQPNs, values are
+    # deques of durations, oldest first.
+    DURATIONS = {}
+    # Everything above is updated from several threads.
+    LOCK = threading.Lock()
+    # Where the current time comes from. The autoscaling simulator in
+    # benchmarks/ swaps in its simulated clock.
+    clock = staticmethod(time.time)
+
+    @classmethod
+    def record_arrivals(cls, jobs):
+        """
+        Records the submission of new jobs.
+
+        :param list jobs: The newly submitted EncodingJobs.
+        """
+        now = cls.clock()
+        cls.LOCK.acquire()
+        try:
+            cls.ARRIVALS.extend([now] * len(jobs))
+            cls._expire_arrivals(now)
+        finally:
+            cls.LOCK.release()
+
+    @classmethod
+    def record_state_changes(cls, jobs):
+        """
+        Records job state changes, timing each job that finishes.
+
+        :param list jobs: The EncodingJobs whose state has changed.
+        """
+        now = cls.clock()
+        cls.LOCK.acquire()
+        try:
+            for job in jobs:
+                if job.job_state == 'FINISHED':
+                    started = cls.STARTED.pop(job.unique_id, None)
+                    if started is None:
+                        # Never saw this one running, so no way to tell.
+                        continue
+                    durations = cls.DURATIONS.setdefault(
+                        get_nommer_name(job),
+                        deque(maxlen=settings.FEEDERD_SCALING_DURATION_HISTORY_SIZE))
+                    durations.append(now - started)
+                elif job.is_finished():
+                    cls.STARTED.pop(job.unique_id, None)
+                elif job.job_state != 'PENDING':
+                    cls.STARTED.setdefault(job.unique_id, now)
+        finally:
+            cls.LOCK.release()
+
+    @classmethod
+    def _expire_arrivals(cls, now):
+        """
+        Drops arrivals that are too old to matter. Must be called with
+        :py:attr:`LOCK` held.
+        """
+        cutoff = now - settings.FEEDERD_SCALING_ARRIVAL_WINDOW
+        while cls.ARRIVALS and cls.ARRIVALS[0] < cutoff:
+            cls.ARRIVALS.popleft()
+
+    @classmethod
+    def get_arrival_rate(cls, window=None):
+        """
+        :keyword int window: How far back (in seconds) to look. Defaults to
+            :py:data:`FEEDERD_SCALING_ARRIVAL_WINDOW <media_nommer.conf.settings.FEEDERD_SCALING_ARRIVAL_WINDOW>`.
+        :rtype: float
+        :returns: The rate at which jobs have been arriving, in jobs per
+            second.
+        """
+        if window is None:
+            window = settings.FEEDERD_SCALING_ARRIVAL_WINDOW
+        now = cls.clock()
+        cls.LOCK.acquire()
+        try:
+            cls._expire_arrivals(now)
+            cutoff = now - window
+            num_arrivals = len([arrival for arrival in cls.ARRIVALS
+                                if arrival >= cutoff])
+        finally:
+            cls.LOCK.release()
+        return num_arrivals / float(window)
+
+    @classmethod
+    def get_mean_duration(cls, nommer_name=None):
+        """
+        :keyword str nommer_name: A nommer's FQPN. If not specified, the
+            mean is taken across all nommers.
+        :rtype: float
+        :returns: The mean duration (in seconds) of recently finished jobs.
+            Falls back to
+            :py:data:`FEEDERD_SCALING_DEFAULT_JOB_DURATION <media_nommer.conf.settings.FEEDERD_SCALING_DEFAULT_JOB_DURATION>`
+            when no jobs have been timed.
+        """
+        cls.LOCK.acquire()
+        try:
+            if nommer_name is None:
+                durations = []
+                for nommer_durations in cls.DURATIONS.values():
+                    durations.extend(nommer_durations)
+            else:
+                durations = list(cls.DURATIONS.get(nommer_name, []))
+        finally:
+            cls.LOCK.release()
+
+        if not durations:
+            return float(settings.FEEDERD_SCALING_DEFAULT_JOB_DURATION)
+        return sum(durations) / float(len(durations))
+
+
+class ScalingPolicy(object):
+    """
+    Base class for scaling policies. Sub-classes must implement
+    :py:meth:`get_desired_num_instances`.
+    """
+    @classmethod
+    def get_desired_num_instances(cls, num_instances):
+        """
+        Decides how many instances should be running.
+        :py:data:`MAX_NUM_EC2_INSTANCES <media_nommer.conf.settings.MAX_NUM_EC2_INSTANCES>`
+        is applied afterwards, so policies needn't worry about it.
+
+        :param int num_instances: The number of instances currently running.
+        :rtype: int
+        :returns: The number of instances that should be running.
+        """
+        msg = "Scaling policy doesn't implement get_desired_num_instances()"
+        raise NotImplementedError(msg)
+
+    @classmethod
+    def get_min_num_instances(cls, num_instances):
+        """
+        Decides how few instances may be left running when
+        :doc:`../feederd` scales in idle instances. By default, enough to
+        give every unfinished job a slot.
+        :py:data:`MIN_NUM_EC2_INSTANCES <media_nommer.conf.settings.MIN_NUM_EC2_INSTANCES>`
+        is applied afterwards.
+
+        :param int num_instances: The number of instances currently running.
+        :rtype: int
+        :returns: The fewest instances that should be running.
+        """
+        num_unfinished_jobs = JobCache.get_num_unfinished_jobs()
+        return int(math.ceil(num_unfinished_jobs /
+                             float(settings.MAX_ENCODING_JOBS_PER_EC2_INSTANCE)))
+
+
+class ThresholdScalingPolicy(ScalingPolicy):
+    """
+    Spawns instances once the number of unfinished jobs exceeds the running
+    instances' capacity
+    (:py:data:`MAX_ENCODING_JOBS_PER_EC2_INSTANCE <media_nommer.conf.settings.MAX_ENCODING_JOBS_PER_EC2_INSTANCE>`
+    each) by
+    :py:data:`JOB_OVERFLOW_THRESH <media_nommer.conf.settings.JOB_OVERFLOW_THRESH>`.
+    """
+    @classmethod
+    def get_desired_num_instances(cls, num_instances):
+        # The job cache keeps a running count, so there's no need to go
+        # to the backend.
+        num_unfinished_jobs = JobCache.get_num_unfinished_jobs()
+        logger.debug("ThresholdScalingPolicy.get_desired_num_instances(): " \
+                     "Current unfinished jobs: %d" % num_unfinished_jobs)
+
+        if num_unfinished_jobs == 0:
+            # No unfinished jobs, no need to go any further.
+            return num_instances
+
+        job_capacity = num_instances * settings.MAX_ENCODING_JOBS_PER_EC2_INSTANCE
+
+        if job_capacity == 0:
+            # Don't factor in overflow thresh or anything if we have no
+            # instances or capacity.
+            cap_plus_thresh = 0
+        else:
+            cap_plus_thresh = job_capacity + settings.JOB_OVERFLOW_THRESH
+
+        logger.debug("ThresholdScalingPolicy.get_desired_num_instances(): " \
+                     "Job capacity (%d w/ thresh): %d" % (job_capacity,
+                                                         cap_plus_thresh))
+
+        is_over_capacity = num_unfinished_jobs >= cap_plus_thresh
+        # Disgregard the overflow thresh if there are jobs but no instances.
+        if is_over_capacity or num_instances == 0:
+            overage = num_unfinished_jobs - job_capacity
+            if job_capacity > 0:
+                # Only factor overhold threshold in when we have capacity
+                # available in some form.
+                overage -= settings.JOB_OVERFLOW_THRESH
+
+            if overage <= 0:
+                # Adding in the overflow thresh brought this under the
+                # overage level. No need for spawning instances.
+                return num_instances
+
+            logger.info("ThresholdScalingPolicy.get_desired_num_instances(): " \
+                         "Observed labor shortage of: %d" % overage)
+
+            # Raw # of instances needing to be spawned.
+            num_new_instances = overage / settings.MAX_ENCODING_JOBS_PER_EC2_INSTANCE
+            # At this point, we know there's an overage, even with the overflow
+            # thresh factored in (if there is at least one EC2 instance
+            # already running).
+            num_new_instances = max(num_new_instances, 1)
+            return num_instances + num_new_instances
+        # No new instances.
+        return num_instances
+
+
+class PredictiveScalingPolicy(ScalingPolicy):
+    """
+    Sizes the pool so that new jobs wait no longer than
+    :py:data:`FEEDERD_SCALING_TARGET_QUEUE_WAIT <media_nommer.conf.settings.FEEDERD_SCALING_TARGET_QUEUE_WAIT>`
+    to start, going by recent arrival rates and how long each nommer's jobs
+    have been taking (see :py:class:`JobStatistics`).
+
+    Instances take
+    :py:data:`FEEDERD_SCALING_INSTANCE_BOOT_TIME <media_nommer.conf.settings.FEEDERD_SCALING_INSTANCE_BOOT_TIME>`
+    to come up, so the policy plans for the backlog as it will be once
+    they're ready. It needs:
+
+    * Enough encoding slots to keep up with arriving jobs.
+    * Plus enough to drain that future backlog within the target wait.
+
+    The arrival rate used is the higher of the rate over the
+    :py:data:`FEEDERD_SCALING_BURST_WINDOW <media_nommer.conf.settings.FEEDERD_SCALING_BURST_WINDOW>`
+    and the
+    :py:data:`FEEDERD_SCALING_ARRIVAL_WINDOW <media_nommer.conf.settings.FEEDERD_SCALING_ARRIVAL_WINDOW>`,
+    so bursts are scaled for as they start.
+    """
+    @classmethod
+    def get_backlog_work(cls):
+        """
+        :rtype: float
+        :returns: The estimated number of encoding-slot seconds it will take
+            to finish every cached unfinished job. Running jobs are counted
+            as half done.
+        """
+        work = 0.0
+        for job in JobCache.get_cached_jobs().values():
+            if job.is_finished():
+                continue
+            duration = JobStatistics.get_mean_duration(get_nommer_name(job))
+            if job.job_state == 'PENDING':
+                work += duration
+            else:
+                work += duration / 2.0
+        return work
+
+    @classmethod
+    def get_needed_num_instances(cls, num_instances):
+        """
+        :param int num_instances: The number of instances currently running.
+        :rtype: int
+        :returns: The number of instances needed to meet the target queue
+            wait. May be fewer than are running.
+        """
+        slots_per_instance = settings.MAX_ENCODING_JOBS_PER_EC2_INSTANCE
+        boot_time = settings.FEEDERD_SCALING_INSTANCE_BOOT_TIME
+        arrival_rate = max(
+            JobStatistics.get_arrival_rate(settings.FEEDERD_SCALING_BURST_WINDOW),
+            JobStatistics.get_arrival_rate())
+        mean_duration = JobStatistics.get_mean_duration()
+
+        # Slots needed just to keep up with arrivals (Little's law).
+        steady_slots = arrival_rate * mean_duration
+        # The backlog once new instances are up: what's here now, plus
+        # what arrives while booting, minus what current instances finish.
+        future_work = cls.get_backlog_work() + \
+                      arrival_rate * boot_time * mean_duration - \
+                      num_instances * slots_per_instance * boot_time
+        drain_slots = max(future_work, 0) / \
+                      settings.FEEDERD_SCALING_TARGET_QUEUE_WAIT
+
+        desired = int(math.ceil(
+            (steady_slots + drain_slots) / float(slots_per_instance)))
+        logger.debug("PredictiveScalingPolicy.get_needed_num_instances(): " \
+                     "Arrivals: %.3f/s, mean duration: %.0fs, steady " \
+                     "slots: %.1f, drain slots: %.1f, desired " \
+                     "instances: %d" % (arrival_rate, mean_duration,
+                                        steady_slots, drain_slots, desired))
+        if JobCache.get_num_unfinished_jobs():
+            # Someone has to do the work, no matter how little there is.
+            desired = max(desired, 1)
+        return desired
+
+    @classmethod
+    def get_desired_num_instances(cls, num_instances):
+        return max(cls.get_needed_num_instances(num_instances), num_instances)
+
+    @classmethod
+    def get_min_num_instances(cls, num_instances):
+        # Never less than the running jobs need, whatever the estimates say.
+        return max(cls.get_needed_num_instances(num_instances),
+                   super(PredictiveScalingPolicy, cls).get_min_num_instances(
+                                                            num_instances))
@@ -0,0 +1,927 @@
+"""
+Tests for feederd's job cache, job state stream, notification outbox, EC2
+instance manager, scaling policies, instance types, and release bundles.
+"""
+import os
+import json
+import shutil
+import tarfile
+import subprocess
+import datetime
+import threading
+import unittest
+import tempfile
+from boto.exception import EC2ResponseError
+from twisted.internet.defer import Deferred, maybeDeferred
+from media_nommer.conf import settings
+from media_nommer.core.job_state_backend import EncodingJob, \
+    get_job_state_backend
+from media_nommer.core import instance_types
+from media_nommer.feederd.job_cache import JobCache
+from media_nommer.feederd.ec2_instance_manager import EC2InstanceManager
+from media_nommer.feederd import release_bundle
+from media_nommer.feederd.scaling_policy import JobStatistics, \
+    ThresholdScalingPolicy, PredictiveScalingPolicy, get_nommer_name
+from media_nommer.feederd.job_state_stream import JobStateStream, \
+    JobStateWatcher
+from media_nommer.feederd.job_state_notifier import NotificationOutbox, \
+    send_notifications
+
+class JobCacheTests(unittest.TestCase):
+    """
+    Tests for the JobCache class.
+    """
+    def setUp(self):
+        self.old_finished_cache_size = settings.FEEDERD_FINISHED_JOB_CACHE_SIZE
+        settings.FEEDERD_FINISHED_JOB_CACHE_SIZE = 2
+        JobCache.CACHE.clear()
+        JobCache.FINISHED_CACHE.clear()
+        JobCache.STATE_COUNTS.clear()
+        JobCache.COUNTED_STATES.clear()
+
+    def tearDown(self):
+        settings.FEEDERD_FINISHED_JOB_CACHE_SIZE = self.old_finished_cache_size
+        JobCache.CACHE.clear()
+        JobCache.FINISHED_CACHE.clear()
+        JobCache.STATE_COUNTS.clear()
+        JobCache.COUNTED_STATES.clear()
+
+    def _get_job(self, unique_id, job_state):
+        """
+        Returns an un-saved job with the given ID and state.
+        """
+        return EncodingJob('file:///tmp/in.mp4', 'file:///tmp/out.mp4',
+                           'media_nommer.ec2nommerd.nommers.ffmpeg.FFmpegNommer',
+                           [], unique_id=unique_id, job_state=job_state)
+
+    def test_finished_jobs_stay_available(self):
+        """
+        Finished jobs leave the main cache, but can still be looked up
+        until they're pushed out by newer finished jobs.
+        """
+        for unique_id in ['a', 'b', 'c']:
+            JobCache.update_job(self._get_job(unique_id, 'FINISHED'))
+        JobCache.update_job(self._get_job('d', 'ENCODING'))
+        JobCache.uncache_finished_jobs()
+
+        self.assertEqual(JobCache.get_cached_jobs().keys(), ['d'])
+        self.assertEqual(JobCache.lookup_job('d').job_state, 'ENCODING')
+        self.assertEqual(len(JobCache.FINISHED_CACHE), 2)
+        self.assertEqual(JobCache.lookup_job('nope'), None)
+        found = [unique_id for unique_id in ['a', 'b', 'c']
+                 if JobCache.lookup_job(unique_id)]
+        self.assertEqual(len(found), 2)
+
+    def test_state_counts(self):
+        """
+        Per-state counts should follow jobs into, around, and out of the
+        cache.
+        """
+        JobCache.update_job(self._get_job('a', 'PENDING'))
+        JobCache.update_job(self._get_job('b', 'PENDING'))
+        job = self._get_job('c', 'ENCODING')
+        JobCache.update_job(job)
+        self.assertEqual(JobCache.get_state_counts(),
+                         {'PENDING': 2, 'ENCODING': 1})
+
+        JobCache.update_job(self._get_job('a', 'DOWNLOADING'))
+        # Changed in place, then re-cached.
+        job.job_state = 'FINISHED'
+        JobCache.update_job(job)
+        self.assertEqual(JobCache.get_state_counts(),
+                         {'PENDING': 1, 'DOWNLOADING': 1, 'FINISHED': 1})
+        self.assertEqual(JobCache.get_num_unfinished_jobs(), 2)
+
+        JobCache.uncache_finished_jobs()
+        JobCache.remove_job('b')
+        self.assertEqual(JobCache.get_state_counts(), {'DOWNLOADING': 1})
+
+    def test_reconcile_unfinished_job_count(self):
+        """
+        A cache that has drifted from the backend should be re-synced.
+        """
+        old_backend = settings.JOB_STATE_BACKEND
+        old_db_path = settings.SQLITE_JOB_STATE_DB_PATH
+        fd, db_path = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(fd)
+        settings.JOB_STATE_BACKEND = 'media_nommer.core.job_state_backends.' \
+                                     'sqlite.SQLiteJobStateBackend'
+        settings.SQLITE_JOB_STATE_DB_PATH = db_path
+        try:
+            jobs = [self._get_job(None, 'PENDING') for i in range(3)]
+            for job in jobs:
+                job.save()
+            JobCache.update_job(jobs[0])
+            # Cached as unfinished, but finished as far as the backend knows.
+            stale_job = self._get_job('gone', 'ENCODING')
+            JobCache.update_job(stale_job)
+            get_job_state_backend()._clear_queue(
+                settings.SQS_JOB_STATE_CHANGE_QUEUE_NAME)
+
+            self.assertTrue(JobCache.reconcile_unfinished_job_count())
+            self.assertEqual(JobCache.get_state_counts(), {'PENDING': 3})
+            self.assertFalse(JobCache.reconcile_unfinished_job_count())
+        finally:
+            settings.JOB_STATE_BACKEND = old_backend
+            settings.SQLITE_JOB_STATE_DB_PATH = old_db_path
+            os.remove(db_path)
+
+class RecordingWatcher(JobStateWatcher):
+    """
+    Remembers the events it was sent.
+    """
+    def __init__(self, unique_ids=None):
+        JobStateWatcher.__init__(self, unique_ids=unique_ids)
+        self.sends = []
+
+    def send(self, events):
+        self.sends.append([event['job_id'] for event in events])
+
+class JobStateStreamTests(unittest.TestCase):
+    """
+    Tests for the JobStateStream class.
+    """
+    def setUp(self):
+        self.old_backlog = settings.FEEDERD_JOB_STATE_STREAM_BACKLOG
+        settings.FEEDERD_JOB_STATE_STREAM_BACKLOG = 3
+        JobStateStream.EVENTS.clear()
+        JobStateStream.LAST_SEQ = 0
+
+    def tearDown(self):
+        settings.FEEDERD_JOB_STATE_STREAM_BACKLOG = self.old_backlog
+        JobStateStream.EVENTS.clear()
+        JobStateStream.WATCHERS_ALL.clear()
+        JobStateStream.WATCHERS_BY_JOB_ID.clear()
+
+    def _get_job(self, unique_id):
+        """
+        Returns an un-saved job with the given ID.
+        """
+        return EncodingJob('file:///tmp/in.mp4', 'file:///tmp/out.mp4',
+                           'media_nommer.ec2nommerd.nommers.ffmpeg.FFmpegNommer',
+                           [], unique_id=unique_id, job_state='ENCODING')
+
+    def test_watchers(self):
+        """
+        Each watcher should get one send per publish, with only the events
+        it asked for.
+        """
+        everything = RecordingWatcher()
+        just_b = RecordingWatcher(unique_ids=['b'])
+        JobStateStream.add_watcher(everything)
+        JobStateStream.add_watcher(just_b)
+
+        JobStateStream.publish_jobs([self._get_job('a'), self._get_job('b')])
+        JobStateStream.publish_jobs([self._get_job('a')])
+        JobStateStream.remove_watcher(just_b)
+        JobStateStream.publish_jobs([self._get_job('b')])
+
+        self.assertEqual(everything.sends, [['a', 'b'], ['a'], ['b']])
+        self.assertEqual(just_b.sends, [['b']])
+        self.assertEqual(JobStateStream.WATCHERS_BY_JOB_ID, {})
+
+    def test_cursors(self):
+        """
+        Resuming from a cursor should return the events after it, and say
+        so when some of those have already been dropped.
+        """
+        for unique_id in ['a', 'b', 'c', 'd']:
+            JobStateStream.publish_jobs([self._get_job(unique_id)])
+
+        seq = JobStateStream.parse_cursor(JobStateStream.get_cursor(2))
+        events, missed = JobStateStream.get_events_since(seq)
+        self.assertEqual([e['job_id'] for e in events], ['c', 'd'])
+        self.assertFalse(missed)
+
+        events, missed = JobStateStream.get_events_since(0, unique_ids=['b'])
+        self.assertEqual([e['job_id'] for e in events], ['b'])
+        # Event 1 is gone.
+        self.assertTrue(missed)
+
+        self.assertEqual(JobStateStream.parse_cursor('someotherrun-2'), None)
+        self.assertEqual(JobStateStream.parse_cursor(
+            JobStateStream.get_cursor(99)), None)
+
+class NotificationOutboxTests(unittest.TestCase):
+    """
+    Tests for the NotificationOutbox class. Nothing is actually delivered,
+    and database work is done right away, rather than in another thread.
+    """
+    def setUp(self):
+        self.old_db_path = settings.FEEDERD_NOTIFICATION_OUTBOX_DB_PATH
+        fd, self.db_path = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(fd)
+        settings.FEEDERD_NOTIFICATION_OUTBOX_DB_PATH = self.db_path
+        NotificationOutbox.IN_FLIGHT.clear()
+        NotificationOutbox._defer_to_db = classmethod(
+            lambda cls, func, *args, **kwargs:
+                maybeDeferred(func, *args, **kwargs))
+        # Keep add() from trying to deliver anything.
+        self.old_max_in_flight = settings.FEEDERD_NOTIFY_MAX_IN_FLIGHT
+        settings.FEEDERD_NOTIFY_MAX_IN_FLIGHT = 0
+
+    def tearDown(self):
+        NotificationOutbox._get_db_connection().close()
+        del NotificationOutbox._defer_to_db
+        NotificationOutbox.IN_FLIGHT.clear()
+        NotificationOutbox._pumping = False
+        NotificationOutbox._pump_again = False
+        settings.FEEDERD_NOTIFICATION_OUTBOX_DB_PATH = self.old_db_path
+        settings.FEEDERD_NOTIFY_MAX_IN_FLIGHT = self.old_max_in_flight
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(self.db_path + suffix):
+                os.remove(self.db_path + suffix)
+
+    def _get_due(self):
+        """
+        Returns (unique_id, body) for each notification that is due.
+        """
+        return [(row['unique_id'], row['body'])
+                for row in NotificationOutbox._get_due_rows(10)]
+
+    def test_ordering_and_retries(self):
+        """
+        Each job's notifications should go out one at a time, in order, and
+        a failed one should hold up the rest of its job's until retried.
+        """
+        NotificationOutbox.add([('a', 'http://example.com/', 'a1'),
+                                ('b', 'http://example.com/', 'b1'),
+                                ('a', 'http://example.com/', 'a2')])
+        self.assertEqual(NotificationOutbox.get_num_pending(), 3)
+        self.assertEqual(self._get_due(), [('a', 'a1'), ('b', 'b1')])
+
+        # Nothing else for a job while one of its notifications is in flight.
+        rows = NotificationOutbox._get_due_rows(10)
+        NotificationOutbox.IN_FLIGHT[rows[0]['id']] = 'a'
+        self.assertEqual(self._get_due(), [('b', 'b1')])
+        del NotificationOutbox.IN_FLIGHT[rows[0]['id']]
+
+        # a1 failed, so a2 waits for it.
+        NotificationOutbox._schedule_retry([rows[0]], 'Testing')
+        NotificationOutbox._remove([rows[1]])
+        self.assertEqual(self._get_due(), [])
+        NotificationOutbox._get_db_connection().execute(
+            "UPDATE outbox SET next_attempt_at = 0")
+        self.assertEqual(self._get_due(), [('a', 'a1')])
+
+        # Give up after too many attempts.
+        old_max_attempts = settings.FEEDERD_NOTIFY_MAX_ATTEMPTS
+        settings.FEEDERD_NOTIFY_MAX_ATTEMPTS = 2
+        try:
+            NotificationOutbox._schedule_retry(
+                NotificationOutbox._get_due_rows(10)[:1], 'Testing')
+        finally:
+            settings.FEEDERD_NOTIFY_MAX_ATTEMPTS = old_max_attempts
+        self.assertEqual(self._get_due(), [('a', 'a2')])
+
+    def test_pump_lookups(self):
+        """
+        Only one pump() lookup should run at a time, and pumps asked for in
+        the meantime should be rolled into one more lookup.
+        """
+        lookups = []
+        def defer_to_db(cls, func, *args, **kwargs):
+            lookups.append(Deferred())
+            return lookups[-1]
+        NotificationOutbox._defer_to_db = classmethod(defer_to_db)
+        settings.FEEDERD_NOTIFY_MAX_IN_FLIGHT = 10
+
+        NotificationOutbox.pump()
+        NotificationOutbox.pump()
+        NotificationOutbox.pump()
+        self.assertEqual(len(lookups), 1)
+        lookups[0].callback([])
+        self.assertEqual(len(lookups), 2)
+        lookups[1].callback([])
+        self.assertEqual(len(lookups), 2)
+        self.assertFalse(NotificationOutbox._pumping)
+
+    def test_batched_notifications(self):
+        """
+        Notifications to URLs that take batches should be held for the
+        batch window, then collapse down to the latest state for each job.
+        """
+        old_batch_urls = settings.FEEDERD_NOTIFY_BATCH_URLS
+        settings.FEEDERD_NOTIFY_BATCH_URLS = ['http://example.com/batch']
+        try:
+            jobs = []
+            for unique_id, job_state in [('a', 'DOWNLOADING'),
+                                         ('b', 'ENCODING'),
+                                         ('a', 'FINISHED')]:
+                job = EncodingJob('file:///tmp/in.mp4', 'file:///tmp/out.mp4',
+                                  'media_nommer.ec2nommerd.nommers.ffmpeg.FFmpegNommer',
+                                  [], unique_id=unique_id, job_state=job_state,
+                                  notify_url='http://example.com/batch/')
+                jobs.append(job)
+            send_notifications(jobs)
+        finally:
+            settings.FEEDERD_NOTIFY_BATCH_URLS = old_batch_urls
+
+        self.assertEqual(NotificationOutbox.get_num_pending(), 3)
+        # Held for the batch window.
+        self.assertEqual(self._get_due(), [])
+        NotificationOutbox._get_db_connection().execute(
+            "UPDATE outbox SET next_attempt_at = 0")
+        rows = NotificationOutbox._get_due_rows(10)
+        self.assertEqual(len(rows), 1)
+
+        rows = NotificationOutbox._get_batch_rows(rows[0]['unique_id'])
+        self.assertEqual(len(rows), 3)
+        batch = json.loads(NotificationOutbox._get_batch_body(rows))
+        self.assertEqual([(data['unique_id'], data['job_state'])
+                          for data in batch],
+                         [('b', 'ENCODING'), ('a', 'FINISHED')])
+
+class FakeReservation(object):
+    """
+    Stands in for a boto Reservation.
+    """
+    def __init__(self, instances):
+        self.instances = instances
+
+class FakeInstance(object):
+    """
+    Stands in for a boto Instance that has been up for a while.
+    """
+    def __init__(self, instance_id, uptime, instance_type=None):
+        self.id = instance_id
+        self.instance_type = instance_type or settings.EC2_INSTANCE_TYPE
+        launch_dtime = datetime.datetime.utcnow() - \
+                       datetime.timedelta(seconds=uptime)
+        self.launch_time = launch_dtime.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+class FakeImage(object):
+    """
+    Stands in for a boto Image.
+    """
+    def __init__(self, image_id):
+        self.id = image_id
+
+class FakeEC2Connection(object):
+    """
+    Stands in for a boto EC2 connection, recording the filters it was
+    given, the instances it was told to start and terminate, and the
+    number of AMI lookups.
+    """
+    def __init__(self, reservations=None):
+        if reservations is None:
+            reservations = [FakeReservation(['i-1', 'i-2']),
+                            FakeReservation(['i-3'])]
+        self.reservations = reservations
+        self.lookups = []
+        self.terminated = []
+        self.image_lookups = 0
+        # Maps (instance_type, zone) pools to how many more instances they
+        # can take. Pools that aren't listed can take any number.
+        self.capacity = {}
+        self.runs = []
+        # The threads run_instances() was called from.
+        self.run_threads = []
+        # How many more create_tags() calls should fail, and the instance
+        # IDs that were tagged.
+        self.tag_failures = 0
+        self.tagged = []
+
+    def get_all_images(self, image_ids=None):
+        self.image_lookups += 1
+        return [FakeImage(image_id) for image_id in image_ids]
+
+    def run_instances(self, image_id, min_count=1, max_count=1,
+                      instance_type=None, placement=None, **kwargs):
+        pool = (instance_type, placement)
+        num_instances = min(max_count, self.capacity.get(pool, max_count))
+        self.runs.append((pool, max_count, num_instances))
+        self.run_threads.append(threading.current_thread())
+        if num_instances < min_count:
+            raise EC2ResponseError(500, 'Server Error',
+                '<Response><Errors><Error>'
+                '<Code>InsufficientInstanceCapacity</Code>'
+                '<Message>Out of capacity</Message>'
+                '</Error></Errors></Response>')
+        if pool in self.capacity:
+            self.capacity[pool] -= num_instances
+        return FakeReservation([FakeImage('i-%s-%s-%d' % (instance_type,
+                                                          placement, i))
+                                for i in range(num_instances)])
+
+    def create_tags(self, instance_ids, tags):
+        if self.tag_failures:
+            self.tag_failures -= 1
+            raise EC2ResponseError(400, 'Bad Request',
+                '<Response><Errors><Error>'
+                '<Code>InvalidInstanceID.NotFound</Code>'
+                '<Message>No such instance</Message>'
+                '</Error></Errors></Response>')
+        self.tagged.extend(instance_ids)
+
+    def get_all_instances(self, filters=None):
+        self.lookups.append(filters)
+        return self.reservations
+
+    def terminate_instances(self, instance_ids=None):
+        self.terminated.extend(instance_ids)
+
+class FakeSDBItem(dict):
+    """
+    Stands in for a boto SimpleDB Item.
+    """
+    def __init__(self, name, attributes):
+        dict.__init__(self, attributes)
+        self.name = name
+
+class FakeSDBDomain(object):
+    """
+    Stands in for the boto SimpleDB domain that instances send their
+    heartbeats to.
+    """
+    def __init__(self, items):
+        self.items = items
+
+    def select(self, query, consistent_read=False):
+        return [FakeSDBItem(name, attributes)
+                for name, attributes in self.items.items()]
+
+    def put_attributes(self, item_name, attributes, replace=True):
+        self.items.setdefault(item_name, {}).update(attributes)
+
+    def batch_put_attributes(self, items, replace=True):
+        for item_name, attributes in items.items():
+            self.put_attributes(item_name, attributes, replace=replace)
+
+    def delete_attributes(self, item_name, attributes=None):
+        for attribute in attributes:
+            self.items[item_name].pop(attribute, None)
+
+class EC2InstanceManagerTests(unittest.TestCase):
+    """
+    Tests for the EC2InstanceManager class. EC2 is never contacted.
+    """
+    def setUp(self):
+        self.conn = FakeEC2Connection()
+        EC2InstanceManager._EC2InstanceManager__aws_ec2_connection = self.conn
+        # Connections opened for other threads, and the threads they were
+        # opened from.
+        self.new_connection_threads = []
+        def new_connection(cls):
+            self.new_connection_threads.append(threading.current_thread())
+            return self.conn
+        EC2InstanceManager._new_aws_ec2_connection = classmethod(
+                                                            new_connection)
+        EC2InstanceManager.clear_instance_cache()
+
+    def tearDown(self):
+        EC2InstanceManager._EC2InstanceManager__aws_ec2_connection = None
+        del EC2InstanceManager._new_aws_ec2_connection
+        EC2InstanceManager.clear_instance_cache()
+        EC2InstanceManager._recently_spawned.clear()
+
+    def test_get_instances(self):
+        """
+        Instances should be filtered by EC2, and cached between lookups.
+        """
+        self.assertEqual(EC2InstanceManager.get_instances(),
+                         ['i-1', 'i-2', 'i-3'])
+        self.assertEqual(EC2InstanceManager.get_instances(),
+                         ['i-1', 'i-2', 'i-3'])
+        self.assertEqual(len(self.conn.lookups), 1)
+        filters = self.conn.lookups[0]
+        self.assertEqual(filters['image-id'], settings.EC2_AMI_ID)
+        self.assertEqual(filters['instance-state-name'], ['running', 'pending'])
+        # Untagged instances count, unless tag filtering is turned on.
+        for tag_name in settings.EC2_INSTANCE_TAGS.keys():
+            self.assertFalse('tag:%s' % tag_name in filters)
+
+        # Forcing a fresh lookup, or clearing the cache, hits EC2 again.
+        EC2InstanceManager.get_instances(max_age=0)
+        EC2InstanceManager.clear_instance_cache()
+        EC2InstanceManager.get_instances()
+        self.assertEqual(len(self.conn.lookups), 3)
+
+    def test_tag_filtering(self):
+        """
+        Tagging should be retried, and spawned instances should be counted
+        until they show up in tag-filtered lookups.
+        """
+        old_filter_by_tags = settings.EC2_FILTER_BY_TAGS
+        old_retry_delay = EC2InstanceManager.TAG_RETRY_DELAY
+        settings.EC2_FILTER_BY_TAGS = True
+        EC2InstanceManager.TAG_RETRY_DELAY = 0
+        EC2InstanceManager._image_cache = None
+        tagged = FakeReservation([FakeInstance('i-1', 60)])
+        self.conn.reservations = [tagged]
+        try:
+            self.conn.tag_failures = 2
+            reservations = EC2InstanceManager.spawn_instances(2)
+            new_ids = [instance.id for instance in reservations[0].instances]
+            self.assertEqual(self.conn.tagged, new_ids)
+
+            # EC2 doesn't return them yet, but they're counted anyway.
+            instance_ids = [instance.id for instance in
+                            EC2InstanceManager.get_instances(max_age=0)]
+            self.assertEqual(instance_ids, ['i-1'] + new_ids)
+            filters = self.conn.lookups[-1]
+            for tag_name, tag_value in settings.EC2_INSTANCE_TAGS.items():
+                self.assertEqual(filters['tag:%s' % tag_name], tag_value)
+
+            # Once EC2 returns them, they're no longer tracked separately.
+            self.conn.reservations = [tagged, reservations[0]]
+            self.assertEqual(len(EC2InstanceManager.get_instances(max_age=0)),
+                             3)
+            self.assertEqual(EC2InstanceManager._recently_spawned, {})
+
+            # If tagging never works, that's given up on.
+            self.conn.tag_failures = EC2InstanceManager.TAG_ATTEMPTS
+            self.assertFalse(EC2InstanceManager._tag_instances(
+                                                    [FakeImage('i-4')]))
+        finally:
+            settings.EC2_FILTER_BY_TAGS = old_filter_by_tags
+            EC2InstanceManager.TAG_RETRY_DELAY = old_retry_delay
+            EC2InstanceManager._image_cache = None
+
+    def test_spawn_instances(self):
+        """
+        The AMI should only be looked up once, and whatever the preferred
+        pool can't take should be spread over the fallback pools.
+        """
+        old_settings = (settings.EC2_INSTANCE_TYPE,
+                        settings.EC2_FALLBACK_INSTANCE_TYPES,
+                        settings.EC2_AVAILABILITY_ZONES)
+        settings.EC2_INSTANCE_TYPE = 'm1.large'
+        settings.EC2_FALLBACK_INSTANCE_TYPES = ['c1.xlarge']
+        settings.EC2_AVAILABILITY_ZONES = ['us-east-1a', 'us-east-1b']
+        EC2InstanceManager._image_cache = None
+        try:
+            self.assertEqual(EC2InstanceManager.get_spawn_pools(), [
+                ('m1.large', 'us-east-1a'), ('m1.large', 'us-east-1b'),
+                ('c1.xlarge', 'us-east-1a'), ('c1.xlarge', 'us-east-1b')])
+
+            reservations = EC2InstanceManager.spawn_instances(2)
+            self.assertEqual(len(reservations), 1)
+            self.assertEqual(len(reservations[0].instances), 2)
+
+            # The preferred pool only has room for one more, so the other
+            # six go to the fallbacks, two apiece.
+            self.conn.capacity[('m1.large', 'us-east-1a')] = 1
+            self.conn.runs = []
+            self.conn.run_threads = []
+            reservations = EC2InstanceManager.spawn_instances(7)
+            self.assertEqual(
+                sum([len(r.instances) for r in reservations]), 7)
+            self.assertEqual(self.conn.runs[0],
+                             (('m1.large', 'us-east-1a'), 7, 1))
+            self.assertEqual(sorted(self.conn.runs[1:]), [
+                (('c1.xlarge', 'us-east-1a'), 2, 2),
+                (('c1.xlarge', 'us-east-1b'), 2, 2),
+                (('m1.large', 'us-east-1b'), 2, 2)])
+            # Each fallback pool gets its own thread and connection.
+            self.assertEqual(set(self.new_connection_threads),
+                             set(self.conn.run_threads[1:]))
+            self.assertEqual(len(set(self.new_connection_threads)), 3)
+
+            # With no capacity there at all, the fallbacks take everything.
+            self.conn.runs = []
+            reservations = EC2InstanceManager.spawn_instances(3)
+            self.assertEqual(
+                sum([len(r.instances) for r in reservations]), 3)
+            self.assertEqual(self.conn.runs[0],
+                             (('m1.large', 'us-east-1a'), 3, 0))
+
+            self.assertEqual(self.conn.image_lookups, 1)
+            for phase in ['image_lookup', 'run', 'fallback_run', 'tag',
+                          'total']:
+                self.assertTrue(
+                    phase in EC2InstanceManager.last_spawn_timings)
+        finally:
+            (settings.EC2_INSTANCE_TYPE,
+             settings.EC2_FALLBACK_INSTANCE_TYPES,
+             settings.EC2_AVAILABILITY_ZONES) = old_settings
+            EC2InstanceManager._image_cache = None
+
+    def test_scale_in_if_needed(self):
+        """
+        Idle instances close to their billing boundary should be drained,
+        down to the minimum, then terminated once drained. Waiting jobs
+        should put draining instances back to work. Every pass should renew
+        the leases of instances that haven't been terminated.
+        """
+        self.conn.reservations = [FakeReservation([
+            FakeInstance('i-busy', 3500),
+            FakeInstance('i-far', 2000),
+            FakeInstance('i-near', 3500),
+            FakeInstance('i-nearish', 3100),
+            FakeInstance('i-drained', 3000),
+        ])]
+        idle = {'active_jobs': '0', 'idle_seconds': '3600', 'state': 'ACTIVE'}
+        domain = FakeSDBDomain({
+            'i-busy': dict(idle, active_jobs='1', idle_seconds='0'),
+            'i-far': dict(idle),
+            'i-near': dict(idle),
+            'i-nearish': dict(idle),
+            'i-drained': dict(idle, drain='1', state='DRAINED'),
+        })
+        EC2InstanceManager._EC2InstanceManager__aws_sdb_nommer_state_domain = domain
+        old_settings = (settings.MIN_NUM_EC2_INSTANCES,
+                        settings.NOMMERD_MAX_INACTIVITY,
+                        settings.FEEDERD_SCALE_IN_BILLING_WINDOW)
+        settings.MIN_NUM_EC2_INSTANCES = 3
+        settings.NOMMERD_MAX_INACTIVITY = 600
+        settings.FEEDERD_SCALE_IN_BILLING_WINDOW = 600
+        JobCache.CACHE.clear()
+        JobCache.STATE_COUNTS.clear()
+        JobCache.COUNTED_STATES.clear()
+        try:
+            terminated = EC2InstanceManager.scale_in_if_needed()
+            self.assertEqual([instance.id for instance in terminated],
+                             ['i-drained'])
+            self.assertEqual(self.conn.terminated, ['i-drained'])
+            self.assertEqual(domain.items['i-drained']['state'], 'TERMINATED')
+            # Four left, one over the minimum. i-far isn't near the end of
+            # its hour, and i-near is closer than i-nearish.
+            self.assertEqual(domain.items['i-near'].get('drain'), '1')
+            self.assertFalse('drain' in domain.items['i-nearish'])
+            self.assertFalse('drain' in domain.items['i-far'])
+            self.assertFalse('drain' in domain.items['i-busy'])
+            for instance_id in domain.items:
+                self.assertTrue(
+                    'feederd_seen_dtime' in domain.items[instance_id])
+            del domain.items['i-drained']['feederd_seen_dtime']
+
+            JobCache.update_job(
+                EncodingJob('file:///tmp/in.mp4', 'file:///tmp/out.mp4',
+                            'media_nommer.ec2nommerd.nommers.ffmpeg.FFmpegNommer',
+                            [], unique_id='waiting', job_state='PENDING'))
+            EC2InstanceManager.scale_in_if_needed()
+            self.assertFalse('drain' in domain.items['i-near'])
+            self.assertFalse('feederd_seen_dtime' in domain.items['i-drained'])
+        finally:
+            (settings.MIN_NUM_EC2_INSTANCES,
+             settings.NOMMERD_MAX_INACTIVITY,
+             settings.FEEDERD_SCALE_IN_BILLING_WINDOW) = old_settings
+            EC2InstanceManager._EC2InstanceManager__aws_sdb_nommer_state_domain = None
+            JobCache.CACHE.clear()
+            JobCache.STATE_COUNTS.clear()
+            JobCache.COUNTED_STATES.clear()
+
+class ScalingPolicyTests(unittest.TestCase):
+    """
+    Tests for the scaling policies, and the job statistics they go by.
+    """
+    def setUp(self):
+        JobCache.CACHE.clear()
+        JobCache.STATE_COUNTS.clear()
+        JobCache.COUNTED_STATES.clear()
+        JobStatistics.ARRIVALS.clear()
+        JobStatistics.STARTED.clear()
+        JobStatistics.DURATIONS.clear()
+
+    tearDown = setUp
+
+    def _cache_jobs(self, num_jobs, job_state='PENDING'):
+        """
+        Caches and returns some un-saved jobs in the given state.
+        """
+        jobs = []
+        for i in range(num_jobs):
+            job = EncodingJob('file:///tmp/in.mp4', 'file:///tmp/out.mp4',
+                              'media_nommer.ec2nommerd.nommers.ffmpeg.FFmpegNommer',
+                              [], unique_id='%s-%d' % (job_state, i),
+                              job_state=job_state)
+            JobCache.update_job(job)
+            jobs.append(job)
+        return jobs
+
+    def test_job_statistics(self):
+        """
+        Durations should be timed from the first running state change to
+        FINISHED, per nommer.
+        """
+        jobs = self._cache_jobs(2, 'ENCODING')
+        JobStatistics.record_state_changes(jobs)
+        JobStatistics.STARTED[jobs[0].unique_id] -= 100
+        JobStatistics.STARTED[jobs[1].unique_id] -= 300
+        for job in jobs:
+            job.job_state = 'FINISHED'
+        JobStatistics.record_state_changes(jobs)
+
+        nommer_name = get_nommer_name(jobs[0])
+        self.assertAlmostEqual(JobStatistics.get_mean_duration(nommer_name),
+                               200, places=0)
+        self.assertEqual(JobStatistics.get_mean_duration('some.OtherNommer'),
+                         settings.FEEDERD_SCALING_DEFAULT_JOB_DURATION)
+        self.assertEqual(JobStatistics.STARTED, {})
+
+        JobStatistics.record_arrivals(jobs)
+        self.assertAlmostEqual(JobStatistics.get_arrival_rate(10), 0.2)
+
+    def test_threshold_policy(self):
+        """
+        The threshold policy should only spawn once the overflow threshold
+        is passed, or when there are jobs but no instances.
+        """
+        self.assertEqual(ThresholdScalingPolicy.get_desired_num_instances(0), 0)
+        self._cache_jobs(1)
+        self.assertEqual(ThresholdScalingPolicy.get_desired_num_instances(0), 1)
+
+        capacity = settings.MAX_ENCODING_JOBS_PER_EC2_INSTANCE
+        self._cache_jobs(capacity + settings.JOB_OVERFLOW_THRESH - 1,
+                         'ENCODING')
+        self.assertEqual(ThresholdScalingPolicy.get_desired_num_instances(1), 1)
+        self._cache_jobs(capacity + 1, 'DOWNLOADING')
+        self.assertTrue(
+            ThresholdScalingPolicy.get_desired_num_instances(1) > 1)
+
+    def test_predictive_policy(self):
+        """
+        The predictive policy should size for both the backlog and the
+        arrival rate, and never ask for fewer instances than are running.
+        """
+        old_settings = (settings.MAX_ENCODING_JOBS_PER_EC2_INSTANCE,
+                        settings.FEEDERD_SCALING_TARGET_QUEUE_WAIT,
+                        settings.FEEDERD_SCALING_INSTANCE_BOOT_TIME,
+                        settings.FEEDERD_SCALING_DEFAULT_JOB_DURATION)
+        settings.MAX_ENCODING_JOBS_PER_EC2_INSTANCE = 2
+        settings.FEEDERD_SCALING_TARGET_QUEUE_WAIT = 100
+        settings.FEEDERD_SCALING_INSTANCE_BOOT_TIME = 50
+        settings.FEEDERD_SCALING_DEFAULT_JOB_DURATION = 100
+        try:
+            self.assertEqual(
+                PredictiveScalingPolicy.get_desired_num_instances(0), 0)
+            self.assertEqual(
+                PredictiveScalingPolicy.get_desired_num_instances(3), 3)
+
+            # 10 pending jobs of 100 seconds each: 1000 slot-seconds, to be
+            # drained in 100 seconds, is 10 slots, or 5 instances.
+            self._cache_jobs(10)
+            self.assertEqual(
+                PredictiveScalingPolicy.get_desired_num_instances(0), 5)
+            # One instance already running finishes 100 slot-seconds of it
+            # while the rest boot.
+            self.assertEqual(
+                PredictiveScalingPolicy.get_desired_num_instances(1), 5)
+
+            # A burst of 0.1 jobs/second needs 10 more slots to keep up,
+            # plus 500 slot-seconds that arrive while booting.
+            JobStatistics.record_arrivals(
+                [None] * int(0.1 * settings.FEEDERD_SCALING_BURST_WINDOW))
+            self.assertEqual(
+                PredictiveScalingPolicy.get_desired_num_instances(0), 13)
+
+            # Scaling in, the estimate can go below what's running, but
+            # never below what the unfinished jobs need.
+            JobStatistics.ARRIVALS.clear()
+            self._cache_jobs(10, 'ENCODING')
+            self.assertEqual(
+                PredictiveScalingPolicy.get_min_num_instances(20), 10)
+            self.assertEqual(
+                ThresholdScalingPolicy.get_min_num_instances(20), 10)
+        finally:
+            (settings.MAX_ENCODING_JOBS_PER_EC2_INSTANCE,
+             settings.FEEDERD_SCALING_TARGET_QUEUE_WAIT,
+             settings.FEEDERD_SCALING_INSTANCE_BOOT_TIME,
+             settings.FEEDERD_SCALING_DEFAULT_JOB_DURATION) = old_settings
+
+class InstanceTypeTests(unittest.TestCase):
+    """
+    Tests for picking instance types, and accounting for their capacity.
+    """
+    def setUp(self):
+        self.old_instance_types = settings.EC2_INSTANCE_TYPES
+        settings.EC2_INSTANCE_TYPES = {
+            'small': {'slots': 2, 'throughput': 1.0, 'cost': 0.1},
+            'big': {'slots': 4, 'throughput': 2.0, 'cost': 0.3},
+        }
+
+    def tearDown(self):
+        settings.EC2_INSTANCE_TYPES = self.old_instance_types
+
+    def test_choose_instance_types(self):
+        """
+        Long jobs should go to fast instances, and short jobs to cheap ones.
+        """
+        short_jobs = [600] * 4
+        long_jobs = [3600 * 10] * 4
+        self.assertEqual(instance_types.choose_instance_types(
+            4, 10, short_jobs, 600), ['small', 'small'])
+        self.assertEqual(instance_types.choose_instance_types(
+            8, 10, long_jobs, 600), ['big'])
+        # The long jobs take up one big instance, leaving the short ones.
+        self.assertEqual(instance_types.choose_instance_types(
+            10, 10, long_jobs[:2] + short_jobs, 600), ['big', 'small'])
+        self.assertEqual(instance_types.choose_instance_types(
+            100, 3, short_jobs, 600), ['small', 'small', 'small'])
+        self.assertEqual(instance_types.choose_instance_types(
+            0, 3, short_jobs, 600), [])
+
+    def test_capacity(self):
+        """
+        Capacity should go by each instance's type, and the slots reported
+        in its heartbeat, if any.
+        """
+        instances = [FakeInstance('i-1', 0, 'small'),
+                     FakeInstance('i-2', 0, 'big'),
+                     FakeInstance('i-3', 0, 'unknown')]
+        default_slots = settings.MAX_ENCODING_JOBS_PER_EC2_INSTANCE
+        self.assertEqual(EC2InstanceManager.get_capacity(instances),
+                         2 + 8 + default_slots)
+        node_states = {'i-1': {'instance_type': 'big', 'slots': '3'}}
+        self.assertEqual(
+            EC2InstanceManager.get_capacity(instances, node_states),
+            6 + 8 + default_slots)
+
+# Stands in for a virtualenv's python when running install.sh. It points
+# get_python_lib() at a scratch directory, and does nothing else.
+FAKE_PYTHON = """#!/bin/sh
+case "$*" in
+    *get_python_lib*) echo "$(dirname "$0")/../site-packages" ;;
+esac
+"""
+# Stands in for a virtualenv's pip, and records how it was called.
+FAKE_PIP = """#!/bin/sh
+echo "$@" >> "$(dirname "$0")/../pip.log"
+"""
+
+class ReleaseBundleTests(unittest.TestCase):
+    """
+    Tests for building release bundles. Nothing is uploaded.
+    """
+    def setUp(self):
+        self.build_dirs = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+
+    def tearDown(self):
+        for build_dir in self.build_dirs:
+            shutil.rmtree(build_dir)
+
+    def test_build_bundle(self):
+        """
+        Bundles should be named after their contents, and hold the package,
+        pinned requirements, and install script.
+        """
+        paths = [release_bundle.build_bundle(build_dir)
+                 for build_dir in self.build_dirs]
+        bundle_file = os.path.basename(paths[0])
+        self.assertEqual(bundle_file, os.path.basename(paths[1]))
+        bundle_name = bundle_file[:-len('.tar.gz')]
+
+        tar = tarfile.open(paths[0])
+        names = tar.getnames()
+        for name in ['media_nommer/__init__.py', 'requirements.txt',
+                     'install.sh']:
+            self.assertTrue('%s/%s' % (bundle_name, name) in names)
+        self.assertEqual([name for name in names if name.endswith('.pyc')],
+                         [])
+        requirements = tar.extractfile(
+            '%s/requirements.txt' % bundle_name).read()
+        self.assertTrue('boto==' in requirements)
+        # The Twisted plugins are installed, and the plugin cache refreshed
+        # once everything is in place.
+        install_script = tar.extractfile('%s/install.sh' % bundle_name).read()
+        for plugin in release_bundle.TWISTED_PLUGINS:
+            self.assertTrue('%s/media_nommer/twisted/plugins/%s' % (
+                                bundle_name, plugin) in names)
+            self.assertTrue(plugin in install_script)
+        self.assertTrue(install_script.rindex('getPlugins') >
+                        install_script.rindex('cp '))
+
+        commands = release_bundle.get_install_commands(
+            release_bundle.S3_KEY_PREFIX + bundle_file)
+        self.assertTrue(bundle_file in commands[0])
+        self.assertTrue('%s/install.sh' % bundle_name in commands[1])
+
+    def test_install_bundle(self):
+        """
+        Without wheels, install.sh should still install the pinned
+        requirements, along with the package and Twisted plugins.
+        """
+        old_include = settings.EC2_RELEASE_BUNDLE_INCLUDE_DEPENDENCIES
+        settings.EC2_RELEASE_BUNDLE_INCLUDE_DEPENDENCIES = False
+        try:
+            path = release_bundle.build_bundle(self.build_dirs[0])
+        finally:
+            settings.EC2_RELEASE_BUNDLE_INCLUDE_DEPENDENCIES = old_include
+        bundle_name = os.path.basename(path)[:-len('.tar.gz')]
+        tar = tarfile.open(path)
+        tar.extractall(self.build_dirs[1])
+        tar.close()
+
+        virtualenv = os.path.join(self.build_dirs[1], 'venv')
+        os.makedirs(os.path.join(virtualenv, 'bin'))
+        os.makedirs(os.path.join(virtualenv, 'site-packages'))
+        for name, script in [('python', FAKE_PYTHON), ('pip', FAKE_PIP)]:
+            script_path = os.path.join(virtualenv, 'bin', name)
+            fobj = open(script_path, 'w')
+            fobj.write(script)
+            fobj.close()
+            os.chmod(script_path, 0755)
+
+        env = dict(os.environ, VIRTUALENV=virtualenv)
+        subprocess.check_call(['sh', os.path.join(self.build_dirs[1],
+                                                  bundle_name, 'install.sh')],
+                              env=env)
+        pip_log = open(os.path.join(virtualenv, 'pip.log')).read()
+        self.assertEqual(pip_log.strip(), 'install -r requirements.txt')
+        site_packages = os.path.join(virtualenv, 'site-packages')
+        self.assertTrue(os.path.exists(
+            os.path.join(site_packages, 'media_nommer', '__init__.py')))
+        for plugin in release_bundle.TWISTED_PLUGINS:
+            self.assertTrue(os.path.exists(
+                os.path.join(site_packages, 'twisted', 'plugins', plugin)))
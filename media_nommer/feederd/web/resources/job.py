@@ -4,9 +4,34 @@ via its JSON API. :py:class:`JobResource` serves as the top-level routing
 resource that determines the /job/<command>/ routing to the appropriate
 sub-resource.
 """
+import hashlib
+from twisted.internet.defer import Deferred
+from twisted.web.http import CACHED, NOT_FOUND
+from twisted.web.resource import NoResource
+from twisted.web.server import NOT_DONE_YET
 from media_nommer.utils.resources import BasicJSONResource, RoutingResource
-from media_nommer.core.job_state_backend import EncodingJob
+from media_nommer.utils.thread_pools import defer_to_named_pool
+from media_nommer.conf import settings
+from media_nommer.core.job_state_backend import EncodingJob, get_job_state_backend
 from media_nommer.feederd.job_cache import JobCache
+from media_nommer.feederd.scaling_policy import JobStatistics
+from media_nommer.feederd.job_state_stream import JobStateStream, \
+    LongPollWatcher, EventStreamWatcher
+
+def defer_to_submission_pool(func, *args, **kwargs):
+    """
+    Runs a blocking call (like saving jobs to the job state backend) in
+    the job submission thread pool, so the reactor thread is free to keep
+    serving requests. The pool's size is set via the
+    :py:data:`FEEDERD_SUBMISSION_THREADS <media_nommer.conf.settings.FEEDERD_SUBMISSION_THREADS>`
+    setting.
+
+    :rtype: Deferred
+    :returns: A Deferred that fires with the call's return value.
+    """
+    return defer_to_named_pool('feederd-submission',
+                               settings.FEEDERD_SUBMISSION_THREADS,
+                               func, *args, **kwargs)
 
 class JobSubmitResource(BasicJSONResource):
     """
@@ -26,21 +51,32 @@ class JobSubmitResource(BasicJSONResource):
         'options', 'nommer',
     ]
 
-    def set_context(self, request):
-        payload = self.user_input
-        print(payload)
+    def get_job_from_payload(self, payload):
+        """
+        Validates a job submission and creates a new (un-saved) job from it.
+
+        :param dict payload: The user's job submission.
+        :rtype: tuple
+        :returns: A tuple of the new
+            :py:class:`EncodingJob <media_nommer.core.job_state_backend.EncodingJob>`
+            and ``None``, or ``None`` and an error message if the
+            submission was invalid.
+        """
+        if not isinstance(payload, dict):
+            return None, "Job submission must be a JSON object."
 
         for key in self.required_keys:
             if not payload.get(key):
                 msg = "Missing/invalid required key+val: ['%s']" % key
-                self.set_error(msg)
-                return
+                return None, msg
+
+        if not isinstance(payload['job_options'], dict):
+            return None, "Missing/invalid required key+val: ['job_options']"
 
         for key in self.required_job_options_keys:
             if not payload['job_options'].get(key):
                 msg = "Missing/invalid required key+val: ['job_options'][%s]" % key
-                self.set_error(msg)
-                return
+                return None, msg
 
         source_path = payload['source_path']
         dest_path = payload['dest_path']
@@ -54,17 +90,374 @@ class JobSubmitResource(BasicJSONResource):
         #print "OPTIONS", job_options
         #print "NOMMER", nommer
 
-        # Create a new job and save it to the DB/queue.
-        job = EncodingJob(source_path, dest_path, nommer, job_options,
-                          notify_url=notify_url)
-        unique_job_id = job.save()
+        try:
+            job = EncodingJob(source_path, dest_path, nommer, job_options,
+                              notify_url=notify_url)
+        except ImportError:
+            msg = "Invalid nommer: ['job_options']['nommer']"
+            return None, msg
+        return job, None
+
+    def set_context(self, request):
+        payload = self.user_input
+        print(payload)
+
+        job, error = self.get_job_from_payload(payload)
+        if error:
+            self.set_error(error)
+            return
+
+        # Save the new job to the DB/queue.
+        deferred = defer_to_submission_pool(job.save)
+        deferred.addCallback(self.cb_job_saved, job)
+        return deferred
+
+    def cb_job_saved(self, unique_job_id, job):
+        """
+        Called on the reactor thread once the new job has been saved.
+
+        :param str unique_job_id: The new job's unique ID.
+        :param EncodingJob job: The newly saved job.
+        """
         # Add the job to the local job cache.
         JobCache.update_job(job)
+        JobStatistics.record_arrivals([job])
 
         # This is serialized and returned to the user.
         self.context.update({'job_id': unique_job_id})
 
 
+class JobSubmitBatchResource(JobSubmitResource):
+    """
+    Submits a list of new encoding jobs in one go. Each job is validated
+    the same way as with :py:class:`JobSubmitResource`, then all of the
+    valid ones are saved and enqueued with batched writes to the job state
+    backend. Results are returned per-job, in the order they were given.
+    """
+    def set_context(self, request):
+        payload = self.user_input
+
+        if not isinstance(payload, dict) or \
+           not isinstance(payload.get('jobs'), list) or not payload['jobs']:
+            self.set_error("Missing/invalid required key+val: ['jobs']")
+            return
+
+        if len(payload['jobs']) > settings.FEEDERD_MAX_JOBS_PER_BATCH_SUBMIT:
+            msg = "Too many jobs in one batch (the limit is %d)." % (
+                settings.FEEDERD_MAX_JOBS_PER_BATCH_SUBMIT)
+            self.set_error(msg)
+            return
+
+        results = []
+        valid_jobs = []
+        for job_payload in payload['jobs']:
+            job, error = self.get_job_from_payload(job_payload)
+            if error:
+                results.append({'success': False, 'message': error})
+            else:
+                results.append({'success': True})
+                valid_jobs.append(job)
+
+        deferred = defer_to_submission_pool(
+            get_job_state_backend().save_new_jobs, valid_jobs)
+        deferred.addCallback(self.cb_jobs_saved, valid_jobs, results)
+        return deferred
+
+    def cb_jobs_saved(self, errors, valid_jobs, results):
+        """
+        Called on the reactor thread once the valid jobs have been saved.
+
+        :param list errors: The error (or ``None``) for each valid job.
+        :param list valid_jobs: The jobs that passed validation.
+        :param list results: The per-job results, including the jobs that
+            didn't pass validation.
+        """
+        saved_results = [result for result in results if result['success']]
+        saved_jobs = []
+        for result, job, error in zip(saved_results, valid_jobs, errors):
+            result['job_id'] = job.unique_id
+            if error:
+                result.update({'success': False, 'message': error})
+            else:
+                # Add the job to the local job cache.
+                JobCache.update_job(job)
+                saved_jobs.append(job)
+        JobStatistics.record_arrivals(saved_jobs)
+
+        # This is serialized and returned to the user.
+        self.context.update({'jobs': results})
+
+
+class JobStatusResource(BasicJSONResource):
+    """
+    Looks up the current state of one or more jobs. Jobs are served from
+    the :py:class:`JobCache <media_nommer.feederd.job_cache.JobCache>` when
+    possible, and loaded from the job state backend otherwise.
+
+    Responses carry an ``ETag`` that changes whenever any of the jobs do,
+    so pollers can send ``If-None-Match`` and get a cheap
+    ``304 Not Modified`` back.
+
+    Paths: /job/status/<job_id>, /job/status?job_id=<id>&job_id=<id>
+    """
+    max_job_ids = 100
+    """The most jobs that may be looked up in one request."""
+
+    def __init__(self, unique_id=None):
+        """
+        :keyword str unique_id: The job to look up, for the single job form
+            of the call.
+        """
+        BasicJSONResource.__init__(self)
+        self.unique_id = unique_id
+        self.not_modified = False
+
+    def getChild(self, path, request):
+        if not path:
+            # Trailing slash.
+            return self
+        if self.unique_id is None:
+            return JobStatusResource(unique_id=path)
+        return NoResource()
+
+    def get_job_status(self, job):
+        """
+        :param EncodingJob job: The job to describe.
+        :rtype: dict
+        :returns: The job's details, as returned to the user.
+        """
+        return {
+            'job_id': job.unique_id,
+            'job_state': job.job_state,
+            'job_state_details': job.job_state_details,
+            'source_path': job.source_path,
+            'dest_path': job.dest_path,
+            'notify_url': job.notify_url,
+            'creation_dtime': job._get_string_from_dtime(job.creation_dtime),
+            'last_modified_dtime': job._get_string_from_dtime(
+                job.last_modified_dtime),
+        }
+
+    def get_requested_ids(self, request):
+        """
+        :rtype: list
+        :returns: The unique IDs of the jobs being looked up.
+        """
+        if self.unique_id:
+            return [self.unique_id]
+        if isinstance(self.user_input, dict) and \
+           isinstance(self.user_input.get('job_ids'), list):
+            return [str(unique_id) for unique_id in self.user_input['job_ids']]
+        return request.args.get('job_id', [])
+
+    def set_context(self, request):
+        unique_ids = self.get_requested_ids(request)
+        if not unique_ids:
+            self.set_error("Missing/invalid required key+val: ['job_ids']")
+            return
+        if len(unique_ids) > self.max_job_ids:
+            msg = "Too many jobs in one lookup (the limit is %d)." % (
+                self.max_job_ids)
+            self.set_error(msg)
+            return
+
+        jobs = {}
+        for unique_id in unique_ids:
+            job = JobCache.lookup_job(unique_id)
+            if job:
+                jobs[unique_id] = job
+        missing_ids = [unique_id for unique_id in unique_ids
+                       if not jobs.has_key(unique_id)]
+
+        if not missing_ids:
+            self.cb_jobs_found({}, request, unique_ids, jobs)
+            return
+
+        deferred = defer_to_named_pool('feederd-status',
+                                       settings.FEEDERD_STATUS_LOOKUP_THREADS,
+                                       self.load_jobs, missing_ids)
+        deferred.addCallback(self.cb_jobs_found, request, unique_ids, jobs)
+        return deferred
+
+    def load_jobs(self, unique_ids):
+        """
+        Loads jobs that weren't cached from the job state backend. Runs
+        in a thread.
+
+        :param list unique_ids: The unique IDs of the jobs to load.
+        :rtype: dict
+        :returns: The jobs that were found, keyed by unique ID.
+        """
+        backend = get_job_state_backend()
+        jobs = {}
+        for unique_id in unique_ids:
+            item = backend._get_job_item(unique_id)
+            if item:
+                jobs[unique_id] = backend._get_job_object_from_item(item)
+        return jobs
+
+    def cb_jobs_found(self, loaded_jobs, request, unique_ids, jobs):
+        """
+        Fills in the context once all of the jobs have been found (or not).
+
+        :param dict loaded_jobs: Jobs loaded from the backend.
+        :param request: The request being responded to.
+        :param list unique_ids: The requested unique IDs, in order.
+        :param dict jobs: Jobs found in the cache.
+        """
+        for unique_id, job in loaded_jobs.items():
+            # Save the backend a trip next time. Un-finished jobs will
+            # be picked up by the job cache as their state changes.
+            if job.is_finished():
+                JobCache.cache_finished_job(job)
+        jobs.update(loaded_jobs)
+
+        if self.unique_id and not jobs:
+            request.setResponseCode(NOT_FOUND)
+            self.set_error("No job found with ID: %s" % self.unique_id)
+            return
+
+        # The ETag covers the version and modification time of every job
+        # in the response, along with which ones weren't found.
+        etag = hashlib.md5()
+        for unique_id in unique_ids:
+            job = jobs.get(unique_id)
+            if job:
+                etag.update('%s:%s:%s;' % (unique_id, job.version,
+                    job._get_string_from_dtime(job.last_modified_dtime)))
+            else:
+                etag.update('%s:missing;' % unique_id)
+        if request.setETag('"%s"' % etag.hexdigest()) == CACHED:
+            self.not_modified = True
+            return
+
+        if self.unique_id:
+            self.context['job'] = self.get_job_status(jobs[self.unique_id])
+        else:
+            self.context['jobs'] = [self.get_job_status(jobs[unique_id])
+                                    for unique_id in unique_ids
+                                    if jobs.has_key(unique_id)]
+            self.context['missing_job_ids'] = [
+                unique_id for unique_id in unique_ids
+                if not jobs.has_key(unique_id)]
+
+    def get_context_json(self):
+        if self.not_modified:
+            # 304 responses have no body.
+            return ''
+        return BasicJSONResource.get_context_json(self)
+
+    def render_GET(self, request):
+        """
+        Looks up the jobs given in the URL.
+
+        :rtype: str
+        :returns: The JSON-serialized context dict.
+        """
+        return self.render_context(request)
+
+
+class JobEventsResource(BasicJSONResource):
+    """
+    Hands out job state changes as :doc:`../feederd` hears about them.
+    Served as server-sent events if the client asks for
+    ``text/event-stream``, or as a JSON long-poll otherwise.
+
+    Query parameters:
+
+    * ``job_id``: Only send changes for this job. May be given more than once.
+    * ``cursor``: Only send changes that came after this cursor. Without it,
+      only new changes are sent. Event streams may use the standard
+      ``Last-Event-ID`` header instead.
+
+    Path: /job/events
+    """
+    def get_unique_ids(self, request):
+        """
+        :rtype: list or ``None``
+        :returns: The jobs the client is interested in, or ``None`` for all.
+        """
+        return request.args.get('job_id') or None
+
+    def get_start_seq(self, request):
+        """
+        :rtype: tuple
+        :returns: A tuple of the sequence number to start after, and a bool
+            that is ``True`` if the client's cursor was not usable (from
+            before a restart, for example).
+        """
+        cursor = request.getHeader('last-event-id') or \
+                 request.args.get('cursor', [None])[0]
+        if not cursor:
+            return JobStateStream.LAST_SEQ, False
+        seq = JobStateStream.parse_cursor(cursor)
+        if seq is None:
+            # Send everything we've got.
+            return 0, True
+        return seq, False
+
+    def set_context(self, request):
+        unique_ids = self.get_unique_ids(request)
+        seq, missed = self.get_start_seq(request)
+        events, dropped = JobStateStream.get_events_since(seq, unique_ids)
+        self.context['missed_events'] = missed or dropped
+
+        if events:
+            self.cb_events(events)
+            return
+
+        deferred = Deferred()
+        watcher = LongPollWatcher(deferred, unique_ids=unique_ids)
+        JobStateStream.add_watcher(watcher)
+        request.notifyFinish().addErrback(lambda failure: watcher.cancel())
+        deferred.addCallback(self.cb_events)
+        return deferred
+
+    def cb_events(self, events):
+        """
+        Fills in the context with the events to send.
+
+        :param list events: The events to send, oldest first.
+        """
+        self.context['events'] = events
+        if events:
+            self.context['cursor'] = events[-1]['cursor']
+        else:
+            self.context['cursor'] = JobStateStream.get_cursor()
+
+    def render_stream(self, request):
+        """
+        Sends any events after the client's cursor, then holds the request
+        open and streams new events as they happen.
+
+        :returns: ``NOT_DONE_YET``
+        """
+        unique_ids = self.get_unique_ids(request)
+        seq, missed = self.get_start_seq(request)
+        request.setHeader('Content-Type', 'text/event-stream')
+        request.setHeader('Cache-Control', 'no-cache')
+
+        watcher = EventStreamWatcher(request, unique_ids=unique_ids)
+        events, dropped = JobStateStream.get_events_since(seq, unique_ids)
+        if missed or dropped:
+            # Let the client know it should re-sync via /job/status.
+            request.write('event: missed_events\ndata: {}\n\n')
+        if events:
+            watcher.send(events)
+        JobStateStream.add_watcher(watcher)
+        request.notifyFinish().addBoth(
+            lambda result: JobStateStream.remove_watcher(watcher))
+        return NOT_DONE_YET
+
+    def render_GET(self, request):
+        """
+        Streams or long-polls for job state changes.
+        """
+        if 'text/event-stream' in (request.getHeader('accept') or ''):
+            return self.render_stream(request)
+        return self.render_context(request)
+
+
 class JobResource(RoutingResource):
     """
     Job-related resources.
@@ -74,4 +467,7 @@ class JobResource(RoutingResource):
     # Maps the URL name to the resource.
     PATHS = {
         'submit': JobSubmitResource,
+        'submit_batch': JobSubmitBatchResource,
+        'status': JobStatusResource,
+        'events': JobEventsResource,
     }
\ No newline at end of file
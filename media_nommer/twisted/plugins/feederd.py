@@ -14,9 +14,11 @@ from twisted.application import internet
 from twisted.web.server import Site
 
 from media_nommer import conf
+from media_nommer.conf import settings
 from media_nommer.conf.utils import upload_settings
 from media_nommer.feederd.web.resources import APIResource
 from media_nommer.feederd.job_cache import JobCache
+from media_nommer.feederd import release_bundle
 
 class Options(usage.Options):
     """
@@ -47,6 +49,7 @@ class WebApiServiceMaker(object):
         """
         self.load_settings(options)
         self.upload_user_settings()
+        self.publish_release_bundle()
         self.load_job_cache()
         self.start_tasks()
 
@@ -81,8 +84,23 @@ class WebApiServiceMaker(object):
         Uploads a copy of the settings to the bucket specified on
         settings.CONFIG_S3_BUCKET. This is used by the nommers that require
         access to the config, like FFmpegNommer.
+
+        Only the EC2 instances that feederd launches know to download the
+        settings, so skip this if launches are disabled. This lets feederd
+        run without AWS when paired with a local job state backend.
+        """
+        if settings.FEEDERD_ALLOW_EC2_LAUNCHES:
+            upload_settings(self.user_settings)
+
+    def publish_release_bundle(self):
+        """
+        Publishes a release bundle of the running media-nommer code for new
+        EC2 instances to install from, rather than GitHub. Only done if
+        launches and settings.EC2_USE_RELEASE_BUNDLE are enabled.
         """
-        upload_settings(self.user_settings)
+        if settings.FEEDERD_ALLOW_EC2_LAUNCHES and \
+           settings.EC2_USE_RELEASE_BUNDLE:
+            release_bundle.publish_bundle()
 
     def load_job_cache(self):
         """
@@ -1,5 +1,8 @@
 import json
+from twisted.internet.defer import Deferred
 from twisted.web.resource import Resource, NoResource
+from twisted.web.server import NOT_DONE_YET
+from media_nommer.utils import logger
 
 class RoutingResource(Resource):
     """
@@ -35,6 +38,10 @@ class BasicJSONResource(Resource):
     Mixin for JSON Resource objects. No particular execution order is
     enforced here, just return the value of :method:`get_context_json` to
     the user.
+
+    If :meth:`set_context` has blocking work to do, it should do it off of
+    the reactor thread and return a Deferred that fires once :attr:`context`
+    is ready. The response is then sent asynchronously.
     """
     #noinspection PyUnusedLocal
     def __init__(self, *args, **kwargs):
@@ -81,6 +88,10 @@ class BasicJSONResource(Resource):
         """
         Adjusts the :attr:`context` attribute to contain whatever data will
         be returned by :meth:`render_POST`.
+
+        :rtype: ``None`` or Deferred
+        :returns: ``None`` if the context is ready, or a Deferred that fires
+            when it is.
         """
         pass
 
@@ -101,5 +112,49 @@ class BasicJSONResource(Resource):
         :returns: The JSON-serialized context dict.
         """
         self.user_input = self.parse_user_input(request)
-        self.set_context(request)
+        return self.render_context(request)
+
+    def render_context(self, request):
+        """
+        Calls :meth:`set_context` and returns the JSON dump of the context,
+        or sends it later if :meth:`set_context` returned a Deferred.
+        Resources that respond to other HTTP methods can call this from
+        their ``render_<METHOD>`` methods.
+
+        :rtype: str or ``NOT_DONE_YET``
+        :returns: The JSON-serialized context dict.
+        """
+        result = self.set_context(request)
+        if isinstance(result, Deferred):
+            self._render_deferred(request, result)
+            return NOT_DONE_YET
         return self.get_context_json()
+
+    def _render_deferred(self, request, deferred):
+        """
+        Finishes the response once the Deferred returned by
+        :meth:`set_context` fires.
+
+        :param request: The request being responded to.
+        :param Deferred deferred: The Deferred returned by :meth:`set_context`.
+        """
+        # Track whether the client went away while we were working, since
+        # writing to a finished request raises an exception.
+        lost = []
+        request.notifyFinish().addErrback(lambda failure: lost.append(failure))
+
+        def cb_finish(result):
+            if not lost:
+                request.write(self.get_context_json())
+                request.finish()
+
+        def eb_error(failure):
+            logger.error("BasicJSONResource._render_deferred(): " \
+                         "Error while rendering %s: %s" % (
+                            request.uri, failure.getTraceback()))
+            self.set_error('Internal server error.')
+            if not lost:
+                request.setResponseCode(500)
+
+        deferred.addErrback(eb_error)
+        deferred.addCallback(cb_finish)
@@ -0,0 +1,81 @@
+"""
+Named thread pools. Blocking work (like talking to AWS_) that shouldn't
+compete with everything else on the reactor's own thread pool gets a pool
+of its own here.
+"""
+from twisted.internet import reactor
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+# Keys are pool names, values are started ThreadPool instances. Do not
+# refer to directly, use get_thread_pool().
+_POOLS = {}
+
+def get_thread_pool(name, max_threads):
+    """
+    Lazy-loading of named thread pools. The pool is created and started the
+    first time it is asked for, and stopped when the reactor shuts down.
+    Only call this from the reactor thread.
+
+    :param str name: The name of the pool.
+    :param int max_threads: The most threads the pool will run. Only used
+        when the pool is first created.
+    :rtype: twisted.python.threadpool.ThreadPool
+    :returns: The started thread pool.
+    """
+    pool = _POOLS.get(name)
+    if pool is None:
+        pool = ThreadPool(minthreads=0, maxthreads=max_threads, name=name)
+        pool.start()
+        reactor.addSystemEventTrigger('during', 'shutdown', pool.stop)
+        _POOLS[name] = pool
+    return pool
+
+def defer_to_named_pool(name, max_threads, func, *args, **kwargs):
+    """
+    Runs a blocking call in the named thread pool, leaving the reactor
+    thread free. Only call this from the reactor thread.
+
+    :param str name: The name of the pool, as per :py:func:`get_thread_pool`.
+    :param int max_threads: The most threads the pool will run.
+    :param callable func: The blocking callable. Any other args and kwargs
+        are passed on to it.
+    :rtype: Deferred
+    :returns: A Deferred that fires with the call's return value.
+    """
+    pool = get_thread_pool(name, max_threads)
+    return deferToThreadPool(reactor, pool, func, *args, **kwargs)
+
+def call_in_named_pool(name, max_threads, func, *args, **kwargs):
+    """
+    Runs a blocking call in the named thread pool, without waiting around
+    for the result. Only call this from the reactor thread.
+
+    :param str name: The name of the pool, as per :py:func:`get_thread_pool`.
+    :param int max_threads: The most threads the pool will run.
+    :param callable func: The blocking callable. Any other args and kwargs
+        are passed on to it.
+    """
+    pool = get_thread_pool(name, max_threads)
+    pool.callInThread(func, *args, **kwargs)
+
+def get_pool_stats(name):
+    """
+    Reports how busy the named thread pool is.
+
+    :param str name: The name of the pool, as per :py:func:`get_thread_pool`.
+    :rtype: dict
+    :returns: A dict with ``max_threads``, ``busy`` (threads running
+        something), ``idle`` (threads waiting for work) and ``queued``
+        (calls waiting for a thread) keys. All zeroes if the pool hasn't
+        been created yet.
+    """
+    pool = _POOLS.get(name)
+    if pool is None:
+        return {'max_threads': 0, 'busy': 0, 'idle': 0, 'queued': 0}
+    return {
+        'max_threads': pool.max,
+        'busy': len(pool.working),
+        'idle': len(pool.waiters),
+        'queued': pool.q.qsize(),
+    }
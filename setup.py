@@ -38,6 +38,7 @@ setup(
         'media_nommer',
         'media_nommer.conf',
         'media_nommer.core',
+        'media_nommer.core.job_state_backends',
         'media_nommer.ec2nommerd',
         'media_nommer.ec2nommerd.nommers',
         'media_nommer.ec2nommerd.web',